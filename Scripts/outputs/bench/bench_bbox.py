@@ -0,0 +1,70 @@
+# Compares the PIL and numpy alpha bounding box engines in image.py
+# Usage: python3 bench/bench_bbox.py [--frames N] [--resolution N]
+
+import os, sys, time, tempfile, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from PIL import Image, ImageDraw
+import image
+
+def make_frame(path: str, resolution: int, i: int, frames: int):
+    # A board-like rectangle with an anti-aliased edge, moving across the frame
+    img = Image.new("RGBA", (resolution, resolution), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    offset = int(resolution * 0.2 * i / max(frames, 1))
+    box = [resolution // 4 + offset, resolution // 3, resolution // 2 + offset, resolution * 2 // 3]
+    draw.rectangle([box[0] - 2, box[1] - 2, box[2] + 2, box[3] + 2], fill=(0, 0, 0, 8))
+    draw.rectangle(box, fill=(0, 120, 40, 255))
+    img.save(path)
+
+def timed(fn, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Alpha bounding box benchmark")
+    argparser.add_argument("--frames", type=int, help="Number of frames in the stack", default=100)
+    argparser.add_argument("--resolution", type=int, help="Still render resolution", default=2000)
+    argparser.add_argument("--frame-resolution", type=int, help="Animation frame resolution", default=640)
+    argparser.add_argument("--threshold", type=int, help="Alpha threshold", default=16)
+    args = argparser.parse_args()
+
+    if image.get_bbox_backend() != "numpy":
+        print("numpy is not installed. Only the PIL engine can be measured.")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        still = os.path.join(tmpdir, "still.png")
+        make_frame(still, args.resolution, 0, 1)
+        frames = []
+        for i in range(args.frames):
+            path = os.path.join(tmpdir, f"{i:04d}.png")
+            make_frame(path, args.frame_resolution, i, args.frames)
+            frames.append(path)
+
+        # Decode up front, so only the bounding box is measured
+        still_img = Image.open(still)
+        still_img.load()
+        frame_imgs = [ Image.open(path) for path in frames ]
+        for img in frame_imgs:
+            img.load()
+
+        cases = [
+            (f"{args.resolution}px still", lambda fn, t: fn(still_img, t), image.get_alpha_bbox_pil, image.get_alpha_bbox_numpy),
+            (f"{args.frames} frame stack", lambda fn, t: fn(frame_imgs, t), image.find_bounding_box_pil, image.find_bounding_box_numpy),
+        ]
+
+        print(f"{'case':<24}{'threshold':>10}{'pil':>10}{'numpy':>10}")
+        for name, call, pil_fn, numpy_fn in cases:
+            for threshold in [0, args.threshold]:
+                pil_time = timed(lambda: call(pil_fn, threshold))
+                numpy_time = None
+                if image.get_bbox_backend() == "numpy":
+                    assert call(pil_fn, threshold) == call(numpy_fn, threshold)
+                    numpy_time = timed(lambda: call(numpy_fn, threshold))
+                numpy_str = f"{numpy_time * 1000:.1f}ms" if numpy_time is not None else "-"
+                print(f"{name:<24}{threshold:>10}{pil_time * 1000:>8.1f}ms{numpy_str:>10}")
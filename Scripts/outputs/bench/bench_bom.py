@@ -0,0 +1,69 @@
+# Measures the BOM engine in bom.py on synthetic python-bom netlists
+# Usage: python3 bench/bench_bom.py [--sizes 1000,10000,100000]
+
+import os, sys, time, tempfile, argparse, tracemalloc
+from xml.sax.saxutils import escape, quoteattr
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import bom
+
+PREFIXES = ["R", "C", "L", "D", "U", "J"]
+FOOTPRINTS = ["R_0402_1005Metric", "C_0402_1005Metric", "C_0805_2012Metric", "SOT-23", "SOIC-8_3.9x4.9mm_P1.27mm", "QFN-32-1EP_5x5mm_P0.5mm"]
+VALUES = ["10k", "4k7", "100n", "1u", "10u", "BAT54", "LM358", "STM32G0B1 & friends"]
+
+def write_netlist(path: str, count: int):
+    # Writes a netlist shaped like a python-bom export, including the libparts and nets sections
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<export version="E">\n')
+        f.write('  <design><source>bench.kicad_sch</source><tool>bench</tool></design>\n  <components>\n')
+        for i in range(count):
+            prefix = PREFIXES[i % len(PREFIXES)]
+            value = VALUES[(i // 7) % len(VALUES)]
+            footprint = FOOTPRINTS[(i // 3) % len(FOOTPRINTS)]
+            f.write(f'    <comp ref="{prefix}{i + 1}">\n')
+            f.write(f'      <value>{escape(value)}</value>\n')
+            f.write(f'      <footprint>Lib:{footprint}</footprint>\n')
+            f.write(f'      <fields><field name="LCSC_Part">C{1000 + i % 500}</field><field name="Description">{escape(value)} part, {"long " * 20}description</field></fields>\n')
+            f.write(f'      <libsource lib="Device" part="{prefix}" description=""/>\n')
+            if i % 17 == 0:
+                f.write('      <property name="dnp"/>\n')
+            f.write(f'      <sheetpath names="/" tstamps="/"/>\n      <tstamps>{i:08x}-0000-0000-0000-000000000000</tstamps>\n')
+            f.write('    </comp>\n')
+        f.write('  </components>\n  <libparts>\n')
+        for prefix in PREFIXES:
+            f.write(f'    <libpart lib="Device" part="{prefix}"><fields><field name="Reference">{prefix}</field></fields></libpart>\n')
+        f.write('  </libparts>\n  <nets>\n')
+        for i in range(count // 2):
+            f.write(f'    <net code="{i + 1}" name={quoteattr(f"Net-{i}")}><node ref="{PREFIXES[0]}{i + 1}" pin="1"/><node ref="{PREFIXES[1]}{i + 2}" pin="2"/></net>\n')
+        f.write('  </nets>\n</export>\n')
+
+def measure(fn) -> tuple[float, int]:
+    # Memory is traced on a second run, as tracing slows down the first
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="BOM engine benchmark")
+    argparser.add_argument("--sizes", type=str, help="Comma separated component counts", default="1000,10000,100000")
+    argparser.add_argument("--group-by", type=str, help="Comma separated group keys", default=",".join(bom.DEFAULT_GROUP_KEYS))
+    argparser.add_argument("--ranges", action="store_true", help="Compress designators into ranges")
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"{'components':>12}{'load':>12}{'load memory':>14}{'bom':>12}{'bom memory':>14}")
+        for count in [ int(s) for s in args.sizes.split(",") ]:
+            xml = os.path.join(tmpdir, f"{count}.xml")
+            csv = os.path.join(tmpdir, f"{count}.csv")
+            write_netlist(xml, count)
+
+            load_time, load_peak = measure(lambda: bom.load_components(xml))
+            components = bom.load_components(xml)
+            assert len(components) == count
+            bom_time, bom_peak = measure(lambda: bom.create_bom(bom.iter_components(xml), csv, ["LCSC_Part"], args.group_by.split(","), args.ranges))
+            print(f"{count:>12}{load_time * 1000:>10.0f}ms{load_peak / 1e6:>12.1f}MB{bom_time * 1000:>10.0f}ms{bom_peak / 1e6:>12.1f}MB")
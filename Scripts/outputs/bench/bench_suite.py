@@ -0,0 +1,227 @@
+# Offline benchmark suite for the output scripts, which needs no KiCad install.
+# Synthetic projects from projects.py are run through output.py with the kicad-cli stand-in in kicad_cli.py,
+# timing each stage, and the bom, image, pdfmerge and bundle modules are timed directly.
+# Results are written as json. Given a baseline, any result slower than the threshold allows fails the run.
+# The stand-in is put first on PATH, so the output.py suite does not run on Windows, where kicad-cli is a fixed path.
+# Usage: python3 bench/bench_suite.py [--sizes 50,500,2000] [--output results.json] [--baseline baseline.json] [--threshold 0.25]
+
+import os, sys, json, time, shutil, platform, tempfile, argparse, subprocess
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCH_DIR, "..", "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+import bom, image, pdfmerge, bundle, cache, schematic
+import projects, kicad_cli
+
+SUITES = ["output", "bom", "image", "pdfmerge", "bundle"]
+LATENCY_VARS = ["KICAD_STUB_LATENCY", "KICAD_STUB_LOAD_LATENCY", "KICAD_STUB_RENDER_LATENCY", "KICAD_STUB_JOBSET"]
+
+# Differences smaller than this are treated as noise, however large they are relative to the baseline
+MIN_DELTA = 0.02
+
+def make_stub_bin(path: str) -> str:
+    # Returns a directory holding a kicad-cli that runs the stand-in
+    os.makedirs(path, exist_ok=True)
+    script = os.path.join(path, "kicad-cli")
+    with open(script, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCH_DIR, "kicad_cli.py")}" "$@"\n')
+    os.chmod(script, 0o755)
+    return path
+
+def best_of(fn: callable, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def clear_memos():
+    # Parsed files and file hashes are memoised, which would hide the cost of all but the first run
+    pdfmerge._board_items.clear()
+    schematic._files.clear()
+    cache._file_hashes.clear()
+
+
+def run_output(input_pro: str, output_dir: str, env: dict, extra_args: list[str]) -> dict[str, float]:
+    # Runs output.py, and returns the time of each stage from its trace, along with the total time
+    trace_file = os.path.join(os.path.dirname(input_pro), "trace.json")
+    start = time.perf_counter()
+    result = subprocess.run([
+        sys.executable, os.path.join(SCRIPTS_DIR, "output.py"),
+        "--input", os.path.basename(input_pro),
+        "--output", output_dir,
+        "--trace", trace_file,
+    ] + extra_args, cwd=os.path.dirname(input_pro), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    output = result.stdout.decode()
+    if result.returncode != 0 or "Aborting" in output:
+        raise RuntimeError(f"output.py failed:\n{output[-2000:]}")
+
+    with open(trace_file, "r") as f:
+        events = json.load(f)["traceEvents"]
+    times = { e["name"]: e["dur"] / 1e6 for e in events if e["cat"] == "stage" }
+    times["total"] = elapsed
+    return times
+
+def bench_output(results: dict, input_pro: str, size: int, args: argparse.Namespace, env: dict) -> str:
+    # Times a run with no cache, and a run where everything is restored from the cache.
+    # Returns the output directory, for the bundle suite.
+    output_dir = os.path.join(os.path.dirname(input_pro), "outputs")
+    common = ["--layers", str(args.layers), "--jobs", str(args.jobs), "--cache-dir", ".bench-cache"]
+    if args.anim_format:
+        common += ["--anim-format", args.anim_format, "--anim-resolution", "200", "--anim-duration", "1"]
+    if args.jobset:
+        common += ["--jobset"]
+
+    runs = [ run_output(input_pro, output_dir, env, common + ["--no-cache"]) for _ in range(args.repeat) ]
+    for name in runs[0]:
+        results[f"output.cold.{size}.{name}"] = min(run[name] for run in runs)
+
+    shutil.rmtree(os.path.join(os.path.dirname(input_pro), ".bench-cache"), ignore_errors=True)
+    run_output(input_pro, output_dir, env, common)
+    runs = [ run_output(input_pro, output_dir, env, common) for _ in range(args.repeat) ]
+    results[f"output.cached.{size}.total"] = min(run["total"] for run in runs)
+    return output_dir
+
+def bench_bom(results: dict, input_pro: str, size: int, args: argparse.Namespace):
+    base = os.path.splitext(input_pro)[0]
+    xml = base + ".bench.xml"
+    kicad_cli.export_python_bom(base + ".kicad_sch", xml)
+    components = bom.load_components(xml)
+    def load_schematic():
+        clear_memos()
+        schematic.load_components(base + ".kicad_sch")
+    results[f"bom.schematic.{size}"] = best_of(load_schematic, args.repeat)
+    results[f"bom.xml.{size}"] = best_of(lambda: bom.load_components(xml), args.repeat)
+    results[f"bom.create.{size}"] = best_of(lambda: bom.create_bom(components, base + ".bench.csv", ["LCSC_Part"], bom.DEFAULT_GROUP_KEYS, True), args.repeat)
+
+def bench_pdfmerge(results: dict, input_pro: str, size: int, args: argparse.Namespace, tmpdir: str):
+    input_pcb = os.path.splitext(input_pro)[0] + ".kicad_pcb"
+    layers = projects.get_layers(args.layers)
+
+    def hash_layers():
+        clear_memos()
+        for layer in layers:
+            pdfmerge.hash_board_layers(input_pcb, [layer, "Edge.Cuts"])
+    results[f"pdfmerge.hash.{size}"] = best_of(hash_layers, args.repeat)
+
+    if pdfmerge.get_backend(True) is None:
+        return
+    pages_dir = os.path.join(tmpdir, f"pages-{size}")
+    pages = [ kicad_cli.export_pcb_pdf(input_pcb, pages_dir, layer, "Edge.Cuts") for layer in layers ]
+    output_pdf = os.path.join(tmpdir, f"merged-{size}.pdf")
+    results[f"pdfmerge.merge.{size}"] = best_of(lambda: pdfmerge.merge_pdf(pages, output_pdf, layers), args.repeat)
+
+def bench_bundle(results: dict, input_path: str, size: int, args: argparse.Namespace, tmpdir: str):
+    for format in bundle.SUPPORTED_FORMATS:
+        output_file = os.path.join(tmpdir, f"bundle-{size}.{format}")
+        results[f"bundle.{format}.{size}"] = best_of(lambda: bundle.bundle(input_path, output_file, jobs=args.jobs), args.repeat)
+
+def bench_image(results: dict, args: argparse.Namespace, tmpdir: str):
+    # Renders a set of animation frames with the stand-in, and times cropping and encoding them
+    frames = []
+    for i in range(args.frames):
+        path = os.path.join(tmpdir, f"frame-{i}.png")
+        kicad_cli.write_png(path, 640, 640, kicad_cli.render_rows(640, 640, 0.8, f"0,{i * 360 / args.frames},0", []))
+        frames.append(path)
+    results["image.bbox"] = best_of(lambda: image.find_bounding_box(frames), args.repeat)
+    bbox = image.find_bounding_box(frames)
+    for format in ["gif", "webp"]:
+        output_file = os.path.join(tmpdir, f"animation.{format}")
+        results[f"image.{format}"] = best_of(lambda: image.make_animation(frames, output_file, 20, bbox), args.repeat)
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    # Prints each result against the baseline, and returns the names of those which regressed
+    regressions = []
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':<{width}}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            print(f"{name:<{width}}{'-':>12}{current:>11.3f}s{'new':>10}")
+            continue
+        change = (current - previous) / previous if previous > 0 else 0.0
+        regressed = current > previous * (1 + threshold) and current - previous > MIN_DELTA
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<{width}}{previous:>11.3f}s{current:>11.3f}s{change:>+9.0%}{' !' if regressed else ''}")
+    return regressions
+
+def get_meta(args: argparse.Namespace) -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "sizes": args.sizes,
+        "layers": args.layers,
+        "jobs": args.jobs,
+        "latency": { name: os.environ[name] for name in LATENCY_VARS if name in os.environ },
+    }
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Offline benchmark suite for the output scripts")
+    argparser.add_argument("--sizes", type=str, help="Comma separated part counts of the synthetic projects", default="50,500,2000")
+    argparser.add_argument("--layers", type=int, help="Number of copper layers in the synthetic projects", default=4)
+    argparser.add_argument("--suites", type=str, help="Comma separated suites to run", default=",".join(SUITES))
+    argparser.add_argument("--repeat", type=int, help="Number of runs of each benchmark. The fastest is recorded.", default=3)
+    argparser.add_argument("--jobs", "-j", type=int, help="Number of jobs passed to output.py and the bundler", default=os.cpu_count())
+    argparser.add_argument("--jobset", action="store_true", help="Run output.py with --jobset")
+    argparser.add_argument("--anim-format", type=str, help="Include an animation of this format in the output.py runs", default=None, choices=image.ANIMATION_FORMATS)
+    argparser.add_argument("--frames", type=int, help="Number of frames for the image suite", default=40)
+    argparser.add_argument("--output", "-o", type=str, help="Json file to write the results to", default=None)
+    argparser.add_argument("--baseline", type=str, help="Json results to compare against", default=None)
+    argparser.add_argument("--threshold", type=float, help="Fraction a result may be slower than the baseline before failing", default=0.25)
+    argparser.add_argument("--keep", type=str, help="Directory to keep the projects and outputs in, rather than a temporary directory", default=None)
+    args = argparser.parse_args()
+
+    sizes = [ int(s) for s in args.sizes.split(",") ]
+    suites = args.suites.split(",")
+    for suite in suites:
+        if suite not in SUITES:
+            argparser.error(f"Unknown suite \"{suite}\". Choose from {', '.join(SUITES)}.")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.keep or tmpdir
+        env = dict(os.environ)
+        env["PATH"] = make_stub_bin(os.path.join(tmpdir, "bin")) + os.pathsep + env.get("PATH", "")
+
+        results = {}
+        for size in sizes:
+            print(f"Benchmarking {size} parts")
+            project_dir = os.path.join(workdir, f"project-{size}")
+            input_pro = projects.write_project(project_dir, "bench", size, args.layers)
+            bundle_input = project_dir
+            if "output" in suites:
+                bundle_input = bench_output(results, input_pro, size, args, env)
+            if "bom" in suites:
+                bench_bom(results, input_pro, size, args)
+            if "pdfmerge" in suites:
+                bench_pdfmerge(results, input_pro, size, args, tmpdir)
+            if "bundle" in suites:
+                bench_bundle(results, bundle_input, size, args, tmpdir)
+        if "image" in suites:
+            print("Benchmarking images")
+            bench_image(results, args, tmpdir)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["meta"] != get_meta(args):
+            print("Warning: the baseline was recorded with different settings")
+        regressions = compare(results, baseline["results"], args.threshold)
+    else:
+        width = max(len(name) for name in results)
+        for name, elapsed in results.items():
+            print(f"{name:<{width}}{elapsed:>11.3f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({ "meta": get_meta(args), "results": results }, f, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
@@ -0,0 +1,339 @@
+# Stands in for kicad-cli, so the output scripts can be benchmarked without a KiCad install.
+# It handles the commands used by output.py, plus jobsets. Outputs have the shape of the real ones and
+# grow with the size of the input, but their contents are not meaningful.
+# Latency is set with environment variables:
+#   KICAD_STUB_LATENCY          Seconds added to every command, for starting up (default 0.05)
+#   KICAD_STUB_LOAD_LATENCY     Seconds per MB of input file, for loading the design (default 0.2)
+#   KICAD_STUB_RENDER_LATENCY   Seconds per megapixel rendered (default 0.5)
+#   KICAD_STUB_JOBSET           Set to 0 to report that jobsets are not supported, as in KiCad 8
+# Usage: python3 bench/kicad_cli.py <kicad-cli arguments>
+
+import os, sys, json, math, time, zlib, struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import sexpr, schematic, jobset
+
+VERSION = "10.0.0"
+
+# Options which take no value. All other options take one.
+FLAGS = {
+    "--severity-warning", "--severity-error", "--schematic-parity", "--excellon-separate-th",
+    "--excellon-min-header", "--generate-map", "--perspective", "--no-dnp", "--include-border-title",
+    "--mode-separate", "--stop-on-error", "--help",
+}
+
+def get_latency(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+def parse_args(args: list[str]) -> tuple[tuple[str, ...], str | None, dict[str, str | bool]]:
+    # Returns the command, the input file and the options
+    command = []
+    input_file = None
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in FLAGS:
+            options[arg] = True
+        elif arg.startswith("-"):
+            options[arg] = args[i + 1]
+            i += 1
+        elif input_file is None and (os.path.sep in arg or "." in arg):
+            input_file = arg
+        else:
+            command.append(arg)
+        i += 1
+    return tuple(command), input_file, options
+
+def load_delay(input_file: str):
+    size = os.path.getsize(input_file) if input_file and os.path.exists(input_file) else 0
+    time.sleep(get_latency("KICAD_STUB_LOAD_LATENCY", 0.2) * size / 1e6)
+
+
+def read_board(input_pcb: str) -> list[list]:
+    with open(input_pcb, "r", encoding="utf-8") as f:
+        return [ sexpr.parse(item) for item in sexpr.split_items(f.read()) ]
+
+def get_footprints(items: list[list]) -> list[dict]:
+    footprints = []
+    for item in items:
+        if item[0] != "footprint":
+            continue
+        at = sexpr.find(item, "at") or ["at", "0", "0"]
+        properties = schematic.get_properties(item)
+        footprints.append({
+            "ref": properties.get("Reference", ""),
+            "value": properties.get("Value", ""),
+            "package": item[1].split(":")[-1],
+            "x": float(at[1]), "y": float(at[2]), "rot": float(at[3]) if len(at) > 3 else 0.0,
+            "side": "top" if sexpr.get_value(item, "layer") == "F.Cu" else "bottom",
+        })
+    return footprints
+
+def get_item_layers(item: list) -> list[str]:
+    layers = []
+    for child in item:
+        if type(child) is list and child and child[0] in ("layer", "layers"):
+            layers += child[1:]
+        if type(child) is list and child and child[0] == "pad":
+            layers += get_item_layers(child)
+    return layers
+
+def get_layer_items(items: list[list], layer: str) -> list[list]:
+    return [ item for item in items if any(l == layer or (l.startswith("*.") and layer.endswith(l[1:])) for l in get_item_layers(item)) ]
+
+
+def write_pdf(path: str, pages: list[list[str]]):
+    # Writes a pdf with a page of text lines per page. The content streams are deflated, as KiCad does.
+    objects = [ b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>" ]
+    kids = []
+    for lines in pages:
+        text = "BT /F1 6 Tf 20 570 Td 8 TL\n" + "".join(f"({line.replace('(', '').replace(')', '')}) '\n" for line in lines) + "ET\n"
+        # Some vector content, so the page is not just text
+        text += "".join(f"{20 + (i * 37) % 800} {20 + (i * 53) % 550} 6 4 re S\n" for i in range(len(lines)))
+        stream = zlib.compress(text.encode("latin-1", "replace"))
+        objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 842 595] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects)))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    data = bytearray(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for i, body in enumerate(objects):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % (i + 1) + body + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def write_png(path: str, width: int, height: int, rows):
+    # Writes an RGBA png from an iterable of rows
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    raw = b"".join(b"\0" + row for row in rows)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+def render_rows(width: int, height: int, zoom: float, rotate: str | None, footprints: list[dict]):
+    # Yields the rows of a board seen from above, squashed as it is rotated away from the camera.
+    # Parts are drawn as dark blocks, so frames differ and compress like a real render.
+    angle = math.radians(float(rotate.split(",")[1])) if rotate else 0.0
+    board_w = min(int(min(width, height) * 0.8 * zoom * max(abs(math.cos(angle)), 0.02)), width - 2)
+    board_h = min(int(min(width, height) * 0.8 * zoom), height)
+    left, top = (width - board_w) // 2, (height - board_h) // 2
+    clear = b"\0\0\0\0"
+    edge = b"\0\x60\x20\x80"
+    board = bytearray(b"\0\x80\x30\xff" * board_w)
+    for i, fp in enumerate(footprints[:board_w]):
+        x = (i * 7919) % max(board_w - 4, 1)
+        board[x * 4:(x + 4) * 4] = b"\x20\x20\x20\xff" * 4
+    parts = bytes(board)
+    plain = b"\0\x80\x30\xff" * board_w
+    for y in range(height):
+        if y < top or y >= top + board_h:
+            yield clear * width
+        else:
+            body = parts if (y - top) % 12 < 4 else plain
+            yield clear * (left - 1) + edge + body + edge + clear * (width - left - board_w - 1)
+
+
+def run_erc(input_sch: str, output: str):
+    components = schematic.load_components(input_sch)
+    violations = []
+    for i, c in enumerate(components[::40]):
+        violations.append({
+            "type": "pin_not_connected" if i % 2 else "lib_symbol_mismatch",
+            "description": "Pin not connected" if i % 2 else "Symbol doesn't match copy in library",
+            "severity": "error" if i % 5 == 0 else "warning",
+            "items": [ { "description": f"Symbol {c.ref} Pin 1", "pos": { "x": (i * 1.27) % 400, "y": (i * 2.54) % 280 }, "uuid": f"{i:08x}-0000-4000-8000-000000000000" } ],
+        })
+    with open(output, "w") as f:
+        json.dump({
+            "$schema": "https://schemas.kicad.org/erc.v1.json",
+            "source": os.path.basename(input_sch),
+            "kicad_version": VERSION,
+            "sheets": [ { "path": "/", "uuid_path": "/", "violations": violations } ],
+        }, f, indent=2)
+
+def run_drc(input_pcb: str, output: str):
+    footprints = get_footprints(read_board(input_pcb))
+    def violation(i: int, kind: str, description: str, fp: dict) -> dict:
+        return {
+            "type": kind, "description": description, "severity": "warning" if i % 3 else "error",
+            "items": [ { "description": f"Pad 1 [N{i}] of {fp['ref']} on F.Cu", "pos": { "x": fp["x"], "y": fp["y"] }, "uuid": f"{i:08x}-0000-4000-8000-000000000000" } ],
+        }
+    with open(output, "w") as f:
+        json.dump({
+            "$schema": "https://schemas.kicad.org/drc.v1.json",
+            "source": os.path.basename(input_pcb),
+            "kicad_version": VERSION,
+            "violations": [ violation(i, "silk_overlap", "Silkscreen overlap", fp) for i, fp in enumerate(footprints[::30]) ],
+            "unconnected_items": [ violation(i, "unconnected_items", "Missing connection between items", fp) for i, fp in enumerate(footprints[::97]) ],
+            "schematic_parity": [],
+        }, f, indent=2)
+
+def export_sch_pdf(input_sch: str, output: str):
+    pages = []
+    for path in schematic.get_sheet_files(input_sch):
+        sheet = schematic.SchematicFile(path)
+        pages.append([ f"{schematic.get_properties(s).get('Reference', '')} {schematic.get_properties(s).get('Value', '')}" for s in sheet.symbols ])
+    write_pdf(output, pages)
+
+def export_python_bom(input_sch: str, output: str):
+    from xml.sax.saxutils import escape, quoteattr
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<export version="E">\n  <design><source>{escape(input_sch)}</source><tool>Eeschema {VERSION}</tool></design>\n  <components>\n')
+        for c in schematic.load_components(input_sch):
+            footprint = c.fields.get("Footprint", c.footprint)
+            f.write(f'    <comp ref={quoteattr(c.ref)}>\n      <value>{escape(c.value)}</value>\n      <footprint>{escape(footprint)}</footprint>\n')
+            fields = [ (k, v) for k, v in c.fields.items() if k != "Footprint" ]
+            if fields:
+                f.write("      <fields>" + "".join(f"<field name={quoteattr(k)}>{escape(v)}</field>" for k, v in fields) + "</fields>\n")
+            if not c.fitted:
+                f.write('      <property name="dnp"/>\n')
+            f.write("    </comp>\n")
+        f.write("  </components>\n</export>\n")
+
+def export_gerbers(input_pcb: str, output: str, layers: str):
+    items = read_board(input_pcb)
+    name = os.path.splitext(os.path.basename(input_pcb))[0]
+    os.makedirs(output, exist_ok=True)
+    for layer in layers.split(","):
+        with open(os.path.join(output, f"{name}-{layer.replace('.', '_')}.gbr"), "w") as f:
+            f.write(f"%TF.GenerationSoftware,KiCad,Pcbnew,{VERSION}*%\n%TF.FileFunction,{layer}*%\n%FSLAX46Y46*%\n%MOMM*%\n")
+            for i, item in enumerate(get_layer_items(items, layer)):
+                f.write(f"D{10 + i % 20}*\nX{i * 1270}Y{i * 2540}D02*\nX{i * 1270 + 500000}Y{i * 2540}D01*\n")
+            f.write("M02*\n")
+
+def export_drill(input_pcb: str, output: str):
+    items = read_board(input_pcb)
+    vias = [ item for item in items if item[0] == "via" ]
+    name = os.path.splitext(os.path.basename(input_pcb))[0]
+    os.makedirs(output, exist_ok=True)
+    for kind, holes in [("PTH", vias), ("NPTH", vias[:len(vias) // 20])]:
+        with open(os.path.join(output, f"{name}-{kind}.drl"), "w") as f:
+            f.write(f"M48\n; DRILL file {{KiCad {VERSION}}}\nMETRIC\nT1C0.300\n%\nG90\nG05\nT1\n")
+            f.writelines(f"X{float(sexpr.find(via, 'at')[1]):.3f}Y{-float(sexpr.find(via, 'at')[2]):.3f}\n" for via in holes)
+            f.write("M30\n")
+        with open(os.path.join(output, f"{name}-{kind}-drl_map.gbr"), "w") as f:
+            f.write(f"%TF.FileFunction,Drillmap*%\n" + "".join(f"X{i}Y{i}D03*\n" for i in range(len(holes))) + "M02*\n")
+
+def export_pos(input_pcb: str, output: str):
+    with open(output, "w") as f:
+        f.write("Ref,Val,Package,PosX,PosY,Rot,Side\n")
+        for fp in get_footprints(read_board(input_pcb)):
+            f.write(f"\"{fp['ref']}\",\"{fp['value']}\",\"{fp['package']}\",{fp['x']:.4f},{-fp['y']:.4f},{fp['rot']:.4f},{fp['side']}\n")
+
+def export_step(input_pcb: str, output: str):
+    footprints = get_footprints(read_board(input_pcb))
+    with open(output, "w") as f:
+        f.write(f"ISO-10303-21;\nHEADER;\nFILE_NAME('{os.path.basename(output)}','',(''),(''),'KiCad {VERSION}','','');\nENDSEC;\nDATA;\n")
+        for i, fp in enumerate(footprints):
+            for j in range(40):
+                f.write(f"#{i * 40 + j + 1}=CARTESIAN_POINT('',({fp['x'] + j * 0.01:.4f},{fp['y']:.4f},{j * 0.05:.4f}));\n")
+        f.write("ENDSEC;\nEND-ISO-10303-21;\n")
+
+def render(input_pcb: str, output: str, width: int, height: int, zoom: float, rotate: str | None):
+    time.sleep(get_latency("KICAD_STUB_RENDER_LATENCY", 0.5) * width * height / 1e6)
+    footprints = get_footprints(read_board(input_pcb))
+    write_png(output, width, height, render_rows(width, height, zoom, rotate, footprints))
+
+def export_pcb_pdf(input_pcb: str, output: str, layers: str, common_layers: str) -> str:
+    items = read_board(input_pcb)
+    name = os.path.splitext(os.path.basename(input_pcb))[0]
+    drawn = [ item for layer in [layers] + common_layers.split(",") if layer for item in get_layer_items(items, layer) ]
+    path = os.path.join(output, f"{name}-{layers.split(',')[0].replace('.', '_')}.pdf")
+    os.makedirs(output, exist_ok=True)
+    write_pdf(path, [[ f"{item[0]} {i}" for i, item in enumerate(drawn) ]])
+    return path
+
+
+def run_export(command: tuple, input_file: str, options: dict) -> str | None:
+    # Runs a single export. Returns a message to print, if any.
+    output = options.get("--output")
+    if command == ("sch", "erc"):
+        run_erc(input_file, output)
+    elif command == ("pcb", "drc"):
+        run_drc(input_file, output)
+    elif command == ("sch", "export", "pdf"):
+        export_sch_pdf(input_file, output)
+    elif command == ("sch", "export", "python-bom"):
+        export_python_bom(input_file, output)
+    elif command == ("pcb", "export", "gerbers"):
+        export_gerbers(input_file, output, options["--layers"])
+    elif command == ("pcb", "export", "drill"):
+        export_drill(input_file, output)
+    elif command == ("pcb", "export", "pos"):
+        export_pos(input_file, output)
+    elif command == ("pcb", "export", "step"):
+        export_step(input_file, output)
+    elif command == ("pcb", "render"):
+        render(input_file, output, int(options["--width"]), int(options["--height"]), float(options["--zoom"]), options.get("--rotate"))
+    elif command == ("pcb", "export", "pdf"):
+        return f"Plotted to '{export_pcb_pdf(input_file, output, options['--layers'], options.get('--common-layers', ''))}'."
+    else:
+        raise ValueError(f"Unsupported command \"{' '.join(command)}\"")
+    return None
+
+def get_job_options(job: dict, root: str) -> dict:
+    # Converts the settings of a job back to the command line options
+    settings = job["settings"]
+    options = { "--output": os.path.join(root, settings["output_filename"]) }
+    if "layers" in settings:
+        options["--layers"] = ",".join(settings["layers"])
+    for name in ["width", "height", "zoom"]:
+        if name in settings:
+            options[f"--{name}"] = str(settings[name])
+    if "rotation_x" in settings:
+        options["--rotate"] = f"{settings['rotation_x']},{settings['rotation_y']},{settings['rotation_z']}"
+    return options
+
+def run_jobset(jobset_file: str, input_pro: str):
+    # The design is only loaded once for all the jobs, which is the point of a jobset
+    commands = { job_type: command for command, job_type in jobset.JOB_TYPES.items() }
+    with open(jobset_file, "r") as f:
+        config = json.load(f)
+    root = config["outputs"][0]["settings"]["output_path"]
+    base = os.path.splitext(input_pro)[0]
+    load_delay(base + ".kicad_sch")
+    load_delay(base + ".kicad_pcb")
+    for job in config["jobs"]:
+        command = commands[job["type"]]
+        input_file = base + (".kicad_sch" if command[0] == "sch" else ".kicad_pcb")
+        message = run_export(command, input_file, get_job_options(job, root))
+        if message:
+            print(message)
+
+def main(args: list[str]) -> int:
+    time.sleep(get_latency("KICAD_STUB_LATENCY", 0.05))
+    command, input_file, options = parse_args(args)
+    if command == ("version",):
+        print(VERSION)
+        return 0
+    if command[:1] == ("jobset",):
+        if os.environ.get("KICAD_STUB_JOBSET", "1") == "0":
+            print("Unknown command: jobset", file=sys.stderr)
+            return 1
+        if "--help" in options:
+            return 0
+        run_jobset(options["--file"], input_file)
+        return 0
+
+    load_delay(input_file)
+    try:
+        message = run_export(command, input_file, options)
+    except (ValueError, KeyError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if message:
+        print(message)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
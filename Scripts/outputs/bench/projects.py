@@ -0,0 +1,171 @@
+# Generates synthetic KiCad projects for benchmarking. The files follow the KiCad 8 formats closely enough
+# for schematic.py, pdfmerge.py and the kicad-cli stand-in, but are not meant to open in KiCad.
+# Usage: python3 bench/projects.py <directory> [--components N] [--layers N]
+
+import os, json, uuid, random, argparse
+
+PARTS = [
+    # prefix, value, footprint, pads
+    ("R", "10k", "Resistor_SMD:R_0402_1005Metric", 2),
+    ("R", "4k7", "Resistor_SMD:R_0402_1005Metric", 2),
+    ("C", "100n", "Capacitor_SMD:C_0402_1005Metric", 2),
+    ("C", "10u", "Capacitor_SMD:C_0805_2012Metric", 2),
+    ("D", "BAT54", "Package_TO_SOT_SMD:SOT-23", 3),
+    ("L", "4u7", "Inductor_SMD:L_1210_3225Metric", 2),
+    ("J", "Conn_01x04", "Connector_JST:JST_SH_SM04B-SRSS-TB_1x04-1MP_P1.00mm_Horizontal", 6),
+    ("U", "LM358", "Package_SO:SOIC-8_3.9x4.9mm_P1.27mm", 8),
+]
+
+# Every Nth part is DNP, and every Nth U has both of its units placed
+DNP_INTERVAL = 23
+MULTI_UNIT_INTERVAL = 3
+SYMBOLS_PER_SHEET = 200
+
+def get_layers(layers: int) -> list[str]:
+    return ["F.Cu"] + [ f"In{i}.Cu" for i in range(1, layers - 1) ] + ["B.Cu"]
+
+def quote(text: str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def make_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def get_parts(components: int) -> list[tuple[str, str, str, int, bool]]:
+    # Returns the reference, value, footprint, pad count and DNP flag of each part
+    counts = {}
+    parts = []
+    for i in range(components):
+        prefix, value, footprint, pads = PARTS[i % len(PARTS)]
+        counts[prefix] = counts.get(prefix, 0) + 1
+        parts.append((f"{prefix}{counts[prefix]}", value, footprint, pads, i % DNP_INTERVAL == DNP_INTERVAL - 1))
+    return parts
+
+def write_lib_symbols(f):
+    # The library symbols make up much of a real schematic, and must be skipped by the readers
+    f.write("  (lib_symbols\n")
+    # The U parts are two unit symbols. Each unit is drawn by a sub-symbol named <name>_<unit>_<style>.
+    for prefix, value, _, pads in PARTS:
+        units = 2 if prefix == "U" else 1
+        f.write(f'    (symbol "Device:{prefix}_{value}" (pin_names (offset 0.254)) (in_bom yes) (on_board yes)\n')
+        f.write(f'      (property "Reference" "{prefix}" (at 0 0 0) (effects (font (size 1.27 1.27))))\n')
+        for unit in range(1, units + 1):
+            f.write(f'      (symbol "{prefix}_{value}_{unit}_1"\n')
+            for pin in range(unit - 1, pads, units):
+                f.write(f'        (pin passive line (at 0 {pin * 2.54} 90) (length 1.27) (name "~" (effects (font (size 1.27 1.27)))) (number "{pin + 1}" (effects (font (size 1.27 1.27)))))\n')
+            f.write("      )\n")
+        f.write("    )\n")
+    f.write("  )\n")
+
+def write_symbol(f, rng: random.Random, part: tuple, unit: int, instance_path: str, project: str, x: float, y: float):
+    ref, value, footprint, _, dnp = part
+    prefix = ref.rstrip("0123456789")
+    f.write(f'  (symbol (lib_id "Device:{prefix}_{value}") (at {x:.2f} {y:.2f} 0) (unit {unit})\n')
+    f.write(f'    (in_bom yes) (on_board yes) (dnp {"yes" if dnp else "no"})\n')
+    f.write(f'    (uuid "{make_uuid(rng)}")\n')
+    f.write(f'    (property "Reference" {quote(ref)} (at {x:.2f} {y - 2.54:.2f} 0) (effects (font (size 1.27 1.27))))\n')
+    f.write(f'    (property "Value" {quote(value)} (at {x:.2f} {y + 2.54:.2f} 0) (effects (font (size 1.27 1.27))))\n')
+    f.write(f'    (property "Footprint" {quote(footprint)} (at {x:.2f} {y:.2f} 0) (effects (font (size 1.27 1.27)) hide))\n')
+    f.write(f'    (property "LCSC_Part" "C{1000 + sum(map(ord, value)) % 9000}" (at {x:.2f} {y:.2f} 0) (effects (font (size 1.27 1.27)) hide))\n')
+    f.write(f'    (pin "1" (uuid "{make_uuid(rng)}"))\n')
+    f.write(f'    (instances (project {quote(project)} (path {quote(instance_path)} (reference {quote(ref)}) (unit {unit}))))\n')
+    f.write("  )\n")
+
+def write_schematic(path: str, rng: random.Random, project: str, root_uuid: str, sheet_uuid: str | None,
+                    file_uuid: str, parts: list[tuple], sheets: list[tuple[str, str]]):
+    instance_path = f"/{root_uuid}" + (f"/{sheet_uuid}" if sheet_uuid else "")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('(kicad_sch (version 20231120) (generator "eeschema") (generator_version "8.0")\n')
+        f.write(f'  (uuid "{file_uuid}")\n  (paper "A3")\n')
+        write_lib_symbols(f)
+        for i, part in enumerate(parts):
+            x, y = 25.4 + (i % 20) * 12.7, 25.4 + (i // 20) * 12.7
+            units = 2 if part[0].startswith("U") and i % MULTI_UNIT_INTERVAL == 0 else 1
+            for unit in range(1, units + 1):
+                write_symbol(f, rng, part, unit, instance_path, project, x + (unit - 1) * 5.08, y)
+            f.write(f'  (wire (pts (xy {x:.2f} {y:.2f}) (xy {x + 5.08:.2f} {y:.2f})) (stroke (width 0) (type default)) (uuid "{make_uuid(rng)}"))\n')
+        for i, (name, uuid_) in enumerate(sheets):
+            f.write(f'  (sheet (at {300 + i * 30} 25.4) (size 25.4 20.32) (fields_autoplaced yes)\n')
+            f.write(f'    (uuid "{uuid_}")\n')
+            f.write(f'    (property "Sheetname" {quote(name)} (at 0 0 0) (effects (font (size 1.27 1.27))))\n')
+            f.write(f'    (property "Sheetfile" {quote(name + ".kicad_sch")} (at 0 0 0) (effects (font (size 1.27 1.27))))\n')
+            f.write("  )\n")
+        f.write("  (sheet_instances (path \"/\" (page \"1\")))\n)\n")
+
+def write_footprint(f, rng: random.Random, part: tuple, x: float, y: float, side: str):
+    ref, value, footprint, pads, _ = part
+    silk, fab, paste, mask = [ f"{side}.{layer}" for layer in ["SilkS", "Fab", "Paste", "Mask"] ]
+    f.write(f'  (footprint {quote(footprint)} (layer "{side}.Cu") (uuid "{make_uuid(rng)}") (at {x:.3f} {y:.3f} {rng.choice([0, 90, 180, 270])})\n')
+    f.write(f'    (property "Reference" {quote(ref)} (at 0 -1.5 0) (layer "{silk}") (uuid "{make_uuid(rng)}") (effects (font (size 1 1) (thickness 0.15))))\n')
+    f.write(f'    (property "Value" {quote(value)} (at 0 1.5 0) (layer "{fab}") (uuid "{make_uuid(rng)}") (effects (font (size 1 1) (thickness 0.15))))\n')
+    f.write(f'    (fp_line (start -1 -0.5) (end 1 -0.5) (stroke (width 0.12) (type solid)) (layer "{silk}") (uuid "{make_uuid(rng)}"))\n')
+    f.write(f'    (fp_rect (start -1 -0.5) (end 1 0.5) (stroke (width 0.1) (type solid)) (fill none) (layer "{fab}") (uuid "{make_uuid(rng)}"))\n')
+    for pad in range(pads):
+        f.write(f'    (pad "{pad + 1}" smd roundrect (at {pad * 0.5 - pads * 0.25:.2f} 0) (size 0.5 0.6) (layers "{side}.Cu" "{paste}" "{mask}") (roundrect_rratio 0.25) (net {rng.randint(1, 50)} "N{rng.randint(1, 50)}") (uuid "{make_uuid(rng)}"))\n')
+    f.write(f'    (model "${{KICAD8_3DMODEL_DIR}}/{footprint.split(":")[0]}.3dshapes/{footprint.split(":")[1]}.wrl" (offset (xyz 0 0 0)) (scale (xyz 1 1 1)) (rotate (xyz 0 0 0)))\n')
+    f.write("  )\n")
+
+def write_board(path: str, rng: random.Random, parts: list[tuple], layers: int):
+    copper = get_layers(layers)
+    side = int(max(len(parts), 1) ** 0.5 * 4) + 20
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('(kicad_pcb (version 20240108) (generator "pcbnew") (generator_version "8.0")\n')
+        f.write(f'  (general (thickness 1.6) (legacy_teardrops no))\n  (paper "A4")\n  (layers\n')
+        for i, layer in enumerate(copper):
+            f.write(f'    ({i if layer != "B.Cu" else 31} "{layer}" signal)\n')
+        for i, layer in enumerate(["B.Adhes", "F.Adhes", "B.Paste", "F.Paste", "B.SilkS", "F.SilkS", "B.Mask", "F.Mask",
+                                   "Dwgs.User", "Cmts.User", "Eco1.User", "Eco2.User", "Edge.Cuts", "Margin", "B.CrtYd", "F.CrtYd", "B.Fab", "F.Fab"]):
+            f.write(f'    ({32 + i} "{layer}" user)\n')
+        f.write("  )\n  (setup (pad_to_mask_clearance 0))\n")
+        f.write('  (net 0 "")\n')
+        for net in range(1, 51):
+            f.write(f'  (net {net} "N{net}")\n')
+
+        for i, part in enumerate(parts):
+            x, y = 10 + (i * 4) % (side - 20), 10 + (i * 4) // (side - 20) * 4
+            write_footprint(f, rng, part, x, y, "B" if i % 5 == 4 else "F")
+
+        # Tracks and vias, roughly three segments and one via per part
+        for i in range(len(parts) * 3):
+            layer = copper[i % len(copper)] if i % 4 else copper[0]
+            x, y = rng.uniform(5, side - 5), rng.uniform(5, side - 5)
+            f.write(f'  (segment (start {x:.3f} {y:.3f}) (end {x + rng.uniform(-5, 5):.3f} {y + rng.uniform(-5, 5):.3f}) (width 0.2) (layer "{layer}") (net {rng.randint(1, 50)}) (uuid "{make_uuid(rng)}"))\n')
+        for i in range(len(parts)):
+            f.write(f'  (via (at {rng.uniform(5, side - 5):.3f} {rng.uniform(5, side - 5):.3f}) (size 0.6) (drill 0.3) (layers "F.Cu" "B.Cu") (net {rng.randint(1, 50)}) (uuid "{make_uuid(rng)}"))\n')
+
+        # Ground pours on the inner layers, or both sides of a two layer board
+        for layer in (copper[1:-1] or copper):
+            f.write(f'  (zone (net 1) (net_name "N1") (layer "{layer}") (uuid "{make_uuid(rng)}") (hatch edge 0.5) (connect_pads (clearance 0.2)) (min_thickness 0.2)\n')
+            f.write(f'    (polygon (pts (xy 1 1) (xy {side - 1} 1) (xy {side - 1} {side - 1}) (xy 1 {side - 1})))\n  )\n')
+        f.write(f'  (gr_rect (start 0 0) (end {side} {side}) (stroke (width 0.1) (type default)) (fill none) (layer "Edge.Cuts") (uuid "{make_uuid(rng)}"))\n')
+        f.write(f'  (gr_text "BENCH" (at {side / 2} 5 0) (layer "F.SilkS") (uuid "{make_uuid(rng)}") (effects (font (size 1.5 1.5) (thickness 0.3))))\n')
+        f.write(")\n")
+
+def write_project(path: str, name: str = "bench", components: int = 100, layers: int = 2, seed: int = 0) -> str:
+    # Writes a project with the given number of parts, spread over as many sheets as needed.
+    # Returns the path of the .kicad_pro file. The same arguments always give the same files.
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    parts = get_parts(components)
+
+    root_uuid = make_uuid(rng)
+    chunks = [ parts[i:i + SYMBOLS_PER_SHEET] for i in range(0, len(parts), SYMBOLS_PER_SHEET) ] or [[]]
+    sheets = [ (f"sheet{i}", make_uuid(rng)) for i in range(1, len(chunks)) ]
+
+    write_schematic(os.path.join(path, name + ".kicad_sch"), rng, name, root_uuid, None, root_uuid, chunks[0], sheets)
+    for (sheet_name, sheet_uuid), chunk in zip(sheets, chunks[1:]):
+        write_schematic(os.path.join(path, sheet_name + ".kicad_sch"), rng, name, root_uuid, sheet_uuid, make_uuid(rng), chunk, [])
+    write_board(os.path.join(path, name + ".kicad_pcb"), rng, parts, layers)
+
+    input_pro = os.path.join(path, name + ".kicad_pro")
+    with open(input_pro, "w") as f:
+        json.dump({ "meta": { "filename": name + ".kicad_pro", "version": 1 }, "text_variables": {} }, f, indent=2)
+    return input_pro
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Synthetic KiCad project generator")
+    argparser.add_argument("directory", type=str, help="Directory to write the project to")
+    argparser.add_argument("--name", type=str, help="Project name", default="bench")
+    argparser.add_argument("--components", type=int, help="Number of parts", default=100)
+    argparser.add_argument("--layers", type=int, help="Number of copper layers", default=2)
+    args = argparser.parse_args()
+    print(write_project(args.directory, args.name, args.components, args.layers))
@@ -0,0 +1,128 @@
+import os, sys, json, shutil, tempfile, threading, importlib, importlib.util
+
+# A registry of the optional modules and tools used by the exports, by name.
+# Modules are imported when they are first used rather than at startup, so runs which do not need them do not pay
+# for loading PIL, numpy or pypdf. The modules of the exports themselves are loaded the same way by output.py.
+# Probes are kept on disk between runs:
+#  - Looking for a module or tool is keyed on the search path (sys.path or PATH) and the modification times of
+#    its directories, so it is looked for again when something is installed or removed.
+#  - Probes which start a process, such as asking kicad-cli for its version, are keyed on the path, size and
+#    modification time of the tool, so they are run again when it is updated, or a change to PATH finds a different one.
+
+class LazyModule():
+    # Stands in for a module, which is imported when one of its attributes is first used
+    def __init__(self, name: str):
+        self._name = name
+
+    def __repr__(self):
+        return f"<lazy module {self._name}>"
+
+    def __getattr__(self, attr: str):
+        # import_module is thread safe, and just returns the module once it is loaded
+        return getattr(importlib.import_module(self._name), attr)
+
+class Backend():
+    # An optional module or tool
+    def __init__(self, name: str, module: str = None, tool: str = None):
+        self.name = name
+        self.module = module
+        self.tool = tool
+
+    def __repr__(self):
+        return f"<backend {self.name}>"
+
+    def is_available(self) -> bool:
+        if self.tool is not None:
+            dirs = os.environ.get("PATH", "").split(os.pathsep)
+            return lookup(self.name, dirs, lambda: shutil.which(self.tool) is not None)
+        return lookup(self.name, sys.path, lambda: importlib.util.find_spec(self.module) is not None)
+
+_backends: dict[str, Backend] = {}
+
+def register(name: str, module: str = None, tool: str = None) -> Backend:
+    _backends[name] = Backend(name, module, tool)
+    return _backends[name]
+
+def get(name: str) -> Backend:
+    return _backends[name]
+
+def is_available(name: str) -> bool:
+    return _backends[name].is_available()
+
+register("pil", module="PIL")
+register("numpy", module="numpy")
+register("pypdf", module="pypdf")
+register("pdfunite", tool="pdfunite")
+register("ffmpeg", tool="ffmpeg")
+register("git", tool="git")
+
+
+_probes = {}
+_probes_lock = threading.Lock()
+_probe_file = None
+_search_idents = {}
+
+def set_probe_file(path: str):
+    # Keeps the probe results in this file between runs
+    global _probe_file
+    _probe_file = path
+    try:
+        with open(path, "r") as f:
+            probes = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return
+    with _probes_lock:
+        _probes.update(probes)
+
+def get_tool_ident(tool: str) -> list | None:
+    path = shutil.which(tool)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+def get_search_ident(dirs: list[str]) -> list:
+    # The directories searched, and when each was last changed. Installing or removing anything in them
+    # changes the time. This is kept for the life of the process.
+    key = tuple(dirs)
+    if key not in _search_idents:
+        times = []
+        for path in dirs:
+            try:
+                times.append(os.stat(path or ".").st_mtime_ns)
+            except OSError:
+                times.append(None)
+        _search_idents[key] = [list(dirs), times]
+    return _search_idents[key]
+
+def probe(name: str, tool: str, fn: callable):
+    # Returns the result of fn, which probes the tool. The result is kept until the tool changes, and must be
+    # json serialisable. Exceptions are not kept, so a failed probe is retried on the next run.
+    return get_probe(f"{name}:{tool}", get_tool_ident(tool), fn)
+
+def lookup(name: str, dirs: list[str], fn: callable):
+    # Returns the result of fn, which looks for something in the given directories.
+    # The result is kept until the directories change.
+    return get_probe(f"lookup:{name}", get_search_ident(dirs), fn)
+
+def get_probe(key: str, ident: list | None, fn: callable):
+    with _probes_lock:
+        entry = _probes.get(key)
+    if entry is not None and entry["ident"] == ident:
+        return entry["result"]
+
+    result = fn()
+    with _probes_lock:
+        _probes[key] = { "ident": ident, "result": result }
+        if _probe_file is not None:
+            write_probes(_probe_file)
+    return result
+
+def write_probes(path: str):
+    # Written to a temporary file first, as other runs may be reading it
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(_probes, f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,111 @@
+import os, glob, json, argparse
+import pipeline, tracing
+
+# Generates the outputs of many projects in one run, ie every board in a repository.
+# Projects are given as glob patterns, or listed in a manifest which may also set options for each project:
+# {
+#     "projects": [
+#         { "input": "power/*.kicad_pro", "layers": 4 },
+#         { "input": "sensor/sensor.kicad_pro", "name": "sensor-v2", "variants": "sensor/variants.json" }
+#     ]
+# }
+# Options are named as on the command line. Paths are relative to the manifest.
+
+# Options that are shared by the whole batch, and so cannot be set for each project
+BATCH_OPTIONS = { "output", "jobs", "max_commands", "jobset", "no_cache", "cache_dir", "cache_size", "render_cache_size",
+                  "page_cache_size", "report_cache_size", "trace", "watch", "manifest", "wait_on_done", "stages" }
+PATH_OPTIONS = ["input", "variants", "baseline"]
+
+class Project():
+    def __init__(self, input_file: str, name: str, args: argparse.Namespace):
+        # The input file is the project path without its extension
+        self.input_file = input_file
+        self.name = name
+        self.args = args
+        self.output_dir = None
+
+    def __repr__(self):
+        return f"<project {self.name}>"
+
+def find_files(pattern: str) -> list[str]:
+    files = sorted(glob.glob(pattern))
+    if len(files) == 0:
+        raise FileNotFoundError(f"No files match \"{pattern}\"")
+    return [ os.path.splitext(path)[0] for path in files ]
+
+def make_projects(entries: list[tuple[str, argparse.Namespace]]) -> list[Project]:
+    # Each project gets an output directory named after it, so the names must be unique
+    projects = []
+    names = set()
+    for input_file, args in entries:
+        name = args.name or os.path.basename(input_file)
+        if name in names:
+            raise ValueError(f"Multiple projects are named \"{name}\". Give them names in a manifest.")
+        names.add(name)
+        projects.append(Project(input_file, name, args))
+    return projects
+
+def find_projects(patterns: list[str], args: argparse.Namespace) -> list[Project]:
+    files = [ path for pattern in patterns for path in find_files(pattern) ]
+    if args.name and len(files) > 1:
+        raise ValueError(f"--name can only be used with one project, but {len(files)} were found. Name the projects of a batch in a manifest.")
+    return make_projects([ (path, args) for path in files ])
+
+def load_manifest(path: str, args: argparse.Namespace) -> list[Project]:
+    with open(path, "r") as f:
+        config = json.load(f)
+
+    base = os.path.dirname(path)
+    entries = []
+    for i, definition in enumerate(config.get("projects", [])):
+        options = { key.lstrip("-").replace("-", "_"): value for key, value in definition.items() }
+        if "input" not in options:
+            raise ValueError(f"Project {i + 1} of the manifest has no input")
+        unknown = (set(options) - set(vars(args))) | (set(options) & BATCH_OPTIONS)
+        if unknown:
+            raise ValueError(f"Options cannot be set for project {i + 1} of the manifest: {', '.join(sorted(unknown))}")
+        for key in PATH_OPTIONS:
+            if options.get(key):
+                options[key] = os.path.join(base, options[key])
+        project_args = argparse.Namespace(**dict(vars(args), **options))
+        entries += [ (input_file, project_args) for input_file in find_files(options["input"]) ]
+    return make_projects(entries)
+
+
+def get_results(projects: list[Project], stages: pipeline.Pipeline) -> list[dict]:
+    # The outcome of each project, from the combined pipeline and the stage spans
+    spans = tracing.get_spans("stage")
+    results = []
+    for project in projects:
+        prefix = project.name + "/"
+        project_spans = [ s for s in spans if s.name.startswith(prefix) ]
+        error = stages.failures.get(project.name)
+        results.append({
+            "name": project.name,
+            "input": project.input_file + ".kicad_pro",
+            "output": project.output_dir,
+            "status": "failed" if error is not None else "done",
+            "error": (str(error) or type(error).__name__) if error is not None else None,
+            "stages": sum(1 for s in stages.stages.values() if s.group == project.name),
+            "completed": sum(1 for name in stages.completed if name.startswith(prefix)),
+            "time": max(s.end for s in project_spans) - min(s.start for s in project_spans) if project_spans else 0.0,
+            "output_size": tracing.get_output_size(project.output_dir),
+        })
+    return results
+
+def print_summary(results: list[dict]):
+    rows = [ [
+        r["name"],
+        r["status"],
+        f"{r['completed']}/{r['stages']}",
+        tracing.format_time(r["time"]),
+        tracing.format_size(r["output_size"]),
+    ] for r in results ]
+    tracing.print_table(["Project", "Status", "Stages", "Time", "Output"], rows)
+    for r in results:
+        if r["error"]:
+            print(f"{r['name']}: {r['error']}")
+
+def write_summary(path: str, results: list[dict]):
+    with open(path, "w") as f:
+        json.dump({ "projects": results }, f, indent=2)
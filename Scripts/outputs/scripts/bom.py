@@ -1,83 +1,183 @@
-import os
-from xml.sax import parse as parse_xml
-from xml.sax.handler import ContentHandler
+import os, re
+from typing import Iterable, Iterator
+from xml.parsers import expat
 
 #"Id";"Designator";"Footprint";"Quantity";"Designation";"Supplier and ref";
 
 class Component():
-    def __init__(self, ref = "", value = "", footprint = "", quantity = 1, fields = None):
+    # Boards may have tens of thousands of components, so these are kept compact
+    __slots__ = ("ref", "value", "footprint", "quantity", "fitted", "fields")
+
+    def __init__(self, ref = "", value = "", footprint = "", quantity = 1, fields = None, fitted = True):
         self.ref = ref
         self.value = value
         self.footprint = footprint
         self.quantity = quantity
-        self.fitted = True
+        self.fitted = fitted
         self.fields = fields or {}
 
     def __repr__(self):
         return f"<component {self.ref}; {self.value}; {self.footprint}; {self.quantity}>"
 
-class BomInfo(ContentHandler):
+class BomReader():
+    # Reads components from a python-bom export with expat.
+    # Text may be delivered in several chunks (ie, around entities or buffer boundaries), so it is
+    # collected until the element ends.
 
     def __init__(self):
-        self._element = None
         self._component = None
         self._field = None
+        self._text = []
         self.components = []
-    
-    def startElement(self, name: str, attr: dict[str, str]):
-        self._element = name
+
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self.start_element
+        self._parser.EndElementHandler = self.end_element
+        self._parser.CharacterDataHandler = self._text.append
+
+    def start_element(self, name: str, attr: dict[str, str]):
+        self._text.clear()
         if name == "comp":
             self._component = Component(attr["ref"])
-            self.components.append(self._component)
-        elif name == "property" and self._component:
-            if attr["name"] == "dnp":
-                self._component.fitted = False
-        elif name == "field":
-            self._field = attr["name"]
-
-    def endElement(self, name: str):
-        if name == "comp":
-            self._component = None
-        self._element = None
-    
-    def characters(self, content: str):
-        if self._component:
-            if self._element == "value":
-                self._component.value = content
-            elif self._element == "footprint":
-                if ':' in content:
-                    lib, content = content.split(':', maxsplit=1)
-                self._component.footprint = content
-            elif self._element == "field":
-                self._component.fields[self._field] = content
-
-    def get_components(self) -> list[Component]:
-        return self.components
-
-def group_components(components: list[Component]) -> list[Component]:
-    groups = {}
+        elif self._component:
+            if name == "property":
+                if attr.get("name") == "dnp":
+                    self._component.fitted = False
+            elif name == "field":
+                self._field = attr["name"]
+
+    def end_element(self, name: str):
+        component = self._component
+        if component:
+            if name == "comp":
+                self.components.append(component)
+                self._component = None
+            elif name == "value":
+                component.value = "".join(self._text)
+            elif name == "footprint":
+                footprint = "".join(self._text)
+                if ':' in footprint:
+                    lib, footprint = footprint.split(':', maxsplit=1)
+                component.footprint = footprint
+            elif name == "field":
+                text = "".join(self._text)
+                if text:
+                    component.fields[self._field] = text
+        self._text.clear()
+
+    def feed(self, data: bytes, final: bool = False) -> list[Component]:
+        # Returns the components completed by this data
+        self._parser.Parse(data, final)
+        components = self.components
+        self.components = []
+        return components
+
+READ_SIZE = 1 << 16
+
+def iter_components(input_xml: str) -> Iterator[Component]:
+    # Streams the components from a python-bom export, without holding the document in memory.
+    reader = BomReader()
+    with open(input_xml, "rb") as f:
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            yield from reader.feed(data)
+    yield from reader.feed(b"", True)
+
+# Components may be grouped by "value", "footprint", or the name of any field (ie, "MPN")
+DEFAULT_GROUP_KEYS = ["footprint", "value"]
+COMPONENT_KEYS = { "value", "footprint" }
+
+NATURAL_RE = re.compile(r'(\d+)')
+REF_RE = re.compile(r'^(.*?)(\d+)$')
+
+def natural_key(ref: str) -> tuple:
+    # Orders references by their numbers, so R2 comes before R10
+    parts = NATURAL_RE.split(ref)
+    parts[1::2] = map(int, parts[1::2])
+    return tuple(parts)
+
+def compress_refs(refs: list[str]) -> list[str]:
+    # Collapses runs of three or more consecutive references into a range, ie R1,R2,R3 into R1-R3.
+    # The references must already be in natural order.
+    result = []
+    run = []
+    last = None
+    for ref in refs:
+        match = REF_RE.match(ref)
+        current = (match.group(1), int(match.group(2))) if match else None
+        if not (current and last and current[0] == last[0] and current[1] == last[1] + 1):
+            result += [f"{run[0]}-{run[-1]}"] if len(run) >= 3 else run
+            run = []
+        run.append(ref)
+        last = current
+    result += [f"{run[0]}-{run[-1]}"] if len(run) >= 3 else run
+    return result
+
+class GroupIndex():
+    # Groups components as they are added. Each component is a constant amount of work,
+    # so grouping stays linear in the number of components.
+    # The first value of each field is kept, and fields missing from the first part are taken from later ones.
+    # Differing values of the checked fields are recorded as conflicts. A missing field counts as an empty value,
+    # so a part which lacks a field the others have is a conflict too.
+
+    def __init__(self, keys: list[str] = DEFAULT_GROUP_KEYS, check_fields: list[str] = []):
+        self.keys = keys
+        self.check_fields = set(check_fields) - set(keys)
+        self.groups = {}
+        self.refs = {}
+        # The checked fields of the first part of each group
+        self.checked = {}
+        self.conflicts = {}
+
+    def get_key(self, component: Component) -> tuple:
+        return tuple(getattr(component, key) if key in COMPONENT_KEYS else component.fields.get(key, "") for key in self.keys)
+
+    def add(self, component: Component):
+        key = self.get_key(component)
+        group = self.groups.get(key)
+        if group is None:
+            group = Component("", component.value, component.footprint, 0, dict(component.fields))
+            self.groups[key] = group
+            self.refs[key] = [component.ref]
+            self.checked[key] = { name: component.fields.get(name, "") for name in self.check_fields }
+            group.quantity = component.quantity
+            return
+
+        self.refs[key].append(component.ref)
+        group.quantity += component.quantity
+        for name, value in component.fields.items():
+            group.fields.setdefault(name, value)
+        for name, existing in self.checked[key].items():
+            value = component.fields.get(name, "")
+            if existing != value:
+                values = self.conflicts.setdefault((key, name), { existing: self.refs[key][0] })
+                values.setdefault(value, component.ref)
+
+    def get_components(self, compress: bool = False) -> list[Component]:
+        groups = []
+        for key, group in self.groups.items():
+            refs = sorted(self.refs[key], key=natural_key)
+            group.ref = ",".join(compress_refs(refs) if compress else refs)
+            groups.append(group)
+        return groups
+
+    def get_conflicts(self) -> list[str]:
+        return [
+            f"{name} differs between parts grouped as {' '.join(key)}: " + ", ".join(f"\"{value}\" ({ref})" for value, ref in values.items())
+            for (key, name), values in self.conflicts.items()
+        ]
+
+def group_components(components: Iterable[Component], keys: list[str] = DEFAULT_GROUP_KEYS, compress: bool = False) -> list[Component]:
+    index = GroupIndex(keys)
     for component in components:
-        key = f"{component.footprint}:{component.value}"
-        if key not in groups:
-            groups[key] = {
-                "footprint": component.footprint,
-                "refs": [],
-                "value": component.value,
-                "quantity": 0,
-                "fields": {}
-            }
-        groups[key]["refs"].append(component.ref)
-        groups[key]["quantity"] += component.quantity
-        groups[key]["fields"].update(component.fields)
-    return [
-        Component(",".join(g["refs"]), g["value"], g["footprint"], g["quantity"], g["fields"]) for g in groups.values()
-    ]
+        index.add(component)
+    return index.get_components(compress)
 
 def select_fitted(components: list[Component], fitted: bool = True) -> list[Component]:
     return [ c for c in components if c.fitted == fitted ]
 
 def sort_components(components: list[Component]) -> list[Component]:
-    return sorted(components, key=lambda x: x.ref )
+    return sorted(components, key=lambda x: natural_key(x.ref))
 
 def write_csv(filename: str, components: list[Component], fields: list[str] = []):
     with open(filename, "w") as f:
@@ -98,15 +198,47 @@ def write_csv(filename: str, components: list[Component], fields: list[str] = []
             write_line([ i+1, c.value, c.ref, c.quantity, c.footprint ] + [ c.fields.get(f, None) for f in fields ])
 
 def load_components(input_xml: str) -> list[Component]:
-    info = BomInfo()
-    parse_xml(input_xml, info)
-    return info.get_components()
-
-def create_bom(components: list[Component], output_csv: str, fields: list[str] = []):
-    components = select_fitted(components, True)
-    components = group_components(components)
-    components = sort_components(components)
-    write_csv(output_csv, components, fields)
+    return list(iter_components(input_xml))
+
+def create_bom(components: Iterable[Component], output_csv: str, fields: list[str] = [], keys: list[str] = DEFAULT_GROUP_KEYS, compress: bool = False) -> list[str]:
+    # Fitted components are grouped as they are read, without building an intermediate list.
+    # Returns a description of any conflicting fields within the groups.
+    index = GroupIndex(keys, fields)
+    for component in components:
+        if component.fitted:
+            index.add(component)
+    write_csv(output_csv, sort_components(index.get_components(compress)), fields)
+    return index.get_conflicts()
+
+def compare_components(expected: list[Component], actual: list[Component], fields: list[str] = []) -> list[str]:
+    # Returns a description of each difference between two component lists
+    # Unannotated parts share a reference (ie, R?), so the components are compared in order within each reference.
+    differences = []
+    def by_ref(components: list[Component]) -> dict[str, list[Component]]:
+        refs = {}
+        for c in components:
+            refs.setdefault(c.ref, []).append(c)
+        for group in refs.values():
+            group.sort(key=lambda c: (c.value, c.footprint, c.fitted, sorted(c.fields.items())))
+        return refs
+    expected = by_ref(expected)
+    actual = by_ref(actual)
+    for ref in sorted(expected.keys() | actual.keys(), key=natural_key):
+        a_list, b_list = expected.get(ref, []), actual.get(ref, [])
+        if not a_list or not b_list:
+            differences.append(f"{ref} is {'missing' if not b_list else 'unexpected'}")
+            continue
+        if len(a_list) != len(b_list):
+            differences.append(f"{ref} appears {len(b_list)} times, expected {len(a_list)}")
+            continue
+        for a, b in zip(a_list, b_list):
+            for name in ["value", "footprint", "fitted"]:
+                if getattr(a, name) != getattr(b, name):
+                    differences.append(f"{ref} {name} is \"{getattr(b, name)}\", expected \"{getattr(a, name)}\"")
+            for name in fields:
+                if a.fields.get(name) != b.fields.get(name):
+                    differences.append(f"{ref} {name} is \"{b.fields.get(name)}\", expected \"{a.fields.get(name)}\"")
+    return differences
 
 def get_dnf_list(components: list[Component]) -> list[str]:
     components = select_fitted(components, False)
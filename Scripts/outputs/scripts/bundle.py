@@ -1,41 +1,181 @@
-import os
-import subprocess
-
-
-def zip_files(input_path: str, output_file: str, files: list[str]):
-    subprocess.check_call([
-            "zip",
-            "-rq",
-            os.path.abspath(output_file),
-        ] + files,
-        cwd=input_path
-    )
-
-def tar_files(input_path: str, output_file: str, files: list[str]):
-    subprocess.check_call([
-            "tar",
-            "-C", input_path,
-            "-acf", output_file,
-        ] + files
-    )
-
-BUNDLERS = {
-    ".zip": zip_files,
-    ".tar.gz": tar_files,
-}
+import os, time, zlib, struct, tarfile, collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Archives are written in-process. Each member is compressed once on a pool of workers, and then
+# written to every archive that includes it, so the full bundle and a release pack share the work.
+# Members are written in sorted order with fixed timestamps and permissions, so identical inputs give
+# byte-identical archives. The timestamp may be set with SOURCE_DATE_EPOCH.
+
+# Files which are already compressed are stored rather than deflated
+COMPRESSED_EXTNS = { ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".webm", ".zip", ".gz", ".stpz", ".pdf" }
+
+# Members which deflate to more than this fraction of their size are stored instead
+STORE_RATIO = 0.95
+
+COMPRESSION_LEVEL = 6
+ZIP_EPOCH = 315532800 # 1980-01-01, the earliest time a zip file can hold
+
+Member = collections.namedtuple("Member", ["name", "path", "is_dir"])
+
+
+def get_timestamp() -> int:
+    return max(int(os.environ.get("SOURCE_DATE_EPOCH", ZIP_EPOCH)), ZIP_EPOCH)
+
+def list_members(input_path: str, files: list[str]) -> list[Member]:
+    # Returns the files and directories under the given paths, relative to the input path
+    members = []
+    for name in files:
+        path = os.path.join(input_path, name)
+        if not os.path.isdir(path):
+            members.append(Member(name, path, False))
+            continue
+        for root, dirs, filenames in os.walk(path):
+            rel = os.path.relpath(root, input_path).replace(os.sep, "/")
+            members.append(Member(rel + "/", root, True))
+            members += [ Member(f"{rel}/{f}", os.path.join(root, f), False) for f in filenames ]
+    return members
+
+def is_compressed(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTNS
+
+def read_member(member: Member) -> bytes:
+    if member.is_dir:
+        return b""
+    with open(member.path, "rb") as f:
+        return f.read()
+
+def iter_parallel(fn: callable, items: list, jobs: int):
+    # Yields fn(item) for each item in order. Only a few items are worked on ahead of the one being
+    # yielded, so large files are not all held in memory at once.
+    jobs = max(jobs, 1)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_dos_time(timestamp: int) -> tuple[int, int]:
+    t = time.gmtime(timestamp)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
 
-SUPPORTED_FORMATS = [ extn[1:] for extn in BUNDLERS.keys() ]
+def compress_zip_member(member: Member) -> tuple[Member, int, int, int, bytes]:
+    # Returns the member, compression method, crc, uncompressed size and the data to write
+    data = read_member(member)
+    crc = zlib.crc32(data)
+    if data and not is_compressed(member.name):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data) * STORE_RATIO:
+            return member, 8, crc, len(data), deflated
+    return member, 0, crc, len(data), data
 
+class ZipWriter():
+    # Writes a zip file from members which are already compressed.
+    # Zip64 is not supported, as outputs are nowhere near 4GB.
 
-def bundle(input_path: str, output_file: str, files: list[str] = None):
-    _, extn = os.path.splitext(output_file)
+    def __init__(self, output_file: str, timestamp: int):
+        self.f = open(output_file, "wb")
+        self.time, self.date = get_dos_time(timestamp)
+        self.entries = []
 
-    if files is None:
-        files = os.listdir(input_path)
+    def write(self, member: Member, method: int, crc: int, size: int, data: bytes):
+        name = member.name.encode("utf-8")
+        offset = self.f.tell()
+        if offset + len(data) >= 0xFFFFFFFF:
+            raise ValueError(f"Zip file is too large at \"{member.name}\"")
+        # Bit 11 marks the name as utf-8
+        self.f.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, 0x800, method, self.time, self.date,
+                                 crc, len(data), size, len(name), 0) + name)
+        self.f.write(data)
+        mode = (0o40755 << 16) | 0x10 if member.is_dir else 0o100644 << 16
+        self.entries.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | 20, 20, 0x800, method, self.time, self.date,
+                                        crc, len(data), size, len(name), 0, 0, 0, 0, mode, offset) + name)
 
-    for extn in BUNDLERS.keys():
+    def close(self):
+        offset = self.f.tell()
+        for entry in self.entries:
+            self.f.write(entry)
+        self.f.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                 self.f.tell() - offset, offset, 0))
+        self.f.close()
+
+def write_zips(outputs: list[tuple[str, set[str]]], members: list[Member], timestamp: int, jobs: int):
+    writers = [ (ZipWriter(output_file, timestamp), names) for output_file, names in outputs ]
+    for compressed in iter_parallel(compress_zip_member, members, jobs):
+        for writer, names in writers:
+            if compressed[0].name in names:
+                writer.write(*compressed)
+    for writer, _ in writers:
+        writer.close()
+
+
+def compress_tar_member(member: Member, timestamp: int) -> tuple[Member, bytes]:
+    # Each member is compressed as its own gzip stream. Concatenated gzip streams are a valid gzip file.
+    data = read_member(member)
+    info = tarfile.TarInfo(member.name.rstrip("/"))
+    info.mtime = timestamp
+    if member.is_dir:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.size = len(data)
+        info.mode = 0o644
+    block = info.tobuf(tarfile.PAX_FORMAT) + data + b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+    level = 0 if is_compressed(member.name) else COMPRESSION_LEVEL
+    return member, gzip_compress(block, level)
+
+def gzip_compress(data: bytes, level: int) -> bytes:
+    # Equivalent to gzip.compress, but with no timestamp or filename in the header
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def write_tars(outputs: list[tuple[str, set[str]]], members: list[Member], timestamp: int, jobs: int):
+    files = [ (open(output_file, "wb"), names) for output_file, names in outputs ]
+    for member, data in iter_parallel(lambda m: compress_tar_member(m, timestamp), members, jobs):
+        for f, names in files:
+            if member.name in names:
+                f.write(data)
+    for f, _ in files:
+        # Two empty blocks end the archive
+        f.write(gzip_compress(b"\0" * (tarfile.BLOCKSIZE * 2), COMPRESSION_LEVEL))
+        f.close()
+
+
+WRITERS = {
+    ".zip": write_zips,
+    ".tar.gz": write_tars,
+}
+
+SUPPORTED_FORMATS = [ extn[1:] for extn in WRITERS.keys() ]
+
+def get_format(output_file: str) -> str:
+    for extn in WRITERS.keys():
         if output_file.endswith(extn):
-            BUNDLERS[extn](input_path, output_file, files)
-            return
-    raise Exception(f"Unknown compression format: \"{extn}\"")
-    
+            return extn
+    raise Exception(f"Unknown compression format: \"{os.path.basename(output_file)}\"")
+
+def bundle_all(input_path: str, bundles: list[tuple[str, list[str] | None]], jobs: int = 1):
+    # Writes several archives of the input path in one pass. Each bundle is an output file and the
+    # files and directories it includes, or None to include everything (except the bundles themselves).
+    output_files = { os.path.abspath(output_file) for output_file, _ in bundles }
+    everything = sorted(name for name in os.listdir(input_path) if os.path.abspath(os.path.join(input_path, name)) not in output_files)
+
+    timestamp = get_timestamp()
+    for extn, writer in WRITERS.items():
+        selected = [ (output_file, files) for output_file, files in bundles if get_format(output_file) == extn ]
+        if not selected:
+            continue
+        members = {}
+        outputs = []
+        for output_file, files in selected:
+            listed = list_members(input_path, sorted(files) if files is not None else everything)
+            members.update((m.name, m) for m in listed)
+            outputs.append((output_file, { m.name for m in listed }))
+        writer(outputs, sorted(members.values(), key=lambda m: m.name), timestamp, jobs)
+
+def bundle(input_path: str, output_file: str, files: list[str] = None, jobs: int = 1):
+    bundle_all(input_path, [(output_file, files)], jobs)
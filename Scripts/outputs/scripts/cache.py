@@ -0,0 +1,203 @@
+import os, shutil, json, hashlib, tempfile, threading, contextlib
+
+ENTRY_FILE = "entry.json"
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+def hash_file(path: str) -> str:
+    # Hashes are remembered for the life of the process, as many stages share the same inputs.
+    stat = os.stat(path)
+    ident = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        if ident in _file_hashes:
+            return _file_hashes[ident]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    with _file_hashes_lock:
+        _file_hashes[ident] = digest.hexdigest()
+    return _file_hashes[ident]
+
+def hash_inputs(paths: list[str]) -> list[str | None]:
+    # The hashes of the inputs of a cache key. Missing inputs hash to None, so that an optional input such as the
+    # project file is part of the key whether or not it exists.
+    return [ hash_file(path) if os.path.exists(path) else None for path in paths ]
+
+def get_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(get_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def copy_path(src: str, dst: str):
+    parent = os.path.dirname(dst)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst)
+
+
+class OutputCache():
+    # A persistent store of stage outputs.
+    # Each entry is a directory named by the key, holding a copy of each output and an entry file.
+    # Entries are touched when restored, so eviction can remove the least recently used first.
+
+    def __init__(self, path: str, max_size: int, version: list[str]):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        os.makedirs(path, exist_ok=True)
+
+    def make_key(self, inputs: list[str], args: list) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": self.version,
+            "inputs": hash_inputs(inputs),
+            "args": args,
+        }).encode())
+        return digest.hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.path, key, ENTRY_FILE))
+
+    def restore(self, key: str, outputs: list[str]) -> dict | None:
+        entry_dir = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entry_dir, ENTRY_FILE), "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if len(entry["outputs"]) != len(outputs):
+            return None
+
+        for i, path in enumerate(outputs):
+            copy_path(os.path.join(entry_dir, str(i)), path)
+
+        os.utime(os.path.join(entry_dir, ENTRY_FILE))
+        return entry
+
+    def store(self, key: str, outputs: list[str], result = None):
+        # Stages that skipped some of their outputs (ie, due to a missing backend) are not stored.
+        if not all(os.path.exists(path) for path in outputs):
+            return
+
+        entry_dir = os.path.join(self.path, key)
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+        try:
+            for i, path in enumerate(outputs):
+                copy_path(path, os.path.join(tmp_dir, str(i)))
+            with open(os.path.join(tmp_dir, ENTRY_FILE), "w") as f:
+                json.dump({
+                    "outputs": outputs,
+                    "result": result,
+                    "size": get_size(tmp_dir),
+                }, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another run may have stored the same entry in the meantime.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits within max_size
+        entries = []
+        for name in os.listdir(self.path):
+            entry_file = os.path.join(self.path, name, ENTRY_FILE)
+            try:
+                with open(entry_file, "r") as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.getmtime(entry_file), size, name))
+            except (OSError, json.JSONDecodeError, KeyError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            total -= size
+
+
+class FileCache():
+    # A persistent store of single files, named by their key.
+    # Files are touched when restored, so eviction can remove the least recently used first.
+
+    def __init__(self, path: str, max_size: int, version: list[str], extn: str):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self.extn = extn
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + self.extn)
+
+    def restore(self, key: str, output_file: str) -> bool:
+        path = self._entry_path(key)
+        try:
+            shutil.copyfile(path, output_file)
+        except FileNotFoundError:
+            return False
+        os.utime(path)
+        return True
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self._entry_path(key))
+
+    def store(self, key: str, output_file: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        os.close(fd)
+        shutil.copyfile(output_file, tmp_path)
+        os.replace(tmp_path, self._entry_path(key))
+
+    def evict(self):
+        # Remove the least recently used files until the cache fits within max_size
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.extn):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+
+def strip_output(args: list[str]) -> list[str]:
+    args = list(args)
+    if "--output" in args:
+        i = args.index("--output")
+        del args[i:i + 2]
+    return args
+
+
+class RenderCache(FileCache):
+    # A persistent store of individual renders, so that frames are reused across runs
+    # and when only the animation format or timing has changed.
+    # Renders are keyed on the board contents and the render arguments (excluding the output path).
+
+    def __init__(self, path: str, max_size: int, version: list[str]):
+        super().__init__(path, max_size, version, ".png")
+
+    def make_key(self, input_file: str, args: list[str]) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": self.version,
+            "input": hash_file(input_file),
+            "args": strip_output(args),
+        }).encode())
+        return digest.hexdigest()
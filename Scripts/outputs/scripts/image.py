@@ -1,5 +1,14 @@
-from PIL import Image
-import subprocess, os, shutil
+from __future__ import annotations
+import subprocess, os, struct
+import backends
+
+# PIL and numpy are imported on first use, so runs without renders or animations do not load them
+Image = backends.LazyModule("PIL.Image")
+GifImagePlugin = backends.LazyModule("PIL.GifImagePlugin")
+numpy = backends.LazyModule("numpy")
+
+def get_bbox_backend() -> str:
+    return "numpy" if backends.is_available("numpy") else "pil"
 
 IMAGE_BACKENDS = {
     ".gif": "pil",
@@ -10,6 +19,9 @@ IMAGE_BACKENDS = {
 
 ANIMATION_FORMATS = [k[1:] for k in IMAGE_BACKENDS.keys()]
 
+# Palette index used for transparent pixels in GIF frames
+GIF_TRANSPARENT = 255
+
 def get_extn(path: str):
     return os.path.splitext(path)[1]
 
@@ -19,89 +31,309 @@ def get_backend(format: str):
         return None
     backend = IMAGE_BACKENDS[format]
     if backend == "ffmpeg":
-        if not shutil.which("ffmpeg"):
+        if not backends.is_available("ffmpeg"):
             return None
     return backend
 
-def crop_image(src: str, dst: str):
+def get_alpha(img: Image.Image|str) -> Image.Image:
+    # Images may be PIL image or path.
+    if type(img) is str:
+        img = Image.open(img)
+    # kicad-cli renders are already RGBA, so only convert other modes.
+    if img.mode == "RGBA" or img.mode == "LA":
+        return img.getchannel("A")
+    return img.convert("RGBA").getchannel("A")
+
+def get_alpha_bbox_pil(img: Image.Image|str, threshold: int = 0) -> tuple[int, int, int, int] | None:
+    alpha = get_alpha(img)
+    if threshold > 0:
+        alpha = alpha.point([0] * (threshold + 1) + [255] * (255 - threshold))
+    return alpha.getbbox()
+
+def get_mask_bbox(mask: "numpy.ndarray") -> tuple[int, int, int, int] | None:
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return None
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+def get_alpha_bbox_numpy(img: Image.Image|str, threshold: int = 0) -> tuple[int, int, int, int] | None:
+    return get_mask_bbox(numpy.asarray(get_alpha(img)) > threshold)
+
+def find_bounding_box_pil(images: list[Image.Image|str], threshold: int = 0) -> tuple[int, int, int, int] | None:
+    union_bbox = None
+    for img in images:
+        union_bbox = merge_bbox(union_bbox, get_alpha_bbox_pil(img, threshold))
+    return union_bbox
+
+def find_bounding_box_numpy(images: list[Image.Image|str], threshold: int = 0) -> tuple[int, int, int, int] | None:
+    # Take the maximum alpha over the whole stack, so the bounds only need to be found once.
+    union_alpha = None
+    for img in images:
+        alpha = numpy.asarray(get_alpha(img))
+        if union_alpha is None:
+            union_alpha = alpha.copy()
+        else:
+            numpy.maximum(union_alpha, alpha, out=union_alpha)
+    if union_alpha is None:
+        return None
+    return get_mask_bbox(union_alpha > threshold)
+
+def get_alpha_bbox(img: Image.Image|str, threshold: int = 0) -> tuple[int, int, int, int] | None:
+    # Pixels with alpha at or below the threshold are treated as transparent, which can be used to ignore anti-aliasing haze.
+    if get_bbox_backend() == "numpy":
+        return get_alpha_bbox_numpy(img, threshold)
+    return get_alpha_bbox_pil(img, threshold)
+
+def merge_bbox(a: tuple[int, int, int, int] | None, b: tuple[int, int, int, int] | None) -> tuple[int, int, int, int] | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (
+        min(a[0], b[0]),
+        min(a[1], b[1]),
+        max(a[2], b[2]),
+        max(a[3], b[3]),
+    )
+
+def find_bounding_box(images: list[Image.Image|str], threshold: int = 0):
+    # Work out the worst case bounding box
+    if get_bbox_backend() == "numpy":
+        union_bbox = find_bounding_box_numpy(images, threshold)
+    else:
+        union_bbox = find_bounding_box_pil(images, threshold)
+    
+    if not union_bbox:
+        raise Exception("All frames are fully transparent!")
+    return union_bbox
+
+def crop_image(src: str, dst: str, threshold: int = 0):
     img = Image.open(src)
     
     if img.mode != "RGBA":
         img = img.convert("RGBA")
 
-    alpha = img.getchannel("A")
-    bbox = alpha.getbbox()
+    bbox = get_alpha_bbox(img, threshold)
 
     if not bbox:
         raise Exception("Frame is fully transparent!")
     
     img.crop(bbox).save(dst)
 
-def find_bounding_box(images: list[Image.Image|str] ):
-    # Work out the worst case bounding box
-    union_bbox = None
-    for img in images:
+def load_frame(src: str, bbox: list[int]) -> Image.Image:
+    img = Image.open(src)
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    return img.crop(bbox)
 
-        # Images may be PIL image or path.
-        if type(img) is str:
-            img = Image.open(img).convert("RGBA")
-
-        alpha = img.getchannel("A")
-        bbox = alpha.getbbox()
-        if bbox:
-            if union_bbox is None:
-                union_bbox = bbox
-            else:
-                union_bbox = (
-                    min(union_bbox[0], bbox[0]),
-                    min(union_bbox[1], bbox[1]),
-                    max(union_bbox[2], bbox[2]),
-                    max(union_bbox[3], bbox[3]),
-                )
-    
-    if not union_bbox:
-        raise Exception("All frames are fully transparent!")
-    return union_bbox
+class FrameSequence():
+    # A lazily loaded sequence of frames, which PIL can save as a multi-frame image.
+    # PIL seeks through multi-frame images one frame at a time, so only the current frame is held in memory.
+
+    def __init__(self, sources: list[str], bbox: list[int]):
+        self.sources = sources
+        self.bbox = bbox
+        self.n_frames = len(sources)
+        self._index = None
+        self._frame = None
+
+    def seek(self, index: int):
+        if index != self._index:
+            self._frame = load_frame(self.sources[index], self.bbox)
+            self._index = index
+
+    def tell(self) -> int:
+        return self._index
+
+    def __getattr__(self, name: str):
+        return getattr(self._frame, name)
 
 
-def make_animation(sources: list[str], dst: str, framerate: int = 10):
-    bbox = find_bounding_box(sources)
+def get_frame_runs(sources: list[str]) -> list[tuple[str, int]]:
+    # Collapses runs of repeated frames into (source, count) pairs.
+    # Repeated angles are rendered once, so identical frames share the same source.
+    runs = []
+    for src in sources:
+        if runs and runs[-1][0] == src:
+            runs[-1] = (src, runs[-1][1] + 1)
+        else:
+            runs.append((src, 1))
+    return runs
 
+def get_run_durations(runs: list[tuple[str, int]], framerate: int, resolution: int = 1) -> list[int]:
+    # Returns the duration of each run in ms, rounded to the given resolution.
+    # Durations are taken from the rounded start and end times, so rounding errors do not accumulate.
+    durations = []
+    frame = 0
+    for _, count in runs:
+        start = round(frame * 1000 / framerate / resolution)
+        frame += count
+        end = round(frame * 1000 / framerate / resolution)
+        durations.append((end - start) * resolution)
+    return durations
+
+def make_animation(sources: list[str], dst: str, framerate: int = 10, bbox: list[int] = None, preset: str = None, crf: int = None, threshold: int = 0):
+    # The bounding box may be given if it was found as the frames were rendered.
+    # The preset and crf only apply to the ffmpeg backend.
+    if bbox is None:
+        bbox = find_bounding_box(sources, threshold)
+
+    runs = get_frame_runs(sources)
     backend = IMAGE_BACKENDS[get_extn(dst)]
     if backend == "pil":
-        make_animation_pil(sources, dst, framerate, bbox)
+        make_animation_pil(runs, dst, framerate, bbox)
     elif backend == "ffmpeg":
-        make_animation_ffmpeg(sources, dst, framerate, bbox)
+        make_animation_ffmpeg(runs, dst, framerate, bbox, preset, crf)
 
-def make_animation_pil(sources: list[str], dst: str, framerate: int, bbox: list[int]):
-    images = [ Image.open(path).convert("RGBA").crop(bbox) for path in sources ]
-    images[0].save(
+def make_animation_pil(runs: list[tuple[str, int]], dst: str, framerate: int, bbox: list[int]):
+    if get_extn(dst) == ".gif":
+        # PIL holds every frame in memory when saving a GIF, so frames are written out one at a time instead.
+        write_gif(runs, dst, framerate, bbox)
+        return
+
+    sources = [ src for src, _ in runs ]
+    first = load_frame(sources[0], bbox)
+    first.save(
         dst,
         save_all=True,
-        append_images=images[1:],
-        duration=int(1000 / framerate),
+        append_images=[FrameSequence(sources[1:], bbox)],
+        duration=get_run_durations(runs, framerate),
         loop=0,
         disposal=2
     )
 
-def make_animation_ffmpeg(sources: list[str], dst: str, framerate: int, bbox: list[int]):
-    x0, y0, x1, y1 = bbox
+# Number of frames sampled to build the GIF palette
+GIF_PALETTE_SAMPLES = 16
+GIF_PALETTE_SAMPLE_SIZE = 256
 
-    frame_info_path = os.path.join(os.path.dirname(dst), "ffmpeg-frames.txt")
-    with open(frame_info_path, 'w') as f:
-        for path in sources:
-            f.write(f"file '{os.path.abspath(path)}'\n")
-    
-    subprocess.check_output([
-        "ffmpeg",
-        "-f", "concat",
-        "-safe", "0",
-        "-r", str(framerate),
-        "-i", frame_info_path,
-        "-pix_fmt", "yuv420p",
-        "-movflags", "+faststart",
-        "-vf", f"crop={x1-x0}:{y1-y0}:{x0}:{y0},pad=ceil(iw/2)*2:ceil(ih/2)*2",
-        dst
-    ], stderr=subprocess.DEVNULL)
-
-    os.remove(frame_info_path)
\ No newline at end of file
+def get_gif_palette(sources: list[str], bbox: list[int]) -> Image.Image:
+    # Builds one palette for the whole animation from a spread of downscaled frames.
+    # The last palette entry is left out, as it is reserved for transparency.
+    step = max(len(sources) // GIF_PALETTE_SAMPLES, 1)
+    samples = []
+    for src in sources[::step]:
+        img = load_frame(src, bbox)
+        img.thumbnail((GIF_PALETTE_SAMPLE_SIZE, GIF_PALETTE_SAMPLE_SIZE))
+        samples.append(img)
+
+    width = max(img.width for img in samples)
+    montage = Image.new("RGB", (width, sum(img.height for img in samples)))
+    y = 0
+    for img in samples:
+        montage.paste(img, (0, y), img)
+        y += img.height
+    return montage.quantize(colors=GIF_TRANSPARENT)
+
+def quantize_frame(img: Image.Image, palette: Image.Image) -> Image.Image:
+    # Converts an RGBA frame to a palette image, using the transparent palette index for transparent pixels.
+    frame = img.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE)
+    transparent = img.getchannel("A").point(lambda a: 255 if a < 128 else 0)
+    frame.paste(GIF_TRANSPARENT, mask=transparent)
+    return frame
+
+def write_gif(runs: list[tuple[str, int]], dst: str, framerate: int, bbox: list[int]):
+    width = bbox[2] - bbox[0]
+    height = bbox[3] - bbox[1]
+    sources = [ src for src, _ in runs ]
+    palette = get_gif_palette(sources, bbox)
+    palette_bytes = bytes(palette.getpalette()[:GIF_TRANSPARENT * 3])
+    palette_bytes += bytes(256 * 3 - len(palette_bytes))
+
+    with open(dst, "wb") as f:
+        # Header, with the shared palette as the global color table, and the looping extension.
+        f.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, GIF_TRANSPARENT, 0))
+        f.write(palette_bytes)
+        f.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00")
+
+        # GIF durations are in units of 10ms
+        for src, duration in zip(sources, get_run_durations(runs, framerate, 10)):
+            frame = load_frame(src, bbox)
+            # Only the visible part of each frame is written. The previous frame is cleared by the disposal method.
+            frame_bbox = frame.getchannel("A").getbbox() or (0, 0, 1, 1)
+            frame = quantize_frame(frame.crop(frame_bbox), palette)
+
+            for data in GifImagePlugin.getdata(frame,
+                    offset=frame_bbox[:2],
+                    duration=duration,
+                    disposal=2,
+                    transparency=GIF_TRANSPARENT):
+                f.write(data)
+        f.write(b";")
+
+# x264 presets. For VP9 these are mapped onto the equivalent -cpu-used speed.
+FFMPEG_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+
+# The fastest -cpu-used speed for VP9 with -deadline good. 0 is the slowest.
+VP9_MAX_SPEED = 5
+
+def get_vp9_speed(preset: str) -> int:
+    # Spreads the presets evenly over the speeds, from ultrafast at the fastest to veryslow at the slowest
+    steps = len(FFMPEG_PRESETS) - 1
+    return round((steps - FFMPEG_PRESETS.index(preset)) * VP9_MAX_SPEED / steps)
+
+def get_ffmpeg_codec_args(extn: str, preset: str = None, crf: int = None) -> list[str]:
+    args = []
+    if extn == ".webm":
+        if preset is not None:
+            args += ["-deadline", "good", "-cpu-used", str(get_vp9_speed(preset))]
+        if crf is not None:
+            # VP9 needs the bitrate set to zero for constant quality
+            args += ["-crf", str(crf), "-b:v", "0"]
+    else:
+        if preset is not None:
+            args += ["-preset", preset]
+        if crf is not None:
+            args += ["-crf", str(crf)]
+    return args
+
+class FfmpegWriter():
+    # Encodes frames by piping raw RGBA pixels into ffmpeg.
+    # ffmpeg encodes each frame as it arrives, so encoding overlaps with loading the next frame.
+
+    def __init__(self, dst: str, framerate: int, size: tuple[int, int], preset: str = None, crf: int = None):
+        self.size = size
+        self.process = subprocess.Popen([
+            "ffmpeg",
+            "-y",
+            "-f", "rawvideo",
+            "-pix_fmt", "rgba",
+            "-s", f"{size[0]}x{size[1]}",
+            "-r", str(framerate),
+            "-i", "-",
+            "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart",
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+        ] + get_ffmpeg_codec_args(get_extn(dst), preset, crf) + [
+            dst
+        ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def write(self, frame: Image.Image):
+        if frame.size != self.size:
+            raise Exception(f"Frame size {frame.size} does not match animation size {self.size}")
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except BrokenPipeError:
+            # ffmpeg has exited. The return code is reported on close.
+            pass
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise Exception(f"ffmpeg failed with code {returncode}")
+
+def make_animation_ffmpeg(runs: list[tuple[str, int]], dst: str, framerate: int, bbox: list[int], preset: str = None, crf: int = None):
+    x0, y0, x1, y1 = bbox
+    writer = FfmpegWriter(dst, framerate, (x1 - x0, y1 - y0), preset, crf)
+    try:
+        # Video needs a constant framerate, so repeated frames are still written. They are only loaded once.
+        for src, count in runs:
+            frame = load_frame(src, bbox)
+            for _ in range(count):
+                writer.write(frame)
+    finally:
+        writer.close()
@@ -0,0 +1,150 @@
+import os, json, uuid, subprocess
+import backends
+
+# Translates kicad-cli export commands into a KiCad jobset, so that a single kicad-cli process
+# loads the schematic and board once and runs all the exports.
+# Only the options used by output.py are translated. Commands using any other option are left
+# to be run individually.
+
+JOB_TYPES = {
+    ("sch", "export", "pdf"):           "sch_export_plot_pdf",
+    ("sch", "export", "python-bom"):    "sch_export_pythonbom",
+    ("pcb", "export", "gerbers"):       "pcb_export_gerbers",
+    ("pcb", "export", "drill"):         "pcb_export_drill",
+    ("pcb", "export", "pos"):           "pcb_export_pos",
+    ("pcb", "export", "step"):          "pcb_export_3d",
+    ("pcb", "render"):                  "pcb_render",
+}
+
+def parse_rotation(value: str) -> dict:
+    x, y, z = [ float(v) for v in value.split(",") ]
+    return { "rotation_x": x, "rotation_y": y, "rotation_z": z }
+
+# Options which take a value, and a function to convert the value to job settings
+VALUE_OPTIONS = {
+    "--layers":                 lambda v: { "layers": v.split(",") },
+    "--format":                 lambda v: { "format": v },
+    "--excellon-zeros-format":  lambda v: { "zero_format": v },
+    "--excellon-units":         lambda v: { "units": v },
+    "--drill-origin":           lambda v: { "drill_origin": { "absolute": "abs" }.get(v, v) },
+    "--map-format":             lambda v: { "map_format": v },
+    "--units":                  lambda v: { "units": v },
+    "--side":                   lambda v: { "side": v },
+    "--quality":                lambda v: { "quality": v },
+    "--zoom":                   lambda v: { "zoom": float(v) },
+    "--width":                  lambda v: { "width": int(v) },
+    "--height":                 lambda v: { "height": int(v) },
+    "--background":             lambda v: { "bg_style": v },
+    "--rotate":                 parse_rotation,
+}
+
+# Options which are translated differently for a job type. The render views top, bottom, front and back
+# all differ, but the placement file only has front and back sides.
+JOB_VALUE_OPTIONS = {
+    "pcb_export_pos": {
+        "--side":               lambda v: { "side": { "top": "front", "bottom": "back" }.get(v, v) },
+    },
+}
+
+# Options which take no value, and the job settings they imply
+FLAG_OPTIONS = {
+    "--excellon-separate-th":   { "excellon.combine_pth_npth": False },
+    "--excellon-min-header":    { "excellon.minimal_header": True },
+    "--generate-map":           { "generate_map": True },
+    "--perspective":            { "perspective": True },
+    "--no-dnp":                 { "no_dnp": True },
+}
+
+_supported = {}
+
+def probe_jobset(kicad_cli: str) -> bool:
+    try:
+        result = subprocess.run([kicad_cli, "jobset", "--help"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+    except OSError:
+        return False
+
+def is_supported(kicad_cli: str) -> bool:
+    # Jobsets were added in KiCad 9
+    if kicad_cli not in _supported:
+        _supported[kicad_cli] = backends.probe("jobset", kicad_cli, lambda: probe_jobset(kicad_cli))
+    return _supported[kicad_cli]
+
+def create_job(args: list[str], root: str) -> dict:
+    # Converts a kicad-cli command into a job. Raises a ValueError if the command cannot be translated.
+    args = args[1:]
+    for path, job_type in JOB_TYPES.items():
+        if tuple(args[:len(path)]) == path:
+            args = args[len(path):]
+            break
+    else:
+        raise ValueError(f"No job type for \"{' '.join(args)}\"")
+
+    value_options = dict(VALUE_OPTIONS, **JOB_VALUE_OPTIONS.get(job_type, {}))
+    settings = { "description": "" }
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--output":
+            # Outputs are relative to the jobset output folder
+            settings["output_filename"] = os.path.relpath(os.path.abspath(args[i + 1]), root)
+            i += 2
+        elif arg in value_options:
+            settings.update(value_options[arg](args[i + 1]))
+            i += 2
+        elif arg in FLAG_OPTIONS:
+            settings.update(FLAG_OPTIONS[arg])
+            i += 1
+        elif not arg.startswith("-"):
+            # The input file. Jobs always run against the project's schematic or board.
+            i += 1
+        else:
+            raise ValueError(f"Unsupported option \"{arg}\"")
+
+    return {
+        "id": str(uuid.uuid4()),
+        "type": job_type,
+        "description": "",
+        "settings": settings,
+    }
+
+def write_jobset(path: str, commands: list[list[str]], root: str) -> list[list[str]]:
+    # Writes a jobset for the given commands. Returns the commands that were included.
+    jobs = []
+    included = []
+    for args in commands:
+        try:
+            job = create_job(args, root)
+        except ValueError:
+            continue
+        jobs.append(job)
+        included.append(args)
+
+        # Make sure the output directories exist, as they would when the commands are run individually.
+        output_dir = os.path.dirname(os.path.join(root, job["settings"].get("output_filename", "")))
+        os.makedirs(output_dir, exist_ok=True)
+
+    with open(path, "w") as f:
+        json.dump({
+            "meta": { "version": 1 },
+            "jobs": jobs,
+            "outputs": [
+                {
+                    "id": str(uuid.uuid4()),
+                    "type": "folder",
+                    "description": "",
+                    "only": [ job["id"] for job in jobs ],
+                    "settings": { "output_path": os.path.abspath(root) },
+                }
+            ],
+        }, f, indent=2)
+
+    return included
+
+def run_jobset_command(kicad_cli: str, jobset_file: str, project_file: str) -> list[str]:
+    return [
+        kicad_cli, "jobset", "run",
+        "--file", jobset_file,
+        "--stop-on-error",
+        project_file,
+    ]
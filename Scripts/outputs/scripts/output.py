@@ -1,7 +1,20 @@
+from __future__ import annotations
 import subprocess
-import os, sys, math, shutil, platform
-import argparse, glob, contextlib, json
-import bom, image, pdfmerge, bundle
+import os, sys, math, shutil, platform, time, threading, tempfile
+import argparse, glob, contextlib, contextvars, json, csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pipeline, cache, tracing, batch, backends
+
+# The modules of the exports are imported when a stage first uses them
+bom = backends.LazyModule("bom")
+schematic = backends.LazyModule("schematic")
+image = backends.LazyModule("image")
+pdfmerge = backends.LazyModule("pdfmerge")
+bundle = backends.LazyModule("bundle")
+jobset = backends.LazyModule("jobset")
+variants = backends.LazyModule("variants")
+watch = backends.LazyModule("watch")
+report = backends.LazyModule("report")
 
 SCRIPT_VERSION = "v1.29"
 KICAD_VERSION = "10.0"
@@ -18,6 +31,15 @@ else:
     IBOM_SCRIPT = os.path.expanduser(f"~/.local/share/kicad/{KICAD_VERSION}/3rdparty/plugins/org_openscopeproject_InteractiveHtmlBom/generate_interactive_bom.py")
 
 
+_kicad_version = None
+
+def get_kicad_version() -> str:
+    global _kicad_version
+    if _kicad_version is None:
+        # Starting kicad-cli takes a while, so the version is kept between runs
+        _kicad_version = backends.probe("version", KICAD_CLI, lambda: run_command([KICAD_CLI, "version"]))
+    return _kicad_version
+
 def get_layer_names(layers: int) -> list[str]:
     names = ["F.Fab", "F.SilkS", "F.Paste", "F.Mask", "F.Cu", "B.Cu", "B.Mask", "B.Paste", "B.SilkS", "B.Fab", "Edge.Cuts"]
     if layers > 2:
@@ -25,16 +47,110 @@ def get_layer_names(layers: int) -> list[str]:
             names.append(f"In{i + 1}.Cu")
     return names
 
+class CommandError(Exception):
+    def __init__(self, args: list[str], returncode: int, output: str):
+        super().__init__(f"Command failed with code {returncode}")
+        self.command = args
+        self.returncode = returncode
+        self.output = output
+
+    def report(self):
+        print_color(f"Command failed with code {self.returncode}!", "r")
+        print_color(' '.join(self.command), "r")
+        print_color(self.output, "r")
+
+class CommandCancelled(pipeline.Cancelled):
+    def __init__(self, args: list[str]):
+        super().__init__(f"Command cancelled: {get_command_name(args)}")
+        self.command = args
+
+class CheckFailed(Exception):
+    # Raised by a gated check, after it has cancelled the running commands
+    pass
+
+# Commands that have already been run as part of a jobset. Each is removed when its stage runs it, and any left
+# over are cleared at the end of the run, so they cannot be skipped by a later run in the same process.
+_completed_commands = set()
+
+class CommandGroup():
+    # The running commands of a project, so that they can be cancelled when a gated check fails
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        # Terminates all running commands, and stops any more from starting
+        with self.lock:
+            self.cancelled.set()
+            for process in self.processes:
+                process.terminate()
+
+    def wrap(self, fn: callable) -> callable:
+        # Returns fn, run with this as the current command group
+        def run():
+            token = _command_group.set(self)
+            try:
+                return fn()
+            finally:
+                _command_group.reset(token)
+        return run
+
+# The command group of the project in the current context. In batch mode, each project has its own.
+_command_group = contextvars.ContextVar("command_group", default=CommandGroup())
+
+# Limits the number of commands running at once, across all projects. None for no limit.
+_command_slots = None
+
+def cancel_commands():
+    _command_group.get().cancel()
+
+def reset_cancel():
+    _command_group.get().cancelled.clear()
+
+def limit_commands(count: int):
+    global _command_slots
+    _command_slots = threading.BoundedSemaphore(max(count, 1))
+
+def get_command_name(args: list[str]) -> str:
+    # The program and its subcommands, ie "kicad-cli pcb export gerbers"
+    words = [ os.path.splitext(os.path.basename(args[0]))[0] ]
+    for arg in args[1:4]:
+        if arg.startswith("-") or os.path.sep in arg or "." in arg:
+            break
+        words.append(arg)
+    return " ".join(words)
+
 def run_command(args: list[str], silent: bool = False) -> str:
-    try:
-        stderr = subprocess.DEVNULL if silent else None
-        return subprocess.check_output(args, stderr=stderr).decode().strip()
-    except subprocess.CalledProcessError as e:
-        print_color(f"Command failed with code {e.returncode}!", "r")
-        print_color(' '.join(args), "r")
-        print_color(e.stdout.decode().strip(), "r")
-        print("Aborting...")
-        exit()
+    if tuple(args) in _completed_commands:
+        _completed_commands.discard(tuple(args))
+        return ""
+
+    # stderr is captured rather than passed through, so that it ends up with the output of the stage that ran it.
+    with tracing.span(get_command_name(args), "command", { "command": subprocess.list2cmdline(args) }) as span:
+        group = _command_group.get()
+        with _command_slots or contextlib.nullcontext():
+            with group.lock:
+                if group.cancelled.is_set():
+                    raise CommandCancelled(args)
+                process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                group.processes.add(process)
+            try:
+                returncode, stdout, stderr = tracing.wait_process(process, span)
+            finally:
+                with group.lock:
+                    group.processes.discard(process)
+        if returncode != 0 and group.cancelled.is_set():
+            raise CommandCancelled(args)
+        if "--output" in args[:-1]:
+            span.args["output_size"] = tracing.get_output_size(args[args.index("--output") + 1])
+    stdout = stdout.decode().strip()
+    stderr = stderr.decode().strip()
+    if returncode != 0:
+        raise CommandError(args, returncode, "\n".join(s for s in [stdout, stderr] if s))
+    if stderr and not silent:
+        print(stderr)
+    return stdout
 
 def print_color(text: str, color: str = "r"):
     colors = {
@@ -61,42 +177,112 @@ def temp_directory(base: str, name: str = "tmp", preserve: bool = False):
         if not preserve:
             shutil.rmtree(path)
 
-def report_errors(title: str, errors: list[dict[str, str]]) -> dict[str, int]:
+# Violations beyond this are counted, but not listed
+MAX_LISTED_VIOLATIONS = 20
+
+def report_errors(title: str, violations: list[report.Violation], baseline: dict[str, dict] = None, section: str = None) -> list[report.Violation]:
+    # Prints the number of violations of each severity.
+    # Given a baseline, violations in the baseline are accepted, and only the new ones are counted and listed.
+    # Returns the violations that were counted.
+    notes = []
+    if baseline is not None:
+        fingerprints = { v.fingerprint for v in violations }
+        new = [ v for v in violations if v.fingerprint not in baseline ]
+        fixed = sum(1 for fingerprint, v in baseline.items() if v["section"] == section and fingerprint not in fingerprints)
+        if len(violations) > len(new):
+            notes.append(f"{len(violations) - len(new)} in baseline")
+        if fixed:
+            notes.append(f"{fixed} fixed")
+        violations = new
+
     groups = {}
-    for error in errors:
-        severity = error["severity"]
+    for violation in violations:
+        severity = violation.severity
         if severity not in groups:
             groups[severity] = 0
         groups[severity] += 1
 
-    if groups:
-        msg = f"{title}: " + ", ".join([f"{count} {type}s" for type, count in groups.items()])
-        color = "r" if "error" in groups else "y"
+    if groups or notes:
+        msg = f"{title}: " + (", ".join([f"{count} {type}s" for type, count in groups.items()]) if groups else "no new violations")
+        if notes:
+            msg += f" ({', '.join(notes)})"
+        color = "r" if "error" in groups else "y" if groups else "g"
         print_color(msg, color)
 
+    if baseline is not None:
+        for violation in violations[:MAX_LISTED_VIOLATIONS]:
+            print(f"  {violation.severity}: {violation.description} ({violation.type})")
+            for description, x, y in violation.items:
+                print(f"    {description} at {x}, {y}")
+        if len(violations) > MAX_LISTED_VIOLATIONS:
+            print(f"  ...and {len(violations) - MAX_LISTED_VIOLATIONS} more")
+    return violations
+
+# Severities a gated run can fail on, in increasing order
+SEVERITY_LEVELS = {
+    "warning": 1,
+    "error": 2,
+}
+
+def check_report(name: str, index: dict[str, report.Violation], sections: list[tuple[str, str]], baseline_file: str = None, update_baseline: bool = False, gate: str = None):
+    # Reports each section of a check, against the baseline if there is one.
+    # Given a gate severity, any new violation at or above it, or any schematic parity violation, fails the check.
+    # The running commands are cancelled straight away, rather than after this stage completes.
+    baseline = report.load_baseline(baseline_file, name) if baseline_file and not update_baseline else None
+    failed = []
+    for title, section in sections:
+        violations = report_errors(title, report.get_section(index, section), baseline, section)
+        if gate:
+            failed += [ v for v in violations if section == "schematic_parity" or SEVERITY_LEVELS.get(v.severity, 0) >= SEVERITY_LEVELS[gate] ]
+    if update_baseline:
+        report.update_baseline(baseline_file, name, index)
+        print(f"Updated {name.upper()} baseline with {len(index)} violations")
+    elif failed:
+        cancel_commands()
+        raise CheckFailed(f"{name.upper()} failed with {len(failed)} violations at or above the {gate} gate")
 
-def run_sch_erc(input_sch: str, output_dir: str):
-    # Run schematic ERC check
-    outfile = os.path.join(output_dir, "sch-erc.json")
-    run_command([
+@contextlib.contextmanager
+def temp_report(name: str):
+    # The check reports are only read, so they are written to a temporary file rather than the output directory.
+    # The file is removed even if the check fails or is cancelled.
+    fd, path = tempfile.mkstemp(prefix=f"{name}-", suffix=".json")
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def run_check(args: list[str], outfile: str, inputs: list[str], report_cache: report.ReportCache = None):
+    # Runs a check, unless its report can be restored from the report cache
+    if report_cache is None:
+        run_command(args)
+        return
+    key = report_cache.make_key(inputs, args)
+    if report_cache.restore(key, outfile):
+        return
+    run_command(args)
+    report_cache.store(key, outfile)
+
+def run_sch_erc_command(input_sch: str, outfile: str) -> list[str]:
+    return [
         KICAD_CLI, "sch", "erc",
         input_sch,
         "--output", outfile,
         "--format", "json",
         "--severity-warning",
         "--severity-error",
-    ])
-    
-    with open(outfile, "r") as f:
-        report = json.load(f)
-        report_errors("ERC report", sum((sheet["violations"] for sheet in report["sheets"]),[]))
+    ]
 
-    os.remove(outfile)
+def run_sch_erc(input_sch: str, inputs: list[str] = [], report_cache: report.ReportCache = None, baseline_file: str = None, update_baseline: bool = False, gate: str = None):
+    # Run schematic ERC check
+    with temp_report("sch-erc") as outfile:
+        run_check(run_sch_erc_command(input_sch, outfile), outfile, inputs, report_cache)
+        index = report.load_erc(outfile)
+    check_report("erc", index, [("ERC report", "erc")], baseline_file, update_baseline, gate)
 
-def run_pcb_drc(input_pcb: str, output_dir: str):
-    # Run PCB DRC check
-    outfile = os.path.join(output_dir, "pcb-drc.json")
-    run_command([
+def run_pcb_drc_command(input_pcb: str, outfile: str) -> list[str]:
+    return [
         KICAD_CLI, "pcb", "drc",
         input_pcb,
         "--output", outfile,
@@ -104,56 +290,113 @@ def run_pcb_drc(input_pcb: str, output_dir: str):
         "--severity-warning",
         "--severity-error",
         "--schematic-parity",
-    ])
-    
-    with open(outfile, "r") as f:
-        report = json.load(f)
-        report_errors("Schematic parity", report["schematic_parity"])
-        report_errors("Unconnected items", report["unconnected_items"])
-        report_errors("DRC report", report["violations"])
-
-    os.remove(outfile)
+    ]
 
-
-def export_sch_pdf(input_sch: str, output_pdf: str):
-    # Create PDF from schematic
-    run_command([
+def run_pcb_drc(input_pcb: str, inputs: list[str] = [], report_cache: report.ReportCache = None, baseline_file: str = None, update_baseline: bool = False, gate: str = None):
+    # Run PCB DRC check
+    with temp_report("pcb-drc") as outfile:
+        run_check(run_pcb_drc_command(input_pcb, outfile), outfile, inputs, report_cache)
+        index = report.load_drc(outfile)
+    check_report("drc", index, [
+        ("Schematic parity", "schematic_parity"),
+        ("Unconnected items", "unconnected_items"),
+        ("DRC report", "violations"),
+    ], baseline_file, update_baseline, gate)
+
+
+def export_sch_pdf_command(input_sch: str, output_pdf: str) -> list[str]:
+    return [
         KICAD_CLI, "sch", "export", "pdf",
         input_sch,
         "--output", output_pdf,
-    ])
+    ]
 
-def export_sch_bom(input_sch: str, output_csv: str, format: str = None) -> list[str]:
-    os.makedirs( os.path.dirname(output_csv) )
-    output_xml = output_csv.replace(".csv", ".xml")
-    run_command([
+def export_sch_pdf(input_sch: str, output_pdf: str):
+    # Create PDF from schematic
+    run_command(export_sch_pdf_command(input_sch, output_pdf))
+
+def export_sch_bom_command(input_sch: str, output_xml: str) -> list[str]:
+    return [
         KICAD_CLI, "sch", "export", "python-bom",
         input_sch,
         "--output", output_xml,
-    ])
-    components = bom.load_components(output_xml)
-    
-    fields = []
+    ]
+
+def get_bom_fields(format: str = None) -> list[str]:
     if format == "jlc":
-        fields = ["LCSC_Part"]
-    
-    bom.create_bom(components, output_csv, fields)
-    dnf_list = bom.get_dnf_list(components)
+        return ["LCSC_Part"]
+    return []
+
+BOM_SOURCES = ["sch", "xml", "verify"]
+
+def load_sch_xml_components(input_sch: str, output_xml: str) -> list[bom.Component]:
+    run_command(export_sch_bom_command(input_sch, output_xml))
+    components = bom.load_components(output_xml)
     os.remove(output_xml)
-    return dnf_list
+    return components
 
-def export_pcb_gerbers(input_pcb: str, output_dir: str, layers: list[str]):
-    os.makedirs(output_dir)
-    run_command([
+def load_sch_components(input_sch: str, output_xml: str, source: str = "sch", fields: list[str] = []) -> list[bom.Component]:
+    # The components are read directly from the schematic, unless the source is "xml".
+    # The python-bom export is used as a fallback if the schematic cannot be read, and to check the schematic reader if the source is "verify".
+    if source == "xml":
+        return load_sch_xml_components(input_sch, output_xml)
+
+    try:
+        components = schematic.load_components(input_sch)
+    except (OSError, ValueError) as e:
+        print_color(f"Could not read schematic ({e}). Falling back to python-bom export", "y")
+        return load_sch_xml_components(input_sch, output_xml)
+
+    if source == "verify":
+        differences = bom.compare_components(load_sch_xml_components(input_sch, output_xml), components, fields)
+        if differences:
+            print_color(f"Schematic reader differs from python-bom export in {len(differences)} places:", "y")
+            for difference in differences:
+                print(f" - {difference}")
+        else:
+            print_color("Schematic reader matches python-bom export", "g")
+    return components
+
+def export_sch_bom(input_sch: str, outputs: list[tuple[variants.Variant, str]], source: str = "sch", group_by: list[str] = None, ranges: bool = False) -> list[list[str]]:
+    # Writes the BOM of each variant from a single read of the schematic. Returns the DNF list of each variant.
+    if group_by is None:
+        group_by = bom.DEFAULT_GROUP_KEYS
+    for _, output_csv in outputs:
+        os.makedirs( os.path.dirname(output_csv), exist_ok=True )
+    output_xml = outputs[0][1].replace(".csv", ".xml")
+    fields = list(dict.fromkeys(field for variant, _ in outputs for field in variant.fields))
+    components = load_sch_components(input_sch, output_xml, source, fields)
+
+    dnf_lists = []
+    for variant, output_csv in outputs:
+        unknown = variant.get_unknown_refs(components)
+        if unknown:
+            print_color(f"Variant {variant.name} refers to unknown parts: {', '.join(unknown)}", "y")
+        variant_components = variant.apply(components)
+        conflicts = bom.create_bom(variant_components, output_csv, variant.fields, group_by, ranges)
+        for conflict in conflicts:
+            print_color(conflict, "y")
+        dnf_list = bom.get_dnf_list(variant_components)
+        if variant.name:
+            with open(output_csv.replace(".bom.csv", ".dnf.txt"), "w") as f:
+                f.writelines(ref + "\n" for ref in dnf_list)
+        dnf_lists.append(dnf_list)
+    return dnf_lists
+
+def export_pcb_gerbers_command(input_pcb: str, output_dir: str, layers: list[str]) -> list[str]:
+    return [
         KICAD_CLI, "pcb", "export", "gerbers",
         input_pcb,
         "--output", output_dir,
         "--layers", ",".join(layers),
-    ])
+    ]
 
-def export_pcb_ncdrill(input_pcb: str, output_dir: str):
-    os.makedirs(output_dir)
-    run_command([
+def export_pcb_gerbers(input_pcb: str, output_dir: str, layers: list[str]):
+    os.makedirs(output_dir, exist_ok=True)
+    run_command(export_pcb_gerbers_command(input_pcb, output_dir, layers))
+
+def export_pcb_ncdrill_command(input_pcb: str, output_dir: str) -> list[str]:
+    return [
         KICAD_CLI, "pcb", "export", "drill",
         input_pcb,
         "--output", output_dir + "/",
@@ -165,7 +408,11 @@ def export_pcb_ncdrill(input_pcb: str, output_dir: str):
         "--excellon-min-header",
         "--generate-map",
         "--map-format", "gerberx2",
-    ])
+    ]
+
+def export_pcb_ncdrill(input_pcb: str, output_dir: str):
+    os.makedirs(output_dir, exist_ok=True)
+    run_command(export_pcb_ncdrill_command(input_pcb, output_dir))
 
 def fix_pos_header(header: str):
     header = header.replace("Ref", "Designator")
@@ -175,15 +422,19 @@ def fix_pos_header(header: str):
     header = header.replace("Side", "Layer")
     return header
 
-def export_pcb_pos(input_pcb: str, output_file: str):
-    run_command([
+def export_pcb_pos_command(input_pcb: str, output_file: str) -> list[str]:
+    return [
         KICAD_CLI, "pcb", "export", "pos",
         input_pcb,
         "--output", output_file,
         "--units", "mm",
         "--side", "both",
         "--format", "csv",
-    ])
+    ]
+
+def export_pcb_pos(input_pcb: str, output_file: str):
+    os.makedirs( os.path.dirname(output_file), exist_ok=True )
+    run_command(export_pcb_pos_command(input_pcb, output_file))
 
     with open(output_file, "r+") as f:
         f.seek(0)
@@ -194,22 +445,35 @@ def export_pcb_pos(input_pcb: str, output_file: str):
         f.truncate()
 
 
-def export_pcb_step(input_pcb: str, output_file: str):
-    run_command([
+def filter_pcb_pos(input_file: str, output_file: str, dnf_list: list[str]):
+    # Writes a copy of the position file without the unfitted parts
+    dnf = set(dnf_list)
+    with open(input_file, "r") as f:
+        lines = f.readlines()
+    with open(output_file, "w") as f:
+        f.write(lines[0])
+        for line in lines[1:]:
+            ref = next(csv.reader([line]), [""])[0]
+            if ref not in dnf:
+                f.write(line)
+
+def export_pcb_pos_variants(input_file: str, outputs: list[str], dnf_lists: list[list[str]]):
+    for output_file, dnf_list in zip(outputs, dnf_lists):
+        filter_pcb_pos(input_file, output_file, dnf_list)
+
+def export_pcb_step_command(input_pcb: str, output_file: str) -> list[str]:
+    return [
         KICAD_CLI, "pcb", "export", "step",
         input_pcb,
         "--output", output_file,
         "--no-dnp",
-    ])
+    ]
 
-def export_pcb_ibom(input_pcb: str, output_file: str, dnf_list: list[str] = []):
-
-    if not os.path.exists(IBOM_SCRIPT):
-        print_color(f"IBOM plugin not found", "y")
-        return
+def export_pcb_step(input_pcb: str, output_file: str):
+    run_command(export_pcb_step_command(input_pcb, output_file))
 
-    os.environ['INTERACTIVE_HTML_BOM_NO_DISPLAY'] = "1"
-    run_command([
+def export_pcb_ibom_command(input_pcb: str, output_file: str, dnf_list: list[str] = []) -> list[str]:
+    return [
         KICAD_PYTHON, IBOM_SCRIPT, input_pcb,
         "--no-browser",
         "--dest-dir", os.path.dirname(output_file),
@@ -219,23 +483,99 @@ def export_pcb_ibom(input_pcb: str, output_file: str, dnf_list: list[str] = []):
         "--include-nets",
         "--name-format", os.path.basename(output_file).replace(".html", ""),
         "--blacklist", ",".join(dnf_list)
-    ], silent=True)
+    ]
+
+def export_pcb_ibom(input_pcb: str, outputs: list[str], dnf_lists: list[list[str]]):
+
+    if not os.path.exists(IBOM_SCRIPT):
+        print_color(f"IBOM plugin not found", "y")
+        return
 
-def export_pcb_image(input_pcb: str, output_file: str, side: str = "top", zoom: float = 0.9, resolution: int = 2000):
-    resolution = [str(resolution), str(resolution)]
-    run_command([
+    os.environ['INTERACTIVE_HTML_BOM_NO_DISPLAY'] = "1"
+    for output_file, dnf_list in zip(outputs, dnf_lists):
+        run_command(export_pcb_ibom_command(input_pcb, output_file, dnf_list), silent=True)
+
+def export_pcb_render_command(input_pcb: str, output_file: str, side: str, zoom: float, resolution: int|tuple[int, int], rotate: str = None) -> list[str]:
+    # The resolution may be a single value for a square render, or a (width, height) tuple
+    if type(resolution) is not tuple:
+        resolution = (resolution, resolution)
+    args = [
         KICAD_CLI, "pcb", "render",
         input_pcb,
         "--output", output_file,
         "--quality", "user",
         "--perspective",
         "--zoom", f"{zoom:.2f}",
-        "--width", resolution[0],
-        "--height", resolution[1],
+        "--width", str(resolution[0]),
+        "--height", str(resolution[1]),
         "--background", "transparent",
         "--side", side,
-    ])
-    image.crop_image(output_file, output_file)
+    ]
+    if rotate is not None:
+        args += ["--rotate", rotate]
+    return args
+
+def run_render(input_pcb: str, args: list[str], render_cache: cache.RenderCache = None) -> bool:
+    # Runs a render command, unless the render can be restored from the cache.
+    # Returns True if the render was restored.
+    output_file = args[args.index("--output") + 1]
+    if render_cache is None:
+        run_command(args)
+        return False
+
+    key = render_cache.make_key(input_pcb, args)
+    if render_cache.restore(key, output_file):
+        return True
+    run_command(args)
+    render_cache.store(key, output_file)
+    return False
+
+# Auto framing renders the board at a low resolution first, to choose the zoom and aspect ratio of the final render.
+AUTO_FRAME_PROBE_RESOLUTION = 200
+AUTO_FRAME_PROBE_ANGLES = 8
+AUTO_FRAME_FILL = 0.95
+
+def get_frame_extent(bbox: tuple[int, int, int, int], width: int, height: int) -> tuple[float, float]:
+    # Returns the fraction of the frame needed to contain the bounding box, if the frame stays centered.
+    x0, y0, x1, y1 = bbox
+    return (
+        2 * max(abs(x0 - width / 2), abs(x1 - width / 2)) / width,
+        2 * max(abs(y0 - height / 2), abs(y1 - height / 2)) / height,
+    )
+
+def find_framing(input_pcb: str, tmpdir: str, side: str, zoom: float, size: int, rotations: list[str] = [None], render_cache: cache.RenderCache = None) -> tuple[float, tuple[int, int]]:
+    # Returns the zoom and resolution which make the largest side of the board (over all rotations) about `size` pixels.
+    # This assumes the board scales linearly with zoom, and that the camera has a fixed vertical field of view.
+    resolution = AUTO_FRAME_PROBE_RESOLUTION
+    while True:
+        extent_x = extent_y = 0.0
+        for i, rotate in enumerate(rotations):
+            path = os.path.join(tmpdir, f"probe-{i}.png")
+            run_render(input_pcb, export_pcb_render_command(input_pcb, path, side, zoom, resolution, rotate), render_cache)
+            bbox = image.get_alpha_bbox(path)
+            os.remove(path)
+            if bbox:
+                x, y = get_frame_extent(bbox, resolution, resolution)
+                extent_x = max(extent_x, x)
+                extent_y = max(extent_y, y)
+
+        if extent_x == 0 or extent_y == 0:
+            raise Exception("Probe render is fully transparent!")
+        if extent_x < 1 and extent_y < 1:
+            break
+        # The board is clipped by the frame, so it cannot be measured. Zoom out and try again.
+        zoom /= 2
+
+    height = size / AUTO_FRAME_FILL / max(extent_x / extent_y, 1)
+    width = height * extent_x / extent_y
+    return zoom * AUTO_FRAME_FILL / extent_y, (round(width), round(height))
+
+def export_pcb_image(input_pcb: str, output_file: str, side: str = "top", zoom: float = 0.9, resolution: int = 2000, render_cache: cache.RenderCache = None, alpha_threshold: int = 0, size: int = None):
+    # If a size is given, the zoom and resolution are chosen to fit the board to that size.
+    if size:
+        zoom, resolution = find_framing(input_pcb, os.path.dirname(output_file), side, zoom, size, render_cache = render_cache)
+    run_render(input_pcb, export_pcb_render_command(input_pcb, output_file, side, zoom, resolution), render_cache)
+    image.crop_image(output_file, output_file, alpha_threshold)
 
 def motion_flip(t: float, dwell: float = 0.3):
     if t > 0.5:
@@ -245,126 +585,346 @@ def motion_flip(t: float, dwell: float = 0.3):
     t_flip = (t - dwell) / (0.5 - dwell)
     return 0.25 - (0.25 * math.cos(math.pi * t_flip))
 
-def export_pcb_animation(input_pcb: str, output_file: str, direction: str = "left", zoom: float = 0.7, framerate: int = 20, duration: float = 3.0, resolution: int = 640, curve: str = "orbit"):
+ANIMATION_DIRECTIONS = {
+    "up":       lambda a: f"{-a:.03f},0,0",
+    "down":     lambda a: f"{a:.03f},0,0",
+    "left":     lambda a: f"0,{a:.03f},0",
+    "right":    lambda a: f"0,{-a:.03f},0",
+}
+
+ANIMATION_CURVES = {
+    "orbit":    lambda t: 360.0 * t,
+    "flip":     lambda t: 360.0 * motion_flip(t, 0.3)
+}
+
+def get_animation_angles(framerate: int, duration: float, curve: str) -> list[float]:
+    angle_fn = ANIMATION_CURVES[curve]
+    frames = int(duration * framerate)
+    return [ round(angle_fn(f / frames), 2) for f in range(frames) ]
+
+def get_animation_frame_path(tmpdir: str, frame: int) -> str:
+    return os.path.join(tmpdir, f"{frame:04d}.png")
+
+def export_pcb_animation_commands(input_pcb: str, tmpdir: str, direction: str, zoom: float, framerate: int, duration: float, resolution: int|tuple[int, int], curve: str) -> dict[float, list[str]]:
+    # Returns the render command for each unique angle in the animation
+    rotate_str = ANIMATION_DIRECTIONS[direction]
+    commands = {}
+    for f, angle in enumerate(get_animation_angles(framerate, duration, curve)):
+        if angle not in commands:
+            path = get_animation_frame_path(tmpdir, f)
+            commands[angle] = export_pcb_render_command(input_pcb, path, "top", zoom, resolution, rotate_str(angle))
+    return commands
+
+def render_frame(input_pcb: str, args: list[str], render_cache: cache.RenderCache = None, alpha_threshold: int = 0) -> tuple[float, bool, tuple]:
+    start = time.perf_counter()
+    restored = run_render(input_pcb, args, render_cache)
+    elapsed = time.perf_counter() - start
+    # Find the bounding box while the frame is fresh, so the frames only need to be read again for assembly
+    bbox = image.get_alpha_bbox(args[args.index("--output") + 1], alpha_threshold)
+    return elapsed, restored, bbox
+
+def render_frames(input_pcb: str, commands: list[list[str]], jobs: int = 1, render_cache: cache.RenderCache = None, alpha_threshold: int = 0) -> tuple:
+    # Renders are run on their own pool, as each renderer can use a lot of memory.
+    # Returns the bounding box of all the frames.
+    start = time.perf_counter()
+    restored_count = 0
+    union_bbox = None
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [ tracing.submit(executor, render_frame, input_pcb, args, render_cache, alpha_threshold) for args in commands ]
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                elapsed, restored, bbox = future.result()
+                union_bbox = image.merge_bbox(union_bbox, bbox)
+                if restored:
+                    restored_count += 1
+                else:
+                    pipeline.print_status(f"Rendered frame {i + 1}/{len(futures)} in {elapsed:.1f}s")
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {len(commands) - restored_count} frames in {elapsed:.1f}s ({restored_count} restored from cache)")
+
+    if not union_bbox:
+        raise Exception("All frames are fully transparent!")
+    return union_bbox
+
+def export_pcb_animation(input_pcb: str, output_file: str, direction: str = "left", zoom: float = 0.7, framerate: int = 20, duration: float = 3.0, resolution: int = 640, curve: str = "orbit", jobs: int = 1, render_cache: cache.RenderCache = None, preset: str = None, crf: int = None, alpha_threshold: int = 0, size: int = None):
 
     export_format = output_file.split('.')[-1]
     if not image.get_backend(export_format):
         print_color(f"No {export_format} backend available. Skipping PCB animation", "y")
         return
 
-    rotate_str = {
-        "up":       lambda a: f"{-a:.03f},0,0",
-        "down":     lambda a: f"{a:.03f},0,0",
-        "left":     lambda a: f"0,{a:.03f},0",
-        "right":    lambda a: f"0,{-a:.03f},0",
-    }[direction]
-
-    angle_fn = {
-        "orbit":    lambda t: 360.0 * t,
-        "flip":     lambda t: 360.0 * motion_flip(t, 0.3)
-    }[curve]
-
-    frames = int(duration * framerate)
-    resolution = [str(resolution), str(resolution)]
     cache = {}
 
     with temp_directory(os.path.dirname(output_file), "gif-tmp") as tmpdir:
+        if size:
+            # Frame the animation on a spread of the angles it passes through
+            angles = sorted(set(get_animation_angles(framerate, duration, curve)))
+            step = max(len(angles) // AUTO_FRAME_PROBE_ANGLES, 1)
+            rotations = [ ANIMATION_DIRECTIONS[direction](angle) for angle in angles[::step] ]
+            zoom, resolution = find_framing(input_pcb, tmpdir, "top", zoom, size, rotations, render_cache)
+
+        commands = export_pcb_animation_commands(input_pcb, tmpdir, direction, zoom, framerate, duration, resolution, curve)
         images = []
-        for f in range(frames):
-            angle = round(angle_fn(f / frames), 2)
+        for f, angle in enumerate(get_animation_angles(framerate, duration, curve)):
             if angle not in cache:
-                path = os.path.join(tmpdir, f"{f:04d}.png")
-                run_command([
-                    KICAD_CLI, "pcb", "render",
-                    input_pcb,
-                    "--output", path,
-                    "--quality", "user",
-                    "--perspective",
-                    "--zoom", f"{zoom:.2f}",
-                    "--width", resolution[0],
-                    "--height", resolution[1],
-                    "--background", "transparent",
-                    "--side", "top",
-                    "--rotate", rotate_str(angle)
-                ])
-                cache[angle] = path
+                cache[angle] = get_animation_frame_path(tmpdir, f)
             images.append(cache[angle])
-        
-        image.make_animation(images, output_file, framerate)
 
-def export_pcb_drawings(input_pcb: str, output_file: str, layers: int, extra_layers: list[str] = None):
+        bbox = render_frames(input_pcb, [ commands[angle] for angle in cache ], jobs, render_cache, alpha_threshold)
+        image.make_animation(images, output_file, framerate, bbox, preset, crf)
+
+def get_drawing_plots(layers: int, extra_layers: list[str] = None) -> list[dict]:
+    plots = [
+        {
+            "name": "Top Fabrication",
+            "layers": ["F.Fab", "Edge.Cuts"],
+        },
+        {
+            "name": "Bottom Fabrication",
+            "layers": ["B.Fab", "Edge.Cuts"],
+        },
+        {
+            "name": "Top",
+            "layers": ["F.Cu", "F.Paste", "F.SilkS", "Edge.Cuts"],
+        },
+        {
+            "name": "Bottom",
+            "layers": ["B.Cu", "B.Paste", "B.SilkS", "Edge.Cuts"],
+        },
+    ]
 
-    if not pdfmerge.get_backend():
+    if layers > 2:
+        # Put the internal layers between the top and bottom layers
+        bottom = plots.pop(-1)
+        for i in range(layers - 2):
+            plots.append({
+                "name": f"Inner Layer {i + 1}",
+                "layers": [f"In{i + 1}.Cu", "Edge.Cuts"]
+            })
+        plots.append(bottom)
+
+    if extra_layers:
+        for layer in extra_layers:
+            plots.append({
+                "name": f"Layer {layer}",
+                "layers": [layer, "Edge.Cuts"]
+            })
+
+    return plots
+
+def export_pcb_plot_command(input_pcb: str, output_dir: str, plot: dict) -> list[str]:
+    return [
+        KICAD_CLI, "pcb", "export", "pdf",
+        input_pcb,
+        "--layers", plot["layers"][0],
+        "--common-layers", ",".join(plot["layers"][1:]),
+        "--output", output_dir,
+        "--include-border-title",
+        "--drill-shape-opt", "2",
+        "--define-var", f"LAYER_NAME={plot['name']}",
+        "--mode-separate",
+    ]
+
+def plot_page(input_pcb: str, tmpdir: str, plot: dict, index: int, page_cache: pdfmerge.PageCache = None) -> str:
+    # Returns the path of the plotted page. Pages are restored from the page cache when possible.
+    args = export_pcb_plot_command(input_pcb, tmpdir, plot)
+    if page_cache is not None:
+        # The project file is included as it holds the text variables used in the title block.
+        input_pro = os.path.splitext(input_pcb)[0] + ".kicad_pro"
+        key = page_cache.make_key(input_pcb, plot["layers"], args, [input_pro])
+        path = os.path.join(tmpdir, f"page-{index}.pdf")
+        if page_cache.restore(key, path):
+            return path
+
+    result = run_command(args)
+    # Result format: "Plotted to 'outputs/pdf-tmp/pcb_name-F_Fab.pdf'."
+    path = result.split("'")[-2]
+    if page_cache is not None:
+        page_cache.store(key, path)
+    return path
+
+def export_pcb_drawings(input_pcb: str, output_file: str, layers: int, extra_layers: list[str] = None, jobs: int = 1, page_cache: pdfmerge.PageCache = None):
+
+    backend = pdfmerge.get_backend(bookmarks=True)
+    if not backend:
         print_color("No PDF merging backend available. Skipping PCB drawings", "y")
         return
+    if backend != pdfmerge.get_backend():
+        print("Merging PCB drawings with pypdf rather than pdfunite, to add bookmarks")
+    elif backend == "pdfunite":
+        print_color("pdfunite cannot add bookmarks. Install pypdf to bookmark the PCB drawings", "y")
 
     with temp_directory(os.path.dirname(output_file), "pdf-tmp") as tmpdir:
-        plots = [
-            {
-                "name": "Top Fabrication",
-                "layers": ["F.Fab", "Edge.Cuts"],
-            },
-            {
-                "name": "Bottom Fabrication",
-                "layers": ["B.Fab", "Edge.Cuts"],
-            },
-            {
-                "name": "Top",
-                "layers": ["F.Cu", "F.Paste", "F.SilkS", "Edge.Cuts"],
-            },
-            {
-                "name": "Bottom",
-                "layers": ["B.Cu", "B.Paste", "B.SilkS", "Edge.Cuts"],
-            },
-        ]
+        plots = get_drawing_plots(layers, extra_layers)
+
+        def plot_pages():
+            # Yields the plotted files in order, so the merge can start while later plots are still running.
+            for future in futures:
+                yield future.result()
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [ tracing.submit(executor, plot_page, input_pcb, tmpdir, plot, i, page_cache) for i, plot in enumerate(plots) ]
+            try:
+                pdfmerge.merge_pdf(plot_pages(), output_file, [ plot["name"] for plot in plots ], backend)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+def run_jobset(jobset_stage: pipeline.Stage, input_pro: str, output_dir: str):
+    # Runs the commands of the stages that come after the jobset stage, and are about to run, in a single kicad-cli process.
+    # The stages themselves then skip these commands, and just do their post processing.
+    # The stages are taken from the pipeline running the jobset, which in a batch is the combined pipeline.
+    stages = jobset_stage.pipeline
+    commands = []
+    for stage in stages.get_after(jobset_stage):
+        if stage.commands and stages.will_run(stage):
+            commands += stage.commands()
+
+    if not commands:
+        return
+
+    if not jobset.is_supported(KICAD_CLI):
+        print_color("kicad-cli does not support jobsets. Running exports individually.", "y")
+        return
 
-        if layers > 2:
-            # Put the internal layers between the top and bottom layers
-            bottom = plots.pop(-1)
-            for i in range(layers - 2):
-                plots.append({
-                    "name": f"Inner Layer {i + 1}",
-                    "layers": [f"In{i + 1}.Cu", "Edge.Cuts"]
-                })
-            plots.append(bottom)
-
-        if extra_layers:
-            for layer in extra_layers:
-                plots.append({
-                    "name": f"Layer {layer}",
-                    "layers": [layer, "Edge.Cuts"]
-                })
-
-        for plot in plots:
-            result = run_command([
-                KICAD_CLI, "pcb", "export", "pdf",
-                input_pcb,
-                "--layers", plot["layers"][0],
-                "--common-layers", ",".join(plot["layers"][1:]),
-                "--output", tmpdir,
-                "--include-border-title",
-                "--drill-shape-opt", "2",
-                "--define-var", f"LAYER_NAME={plot['name']}",
-                "--mode-separate",
-            ])
-            # Result format: "Plotted to 'outputs/pdf-tmp/pcb_name-F_Fab.pdf'."
-            plot["filename"] = result.split("'")[-2]
-
-        pages = [ plot["filename"] for plot in plots ]
-        pdfmerge.merge_pdf(pages, output_file)
+    with temp_directory(output_dir, "jobset-tmp") as tmpdir:
+        jobset_file = os.path.join(tmpdir, "outputs.kicad_jobset")
+        included = jobset.write_jobset(jobset_file, commands, os.getcwd())
+        try:
+            run_command(jobset.run_jobset_command(KICAD_CLI, jobset_file, input_pro))
+        except CommandError as e:
+            print_color(f"Jobset failed with code {e.returncode}. Running exports individually.", "y")
+            return
+
+    _completed_commands.update(tuple(args) for args in included)
+
+def run_stages(stages: pipeline.Pipeline, jobs: int, only: set[str] = None):
+    try:
+        stages.run(jobs, only)
+    finally:
+        # Commands left by the jobset, ie for a stage that failed or was cancelled, are not carried into the next run
+        _completed_commands.clear()
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def select_stages(stages: pipeline.Pipeline, names: list[str]) -> set[str]:
+    # Returns the named stages and the stages they depend on, and removes their old outputs.
+    # The outputs of other stages are left in place.
+    unknown = [ name for name in names if name not in stages.stages ]
+    if unknown:
+        raise ValueError(f"Unknown stages {', '.join(unknown)}. Choose from {', '.join(stages.names())}.")
+    selected = stages.get_dependencies(names)
+    for name in selected:
+        for path in stages.stages[name].outputs:
+            remove_path(path)
+    return selected
+
+def remove_incomplete(stages: pipeline.Pipeline, group: str = None):
+    # Removes the outputs of stages that did not complete, so no partial files are left after a failed check
+    for stage in stages.stages.values():
+        if stage.name not in stages.completed and (group is None or stage.group == group):
+            for path in stage.outputs:
+                remove_path(path)
+
+def get_watched_files(input_file: str, variants_file: str = None) -> list[str]:
+    files = [input_file + ".kicad_pro", input_file + ".kicad_pcb"] + schematic.get_sheet_files(input_file + ".kicad_sch")
+    return files + ([variants_file] if variants_file else [])
+
+def finish_run(caches: list, trace_file: str = None, print_summary: callable = tracing.print_summary):
+    for c in caches:
+        c.evict()
+    print_summary()
+    if trace_file:
+        tracing.write_chrome_trace(trace_file)
+
+def watch_project(stages: pipeline.Pipeline, make_pipeline: callable, get_files: callable, jobs: int, finish: callable, selected: set[str] = None):
+    # Re-runs the stages affected by each change to the project files, until interrupted.
+    # If stages are selected, only those are re-run.
+    # The process stays up between runs, so parsed schematics, file hashes and the caches stay warm.
+    watcher = watch.FileWatcher(get_files())
+    print("Watching for changes. Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed = watcher.wait()
+            try:
+                # The pipeline is rebuilt, as sheets may have been added or removed.
+                previous, stages = stages, make_pipeline()
+                stages.keep_results(previous)
+                affected = stages.affected_by(changed)
+                if selected is not None:
+                    affected &= selected
+                print(f"Changed {', '.join(os.path.basename(path) for path in changed)}")
+                # Old outputs are removed first, so nothing stale is left in output directories.
+                for name in affected:
+                    for path in stages.stages[name].outputs:
+                        remove_path(path)
+                tracing.clear()
+                reset_cancel()
+                run_stages(stages, jobs, affected)
+                finish()
+            except CommandError as e:
+                e.report()
+            except CheckFailed as e:
+                print_color(str(e))
+                remove_incomplete(stages)
+            except (OSError, ValueError) as e:
+                # Most likely a file that was read part way through being saved. It is retried on the next change.
+                print_color(f"Run failed: {e}")
+            watcher.watch(get_files())
+            print("Watching for changes...")
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+def run_batch(projects: list[batch.Project], make_pipeline: callable, jobs: int, output_cache: cache.OutputCache = None, stage_names: list[str] = None) -> pipeline.Pipeline:
+    # Runs the stages of all projects on one pool of workers. If stage names are given, just those stages are run.
+    # A failed project does not stop the others. Its failure is left in the failures of the returned pipeline.
+    pipelines = {}
+    selected = None
+    for project in projects:
+        os.makedirs(project.output_dir, exist_ok=True)
+        stages = make_pipeline(project)
+        if stage_names:
+            selected = (selected or set()) | { f"{project.name}/{name}" for name in select_stages(stages, stage_names) }
+        # Each project has its own command group, so a failed check only cancels the commands of its project
+        group = CommandGroup()
+        for stage in stages.stages.values():
+            stage.run = group.wrap(stage.run)
+        pipelines[project.name] = stages
+
+    stages = pipeline.interleave(pipelines, output_cache)
+    run_stages(stages, jobs, selected)
+
+    for name, error in stages.failures.items():
+        print_color(f"{name} failed", "r")
+        if isinstance(error, CommandError):
+            error.report()
+        else:
+            print_color(str(error))
+        if isinstance(error, CheckFailed):
+            remove_incomplete(stages, name)
+    return stages
 
 def run_git_check() -> str:
-    if not shutil.which("git"):
+    if not backends.is_available("git"):
         print_color("Git not found. Skipping git check.", "y")
         return None
 
     try:
         output = run_command(["git", "status"], silent=True)
-    except subprocess.CalledProcessError:
+        git_commit = run_command(["git", "rev-parse", "--short", "HEAD"], silent=True)
+    except CommandError:
         print_color("Not a git repository.", "y")
         return None
-    
-    git_commit = run_command(["git", "rev-parse", "--short", "HEAD"], silent=True)
 
     if not "nothing to commit, working tree clean" in output:
         print_color("Git repository has uncommitted changes.", "y")
@@ -373,122 +933,382 @@ def run_git_check() -> str:
 
     return git_commit
 
-def zip_files(input_path: str, output_file: str, files: list[str] = None):
-    bundle.bundle(input_path, output_file, files)
-
-def zip_release_pack(input_path: str, output_file: str, format: str):
+def get_release_files(format: str) -> list[str]:
     if format == "jlc":
-        zip_files(input_path, output_file, [
+        return [
             "Assembly",
             "Gerber",
             "NC Drill",
-        ])
+        ]
     else:
         raise ValueError(f"Unknown release format: {format}.")
 
-def glob_single(input_pattern: str) -> str:
-    files = glob.glob(input_pattern)
-    if len(files) == 0:
-        raise FileNotFoundError(f"No files match \"{input_pattern}\"")
-    if len(files) > 1:
-        raise ValueError(f"Multiple files match \"{input_pattern}\".")
-    return files[0]
+def bundle_outputs(input_path: str, output_file: str, release_file: str = None, format: str = None, jobs: int = 1):
+    # The full bundle and the release pack are written together, so each file is only compressed once.
+    bundles = [(output_file, None)]
+    if format != None:
+        bundles.append((release_file, get_release_files(format)))
+    bundle.bundle_all(input_path, bundles, jobs)
+
+def create_pipeline(args: argparse.Namespace, input_file: str, output_dir: str, output_name: str, output_cache: cache.OutputCache = None, render_cache: cache.RenderCache = None, page_cache: pdfmerge.PageCache = None, variant_list: list[variants.Variant] = None, report_cache: report.ReportCache = None) -> pipeline.Pipeline:
+    input_pro = input_file + ".kicad_pro"
+    input_sch = input_file + ".kicad_sch"
+    input_pcb = input_file + ".kicad_pcb"
+
+    def output_path(*path: str) -> str:
+        return os.path.join(output_dir, *path)
+
+    # Inputs for cached stages, and for choosing the stages to re-run in watch mode.
+    # The project file is included as it holds the design rules and text variables.
+    sch_inputs = [input_pro] + schematic.get_sheet_files(input_sch)
+    pcb_inputs = [input_pro, input_pcb]
+
+    stages = pipeline.Pipeline(output_cache)
+
+    # The checks are added first, so they start ahead of the exports. With --gate, a failed check cancels the exports.
+    stages.add(pipeline.Stage("erc", "Running schematic ERC",
+        lambda: run_sch_erc(input_sch, sch_inputs, report_cache, args.baseline, args.update_baseline, args.gate),
+        inputs = sch_inputs
+    ))
+
+    # DRC reads the schematic too, for the schematic parity check.
+    stages.add(pipeline.Stage("drc", "Running PCB DRC",
+        lambda: run_pcb_drc(input_pcb, pcb_inputs + sch_inputs, report_cache, args.baseline, args.update_baseline, args.gate),
+        inputs = pcb_inputs + sch_inputs
+    ))
+
+    def uncached_renders(commands: list[list[str]]) -> list[list[str]]:
+        # Renders restored from the render cache are left out of the jobset
+        if render_cache is None:
+            return commands
+        return [ c for c in commands if not render_cache.contains(render_cache.make_key(input_pcb, c)) ]
+
+    # Exports which may be batched into a jobset run after it. The jobset is run along with any of them, and only
+    # includes the commands of those being run. It has no inputs of its own, so in watch mode a change only
+    # re-runs the stages that read the changed file.
+    jobset_after = []
+    if args.jobset:
+        jobset_stage = stages.add(pipeline.Stage("jobset", "Running export jobset",
+            lambda: run_jobset(jobset_stage, input_pro, output_dir),
+        ))
+        jobset_after = ["jobset"]
+
+    sch_pdf = output_path(output_name + ".schematics.pdf")
+    stages.add(pipeline.Stage("sch-pdf", "Generating schematic PDF",
+        lambda: export_sch_pdf(input_sch, sch_pdf),
+        after = jobset_after,
+        inputs = sch_inputs,
+        outputs = [sch_pdf],
+        key = lambda: export_sch_pdf_command(input_sch, sch_pdf),
+        commands = lambda: [export_sch_pdf_command(input_sch, sch_pdf)]
+    ))
+
+
+    # Without any variants, there is a single unnamed variant using the schematic DNP flags.
+    variant_list = variant_list or [variants.Variant(fields = get_bom_fields(args.format))]
+    named_variants = [ v for v in variant_list if v.name ]
+    variant_inputs = [args.variants] if args.variants else []
+
+    def variant_name(variant: variants.Variant) -> str:
+        return f"{output_name}.{variant.name}" if variant.name else output_name
+
+    bom_outputs = [ (v, output_path("Assembly", variant_name(v) + ".bom.csv")) for v in variant_list ]
+    bom_xml = bom_outputs[0][1].replace(".csv", ".xml")
+    stages.add(pipeline.Stage("bom", "Generating BOM",
+        lambda: export_sch_bom(input_sch, bom_outputs, args.bom_source, args.bom_group_by.split(","), args.bom_ranges),
+        after = jobset_after,
+        inputs = sch_inputs + variant_inputs,
+        outputs = [ path for _, path in bom_outputs ] + [ path.replace(".bom.csv", ".dnf.txt") for v, path in bom_outputs if v.name ],
+        key = lambda: export_sch_bom_command(input_sch, bom_xml) + [ v.fields for v in variant_list ] + [args.bom_source, args.bom_group_by, args.bom_ranges],
+        # The python-bom export is only needed when the schematic is not read directly
+        commands = lambda: [export_sch_bom_command(input_sch, bom_xml)] if args.bom_source != "sch" else []
+    ))
+
+    ibom_outputs = [ output_path(variant_name(v) + ".ibom.html") for v in variant_list ]
+    stages.add(pipeline.Stage("ibom", "Generating IBOM",
+        lambda: export_pcb_ibom(input_pcb, ibom_outputs, stages.result("bom")),
+        depends = ["bom"],
+        inputs = pcb_inputs + [IBOM_SCRIPT],
+        outputs = ibom_outputs,
+        key = lambda: [ export_pcb_ibom_command(input_pcb, path, dnf_list) for path, dnf_list in zip(ibom_outputs, stages.result("bom")) ]
+    ))
+
+    gerber_dir = output_path("Gerber")
+    gerber_layers = get_layer_names(args.layers) + args.extra_layer
+    stages.add(pipeline.Stage("gerbers", "Generating gerbers",
+        lambda: export_pcb_gerbers(input_pcb, gerber_dir, gerber_layers),
+        after = jobset_after,
+        inputs = pcb_inputs,
+        outputs = [gerber_dir],
+        key = lambda: export_pcb_gerbers_command(input_pcb, gerber_dir, gerber_layers),
+        commands = lambda: [export_pcb_gerbers_command(input_pcb, gerber_dir, gerber_layers)]
+    ))
+
+    drill_dir = output_path("NC Drill")
+    stages.add(pipeline.Stage("drill", "Generating drill reports",
+        lambda: export_pcb_ncdrill(input_pcb, drill_dir),
+        after = jobset_after,
+        inputs = pcb_inputs,
+        outputs = [drill_dir],
+        key = lambda: export_pcb_ncdrill_command(input_pcb, drill_dir),
+        commands = lambda: [export_pcb_ncdrill_command(input_pcb, drill_dir)]
+    ))
+
+    pos_csv = output_path("Assembly", output_name + ".pos.csv")
+    stages.add(pipeline.Stage("pos", "Generating position report",
+        lambda: export_pcb_pos(input_pcb, pos_csv),
+        after = jobset_after,
+        inputs = pcb_inputs,
+        outputs = [pos_csv],
+        key = lambda: export_pcb_pos_command(input_pcb, pos_csv),
+        commands = lambda: [export_pcb_pos_command(input_pcb, pos_csv)]
+    ))
+
+    if named_variants:
+        # The position file is only exported once, and then filtered for each variant
+        pos_outputs = [ output_path("Assembly", variant_name(v) + ".pos.csv") for v in named_variants ]
+        stages.add(pipeline.Stage("pos-variants", "Generating variant position reports",
+            lambda: export_pcb_pos_variants(pos_csv, pos_outputs, stages.result("bom")),
+            depends = ["bom", "pos"],
+            inputs = pcb_inputs,
+            outputs = pos_outputs,
+            key = lambda: [ export_pcb_pos_command(input_pcb, pos_csv), pos_outputs, stages.result("bom") ]
+        ))
+
+    # The drawings are not batched into the jobset, as each plot needs its own LAYER_NAME variable.
+    drawings_pdf = output_path(output_name + ".drawings.pdf")
+    stages.add(pipeline.Stage("drawings", "Generating PCB drawings",
+        lambda: export_pcb_drawings(input_pcb, drawings_pdf, args.layers, args.extra_layer, args.jobs, page_cache),
+        inputs = pcb_inputs,
+        outputs = [drawings_pdf],
+        key = lambda: [
+            export_pcb_plot_command(input_pcb, output_path("pdf-tmp"), plot)
+            for plot in get_drawing_plots(args.layers, args.extra_layer)
+        ]
+    ))
 
-if __name__ == "__main__":
+    render_png = output_path(output_name + ".png")
+    stages.add(pipeline.Stage("render", "Generating PCB render",
+        lambda: export_pcb_image(input_pcb, render_png,
+            side = args.render_side,
+            zoom = args.render_zoom,
+            resolution = args.render_resolution,
+            render_cache = render_cache,
+            alpha_threshold = args.alpha_threshold,
+            size = args.render_size
+        ),
+        after = jobset_after,
+        inputs = pcb_inputs,
+        outputs = [render_png],
+        key = lambda: [export_pcb_render_command(input_pcb, render_png, args.render_side, args.render_zoom, args.render_resolution), args.alpha_threshold, args.render_size],
+        # Auto framed renders depend on the probe render, so cannot be batched into the jobset.
+        commands = lambda: uncached_renders([export_pcb_render_command(input_pcb, render_png, args.render_side, args.render_zoom, args.render_resolution)])
+            if not args.render_size else []
+    ))
 
-    sys.argv[-1] = sys.argv[-1].strip()  # Remove trailing carriage return for *nix/win compat.
+    if args.anim_format:
+        animation_file = output_path(f"{output_name}.{args.anim_format}")
+        animation_args = dict(
+            direction = args.anim_direction,
+            zoom = args.anim_zoom,
+            framerate = args.anim_framerate,
+            duration = args.anim_duration,
+            resolution = args.anim_resolution,
+            curve = args.anim_curve
+        )
+        stages.add(pipeline.Stage("animation", f"Generating PCB {args.anim_format} animation",
+            lambda: export_pcb_animation(input_pcb, animation_file, **animation_args,
+                jobs = args.anim_jobs,
+                render_cache = render_cache,
+                preset = args.anim_preset,
+                crf = args.anim_crf,
+                alpha_threshold = args.alpha_threshold,
+                size = args.anim_size
+            ),
+            after = jobset_after,
+            inputs = pcb_inputs,
+            outputs = [animation_file],
+            key = lambda: [
+                list(export_pcb_animation_commands(input_pcb, output_path("gif-tmp"), **animation_args).values()),
+                get_animation_angles(args.anim_framerate, args.anim_duration, args.anim_curve),
+                args.anim_framerate,
+                args.anim_preset,
+                args.anim_crf,
+                args.alpha_threshold,
+                args.anim_size,
+            ],
+            commands = lambda: uncached_renders(list(export_pcb_animation_commands(input_pcb, output_path("gif-tmp"), **animation_args).values()))
+                if image.get_backend(args.anim_format) and not args.anim_size else []
+        ))
+
+    step_file = output_path(output_name + ".step")
+    stages.add(pipeline.Stage("step", "Generating step file",
+        lambda: export_pcb_step(input_pcb, step_file),
+        after = jobset_after,
+        inputs = pcb_inputs,
+        outputs = [step_file],
+        key = lambda: export_pcb_step_command(input_pcb, step_file),
+        commands = lambda: [export_pcb_step_command(input_pcb, step_file)]
+    ))
+
+    # The bundles must wait for everything else, as they pack up the whole output directory.
+    bundle_file = output_path(f"{output_name}.{args.compression}")
+    release_file = output_path(f"{output_name}.{args.format}.{args.compression}") if args.format != None else None
+    stages.add(pipeline.Stage("bundle", f"Generating {args.compression} file" + (f" and {args.format} release pack" if args.format != None else ""),
+        lambda: bundle_outputs(output_dir, bundle_file, release_file, args.format, args.jobs),
+        depends = stages.names()
+    ))
+
+    return stages
+
+# The choices and defaults of the arguments, from the image, bom and bundle modules.
+# They are repeated here so that building the parser does not import those modules.
+ANIMATION_FORMATS = ["gif", "webp", "mp4", "webm"]
+FFMPEG_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+BOM_GROUP_KEYS = ["footprint", "value"]
+COMPRESSION_FORMATS = ["zip", "tar.gz"]
+
+def get_argparser() -> argparse.ArgumentParser:
     argparser = argparse.ArgumentParser(description="Output generator for kicad projects")
-    argparser.add_argument("--input", "-i", type=str, help="Kicad project", default="*.kicad_pro")
+    argparser.add_argument("--input", "-i", type=str, nargs="+", help="Kicad projects, or glob patterns matching them. More than one project is run as a batch, with the outputs of each in its own directory.", default=["*.kicad_pro"])
+    argparser.add_argument("--manifest", type=str, help="Json file listing the projects to run as a batch, and their options.", default=None)
     argparser.add_argument("--output", "-o", type=str, help="Output directory", default="outputs")
     argparser.add_argument("--layers", "-l", type=int, help="Number of layers in the PCB design.", default=2)
     argparser.add_argument("--extra-layer", action="append", default=[], help="Additional PCB layers to add to gerbers and drawings")
     argparser.add_argument("--render-side", type=str, help="Side of the board to render.", default="top", choices=["top", "bottom", "left", "right", "front", "back"])
     argparser.add_argument("--render-zoom", type=float, help="Zoom used for rendering.", default=0.9)
     argparser.add_argument("--render-resolution", type=int, help="Render resolution (before cropping)", default=2000)
-    argparser.add_argument("--anim-format", type=str, help="Selects output animation format", choices=image.ANIMATION_FORMATS)
+    argparser.add_argument("--render-size", type=int, help="Size of the largest side of the cropped render. Chooses the zoom and resolution automatically.", default=None)
+    argparser.add_argument("--alpha-threshold", type=int, help="Pixels with alpha at or below this are ignored when cropping renders.", default=0)
+    argparser.add_argument("--anim-format", type=str, help="Selects output animation format", choices=ANIMATION_FORMATS)
     argparser.add_argument("--anim-zoom", type=float, help="Zoom used for animation rendering.", default=0.7)
     argparser.add_argument("--anim-duration", type=float, help="Duration of the animation in seconds.", default=5.0)
     argparser.add_argument("--anim-framerate", type=int, help="Framerate of the animation.", default=20)
     argparser.add_argument("--anim-resolution", type=int, help="Animation resolution (before cropping)", default=640)
+    argparser.add_argument("--anim-size", type=int, help="Size of the largest side of the cropped animation. Chooses the zoom and resolution automatically.", default=None)
     argparser.add_argument("--anim-direction", type=str, help="Rotation direction of the animation", default="left", choices=["up", "down", "left", "right"])
     argparser.add_argument("--anim-curve", type=str, help="Curve used for animation path", default="flip", choices=["orbit", "flip"])
+    argparser.add_argument("--anim-preset", type=str, help="Encoder preset for mp4/webm animations. Faster presets give larger files.", default=None, choices=FFMPEG_PRESETS)
+    argparser.add_argument("--anim-crf", type=int, help="Encoder CRF for mp4/webm animations. Higher values give smaller files with lower quality.", default=None)
+    argparser.add_argument("--anim-jobs", type=int, help="Number of animation frames to render in parallel.", default=2)
     argparser.add_argument("--name", type=str, help="Output name", default=None)
     argparser.add_argument("--wait-on-done", action="store_true", help="Wait to hold the terminal open when done.")
     argparser.add_argument("--format", type=str, help="Manufacturer specific output options", default=None, choices=["jlc"])
-    argparser.add_argument("--compression", type=str, help="Compression format", default="zip", choices=bundle.SUPPORTED_FORMATS)
+    argparser.add_argument("--variants", type=str, help="Json file of assembly variants. A BOM, position file and IBOM is generated for each variant.", default=None)
+    argparser.add_argument("--bom-group-by", type=str, help="Comma separated list of the properties BOM lines are grouped by. Use value, footprint, or the name of any field (ie, footprint,value,MPN).", default=",".join(BOM_GROUP_KEYS))
+    argparser.add_argument("--bom-ranges", action="store_true", help="Compress consecutive BOM designators into ranges, ie R1-R12.")
+    argparser.add_argument("--bom-source", type=str, help="Read BOM components directly from the schematic (sch), from a kicad-cli python-bom export (xml), or from both and compare them (verify).", default="sch", choices=BOM_SOURCES)
+    argparser.add_argument("--jobs", "-j", type=int, help="Number of stages to run in parallel.", default=os.cpu_count())
+    argparser.add_argument("--max-commands", type=int, help="Maximum number of kicad-cli commands to run at once. Defaults to no limit, or to --jobs for a batch.", default=None)
+    argparser.add_argument("--jobset", action="store_true", help="Run the exports as a single kicad-cli jobset, rather than a kicad-cli process per export.")
+    argparser.add_argument("--no-cache", action="store_true", help="Regenerate all outputs rather than restoring unchanged outputs from the cache.")
+    argparser.add_argument("--cache-dir", type=str, help="Output cache directory. Note that 3D models and libraries are not tracked by the cache.", default=".output-cache")
+    argparser.add_argument("--cache-size", type=int, help="Maximum size of the output cache in MB.", default=2000)
+    argparser.add_argument("--render-cache-size", type=int, help="Maximum size of the render frame cache in MB.", default=1000)
+    argparser.add_argument("--page-cache-size", type=int, help="Maximum size of the drawing page cache in MB.", default=200)
+    argparser.add_argument("--report-cache-size", type=int, help="Maximum size of the ERC and DRC report cache in MB.", default=50)
+    argparser.add_argument("--baseline", type=str, help="Json file of accepted ERC and DRC violations. Only violations not in the baseline are reported.", default=None)
+    argparser.add_argument("--update-baseline", action="store_true", help="Write the current ERC and DRC violations to the --baseline file.")
+    argparser.add_argument("--gate", type=str, help="Stop if ERC or DRC finds new violations of this severity or above, or any schematic parity violations. Exports are started alongside the checks, and cancelled if they fail.", default=None, choices=list(SEVERITY_LEVELS))
+    argparser.add_argument("--trace", type=str, help="Write a trace of the stages and commands to this json file. Open it in chrome://tracing or ui.perfetto.dev.", default=None)
+    argparser.add_argument("--stages", type=str, help="Comma separated stages to run, ie bom,pos. The stages they depend on are also run, and other outputs are left in place.", default=None)
+    argparser.add_argument("--watch", action="store_true", help="Keep running, and regenerate the outputs affected by each change to the project files.")
+    argparser.add_argument("--compression", type=str, help="Compression format", default="zip", choices=COMPRESSION_FORMATS)
+    return argparser
+
+if __name__ == "__main__":
+
+    sys.argv[-1] = sys.argv[-1].strip()  # Remove trailing carriage return for *nix/win compat.
+    argparser = get_argparser()
     args = argparser.parse_args()
+    if args.update_baseline and not args.baseline:
+        argparser.error("--update-baseline requires --baseline")
+    if not args.no_cache:
+        # Before anything is probed, so the probes from earlier runs are used
+        backends.set_probe_file(os.path.join(args.cache_dir, "probes.json"))
 
-    # Strip file extention
-    input_file = glob_single(args.input)
-    input_file = os.path.splitext(input_file)[0]
-    
-    INPUT_SCH = input_file + ".kicad_sch"
-    INPUT_PCB = input_file + ".kicad_pcb"
-    OUTPUT_DIR = args.output
-    OUTPUT_NAME = args.name if args.name else os.path.basename(input_file)
+    try:
+        projects = batch.load_manifest(args.manifest, args) if args.manifest else batch.find_projects(args.input, args)
+    except (OSError, ValueError) as e:
+        argparser.error(str(e))
+    batch_mode = args.manifest is not None or len(projects) > 1
+    if batch_mode and args.watch:
+        argparser.error("--watch only supports a single project")
+    for project in projects:
+        project.output_dir = os.path.join(args.output, project.name) if batch_mode else args.output
+
+    # Stages such as the drawings and animation run several commands of their own, so a batch also limits
+    # the number of commands running at once to the jobs.
+    if args.max_commands or batch_mode:
+        limit_commands(args.max_commands or args.jobs)
 
     print("Running output generator {}".format(SCRIPT_VERSION))
 
-    clean_directory(OUTPUT_DIR)
+    stage_names = args.stages.split(",") if args.stages else None
+    if stage_names:
+        os.makedirs(args.output, exist_ok=True)
+    else:
+        clean_directory(args.output)
 
     print("Checking git status")
     run_git_check()
 
-    print("Running schematic ERC")
-    run_sch_erc(INPUT_SCH, OUTPUT_DIR)
-
-    print("Generating schematic PDF")
-    export_sch_pdf(INPUT_SCH, os.path.join(OUTPUT_DIR, OUTPUT_NAME + ".schematics.pdf"))
-
-    print("Running PCB DRC")
-    run_pcb_drc(INPUT_PCB, OUTPUT_DIR)
-
-    print("Generating BOM")
-    dnf_list = export_sch_bom(INPUT_SCH, os.path.join(OUTPUT_DIR, "Assembly" , OUTPUT_NAME + ".bom.csv"), args.format)
-
-    print("Generating IBOM")
-    export_pcb_ibom(INPUT_PCB, os.path.join(OUTPUT_DIR, OUTPUT_NAME + ".ibom.html"), dnf_list)
-
-    print("Generating gerbers")
-    export_pcb_gerbers(INPUT_PCB, os.path.join(OUTPUT_DIR, "Gerber"), get_layer_names(args.layers) + args.extra_layer)
-
-    print("Generating drill reports")
-    export_pcb_ncdrill(INPUT_PCB, os.path.join(OUTPUT_DIR, "NC Drill"))
-
-    print("Generating position report")
-    export_pcb_pos(INPUT_PCB, os.path.join(OUTPUT_DIR, "Assembly", OUTPUT_NAME + ".pos.csv"))
-
-    print("Generating PCB drawings")
-    export_pcb_drawings(INPUT_PCB, os.path.join(OUTPUT_DIR, OUTPUT_NAME + ".drawings.pdf"), args.layers, args.extra_layer)
-
-    print("Generating PCB render")
-    export_pcb_image(INPUT_PCB, os.path.join(OUTPUT_DIR, OUTPUT_NAME + ".png"),
-            side = args.render_side,
-            zoom = args.render_zoom,
-            resolution = args.render_resolution
-        )
-
-    if args.anim_format:
-        print(f"Generating PCB {args.anim_format} animation")
-        export_pcb_animation(INPUT_PCB, os.path.join(OUTPUT_DIR, f"{OUTPUT_NAME}.{args.anim_format}"),
-            direction = args.anim_direction,
-            zoom = args.anim_zoom,
-            framerate = args.anim_framerate,
-            duration = args.anim_duration,
-            resolution = args.anim_resolution,
-            curve = args.anim_curve
-        )
-
-    print("Generating step file")
-    export_pcb_step(INPUT_PCB, os.path.join(OUTPUT_DIR, OUTPUT_NAME + ".step"))
-
-    print(f"Generating {args.compression} file")
-    zip_files(OUTPUT_DIR, os.path.join(OUTPUT_DIR, f"{OUTPUT_NAME}.{args.compression}"))
-
-    if args.format != None:
-        print(f"Generating {args.format} release pack")
-        zip_release_pack(OUTPUT_DIR, os.path.join(OUTPUT_DIR, f"{OUTPUT_NAME}.{args.format}.{args.compression}"), args.format)
-
+    output_cache = None
+    render_cache = None
+    page_cache = None
+    report_cache = None
+    if not args.no_cache:
+        cache_version = [SCRIPT_VERSION, get_kicad_version()]
+        output_cache = cache.OutputCache(args.cache_dir, args.cache_size * 1000000, cache_version)
+        render_cache = cache.RenderCache(os.path.join(args.cache_dir, "renders"), args.render_cache_size * 1000000, cache_version)
+        page_cache = pdfmerge.PageCache(os.path.join(args.cache_dir, "pages"), args.page_cache_size * 1000000, cache_version)
+        report_cache = report.ReportCache(os.path.join(args.cache_dir, "reports"), args.report_cache_size * 1000000, cache_version)
+
+    def make_pipeline(project: batch.Project) -> pipeline.Pipeline:
+        # The variants are loaded with the pipeline, so watch mode picks up changes to them
+        a = project.args
+        variant_list = variants.load_variants(a.variants, get_bom_fields(a.format)) if a.variants else None
+        return create_pipeline(a, project.input_file, project.output_dir, project.name, output_cache, render_cache, page_cache, variant_list, report_cache)
+
+    caches = [output_cache, render_cache, page_cache, report_cache] if output_cache else []
+
+    if batch_mode:
+        try:
+            stages = run_batch(projects, make_pipeline, args.jobs, output_cache, stage_names)
+        except ValueError as e:
+            argparser.error(str(e))
+        results = batch.get_results(projects, stages)
+        batch.write_summary(os.path.join(args.output, "summary.json"), results)
+        finish_run(caches, args.trace, lambda: batch.print_summary(results))
+        if stages.failures:
+            print(f"{len(stages.failures)} of {len(projects)} projects failed")
+            sys.exit(1)
+    else:
+        project = projects[0]
+        finish = lambda: finish_run(caches, args.trace)
+
+        stages = make_pipeline(project)
+        try:
+            selected = select_stages(stages, stage_names) if stage_names else None
+        except ValueError as e:
+            argparser.error(str(e))
+        try:
+            run_stages(stages, args.jobs, selected)
+        except CommandError as e:
+            e.report()
+            if not args.watch:
+                print("Aborting...")
+                sys.exit(1)
+        except CheckFailed as e:
+            print_color(str(e))
+            remove_incomplete(stages)
+            if not args.watch:
+                print("Aborting...")
+                sys.exit(1)
+
+        finish()
+        if args.watch:
+            watch_project(stages, lambda: make_pipeline(project), lambda: get_watched_files(project.input_file, args.variants), args.jobs, finish, selected)
     print("Done!")
     if args.wait_on_done:
         input("Press enter to exit...")
@@ -1,46 +1,247 @@
-import shutil
+import os, re, hashlib, json
+from typing import Iterable
+import cache, sexpr, backends
 
-BACKEND = None
+# pypdf is imported on first use
+pypdf = backends.LazyModule("pypdf")
 
-if not BACKEND:
-    if shutil.which("pdfunite"):
-        BACKEND = "pdfunite"
+def get_backend(bookmarks: bool = False) -> str | None:
+    # pdfunite cannot write bookmarks, so pypdf is preferred when they are wanted.
+    if bookmarks and backends.is_available("pypdf"):
+        return "pypdf"
+    if backends.is_available("pdfunite"):
+        return "pdfunite"
+    if backends.is_available("pypdf"):
+        return "pypdf"
+    return None
 
-if not BACKEND:
-    try: 
-        import pypdf
-        BACKEND = "pypdf"
-    except ImportError:
-        pass
 
+def merge_pdf(pdf_files: Iterable[str], output_file: str, titles: list[str] = None, backend: str = None):
+    # The pdf files may be given as an iterator. With pypdf, pages are written to the output as each file
+    # becomes available. pdfunite merges in a single process, so it waits for all of the files.
+    # If titles are given, a bookmark is added at the start of each file. pdfunite cannot add these.
+    if backend is None:
+        backend = get_backend(titles is not None)
 
-def get_backend() -> str | None:
-    return BACKEND
-
+    if backend == "pdfunite":
+        return merge_pdf_pdfunite(pdf_files, output_file)
 
-def merge_pdf(pdf_files: list[str], output_file: str):
+    elif backend == "pypdf":
+        return merge_pdf_pypdf(pdf_files, output_file, titles)
 
-    if BACKEND == "pdfunite":
-        return merge_pdf_pdfunite(pdf_files, output_file)
-    
-    elif BACKEND == "pypdf":
-        return merge_pdf_pypdf(pdf_files, output_file)
-    
     else:
         raise Exception("No PDF merging backend available. Please install 'pypdf' or ensure 'pdfunite' is available in your PATH.")
 
 
-def merge_pdf_pypdf(pdf_files: list[str], output_file: str):
-    merger = pypdf.PdfWriter()
-    for pdf in pdf_files:
-        merger.append(pdf)
-    merger.write(output_file)
-    merger.close()
+class PdfStream():
+    # Writes a PDF one page at a time. pypdf is only used to read the input files: each page, and the objects it uses,
+    # are written out as soon as the page is added. Only the object offsets, page numbers and bookmarks are kept,
+    # rather than the whole document as with pypdf's PdfWriter.
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self.offsets = {}
+        self.next_id = 3
+        self.pages = []
+        self.bookmarks = []
+
+    def allocate(self) -> int:
+        self.next_id += 1
+        return self.next_id - 1
+
+    def ref(self, idnum: int):
+        return pypdf.generic.IndirectObject(idnum, 0, None)
+
+    def write_object(self, idnum: int, obj):
+        self.offsets[idnum] = self.file.tell()
+        self.file.write(f"{idnum} 0 obj\n".encode())
+        obj.write_to_stream(self.file)
+        self.file.write(b"\nendobj\n")
+
+    def add_file(self, path: str, title: str = None):
+        # Objects are numbered again in the output. ids maps the numbers of the input file to these, so objects
+        # shared between its pages, such as fonts, are only written once.
+        with open(path, "rb") as f:
+            reader = pypdf.PdfReader(f)
+            ids = {}
+            for i, page in enumerate(reader.pages):
+                idnum = self.add_page(page, ids)
+                if i == 0 and title is not None:
+                    self.bookmarks.append((title, idnum))
+        # Written through, rather than left in the buffer while the next file is plotted
+        self.file.flush()
+
+    def add_page(self, page, ids: dict[int, int]) -> int:
+        # The page is flattened by the reader, so it holds any attributes it inherited from the page tree.
+        # Its parent is replaced by the page tree of the output.
+        generic = pypdf.generic
+        page_id = self.allocate()
+        ids[page.indirect_reference.idnum] = page_id
+        queue = []
+
+        def relink(obj):
+            # Returns the object with its references renumbered, queueing the objects they point to.
+            # Streams are always indirect, so are only seen once, and are changed in place.
+            if isinstance(obj, generic.IndirectObject):
+                if obj.idnum not in ids:
+                    ids[obj.idnum] = self.allocate()
+                    queue.append(obj)
+                return self.ref(ids[obj.idnum])
+            if isinstance(obj, generic.StreamObject):
+                for key, value in list(obj.items()):
+                    if key != "/Length":
+                        obj[key] = relink(value)
+                return obj
+            if isinstance(obj, generic.DictionaryObject):
+                copy = generic.DictionaryObject()
+                for key, value in obj.items():
+                    copy[key] = relink(value)
+                return copy
+            if isinstance(obj, generic.ArrayObject):
+                return generic.ArrayObject([ relink(value) for value in obj ])
+            return obj
+
+        content = relink(generic.DictionaryObject({ key: value for key, value in page.items() if key != "/Parent" }))
+        content[generic.NameObject("/Parent")] = self.ref(self.PAGES)
+        self.write_object(page_id, content)
+        while queue:
+            ref = queue.pop()
+            obj = ref.get_object()
+            self.write_object(ids[ref.idnum], relink(obj if obj is not None else generic.NullObject()))
+        self.pages.append(page_id)
+        return page_id
+
+    def close(self):
+        generic = pypdf.generic
+        catalog = generic.DictionaryObject({
+            generic.NameObject("/Type"): generic.NameObject("/Catalog"),
+            generic.NameObject("/Pages"): self.ref(self.PAGES),
+        })
+        self.write_object(self.PAGES, generic.DictionaryObject({
+            generic.NameObject("/Type"): generic.NameObject("/Pages"),
+            generic.NameObject("/Kids"): generic.ArrayObject([ self.ref(idnum) for idnum in self.pages ]),
+            generic.NameObject("/Count"): generic.NumberObject(len(self.pages)),
+        }))
+
+        if self.bookmarks:
+            outlines_id = self.allocate()
+            item_ids = [ self.allocate() for _ in self.bookmarks ]
+            for i, (title, page_id) in enumerate(self.bookmarks):
+                item = generic.DictionaryObject({
+                    generic.NameObject("/Title"): generic.TextStringObject(title),
+                    generic.NameObject("/Parent"): self.ref(outlines_id),
+                    generic.NameObject("/Dest"): generic.ArrayObject([ self.ref(page_id), generic.NameObject("/Fit") ]),
+                })
+                if i > 0:
+                    item[generic.NameObject("/Prev")] = self.ref(item_ids[i - 1])
+                if i + 1 < len(item_ids):
+                    item[generic.NameObject("/Next")] = self.ref(item_ids[i + 1])
+                self.write_object(item_ids[i], item)
+            self.write_object(outlines_id, generic.DictionaryObject({
+                generic.NameObject("/Type"): generic.NameObject("/Outlines"),
+                generic.NameObject("/First"): self.ref(item_ids[0]),
+                generic.NameObject("/Last"): self.ref(item_ids[-1]),
+                generic.NameObject("/Count"): generic.NumberObject(len(item_ids)),
+            }))
+            catalog[generic.NameObject("/Outlines")] = self.ref(outlines_id)
+            catalog[generic.NameObject("/PageMode")] = generic.NameObject("/UseOutlines")
+        self.write_object(self.CATALOG, catalog)
+
+        xref = self.file.tell()
+        self.file.write(f"xref\n0 {self.next_id}\n0000000000 65535 f \n".encode())
+        for idnum in range(1, self.next_id):
+            self.file.write(f"{self.offsets[idnum]:010d} 00000 n \n".encode())
+        self.file.write(f"trailer\n<< /Size {self.next_id} /Root {self.CATALOG} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+        self.file.close()
+
+    def abort(self):
+        # Removes the partly written file
+        self.file.close()
+        os.remove(self.path)
 
 
-def merge_pdf_pdfunite(pdf_files: list[str], output_file: str):
+def merge_pdf_pypdf(pdf_files: Iterable[str], output_file: str, titles: list[str] = None):
+    stream = PdfStream(output_file)
+    try:
+        for i, pdf in enumerate(pdf_files):
+            stream.add_file(pdf, titles[i] if titles else None)
+    except BaseException:
+        stream.abort()
+        raise
+    stream.close()
+
+
+def merge_pdf_pdfunite(pdf_files: Iterable[str], output_file: str):
     import subprocess
-    command = ["pdfunite"] + pdf_files + [output_file]
+    command = ["pdfunite"] + list(pdf_files) + [output_file]
     result = subprocess.run(command, capture_output=True)
     if result.returncode != 0:
         raise Exception(f"pdfunite failed: {result.stderr.decode()}")
+
+
+# Top level board items which are drawn on particular layers.
+# Anything else (setup, nets, title block, groups) may affect every page.
+LAYER_ITEMS = { "footprint", "module", "segment", "arc", "via", "zone", "dimension", "target", "image", "table", "generated" }
+
+LAYER_RE = re.compile(r'\(layers?((?:\s+(?:"[^"]*"|[^\s()"]+))+)\s*\)')
+LAYER_NAME_RE = re.compile(r'"([^"]*)"|([^\s"]+)')
+
+def layer_matches(pattern: str, layer: str) -> bool:
+    # Board items may use wildcards such as "*.Cu" and "F&B.Cu"
+    side, _, kind = pattern.partition(".")
+    layer_side, _, layer_kind = layer.partition(".")
+    return kind == layer_kind and (side == "*" or layer_side in side.split("&"))
+
+def get_item_layers(item: str) -> list[str] | None:
+    name = sexpr.get_name(item)
+    if name == "via":
+        # Vias are drawn on every copper layer they pass through, which is not listed for through vias.
+        return ["*.Cu"]
+    if name not in LAYER_ITEMS and not name.startswith("gr_"):
+        return None
+    layers = []
+    for match in LAYER_RE.finditer(item):
+        layers += [ a or b for a, b in LAYER_NAME_RE.findall(match.group(1)) ]
+    return layers
+
+_board_items = {}
+
+def get_board_items(input_pcb: str) -> list[tuple[list[str] | None, str]]:
+    # Returns each board item with the layers it is drawn on, or None if it may affect every layer.
+    ident = cache.hash_file(input_pcb)
+    if ident not in _board_items:
+        with open(input_pcb, "r", encoding="utf-8") as f:
+            items = sexpr.split_items(f.read())
+        _board_items[ident] = [ (get_item_layers(item), item) for item in items ]
+    return _board_items[ident]
+
+def hash_board_layers(input_pcb: str, layers: list[str]) -> str:
+    # Hashes only the parts of the board which can appear on a plot of the given layers.
+    digest = hashlib.sha256()
+    for item_layers, item in get_board_items(input_pcb):
+        if item_layers is None or any(layer_matches(pattern, layer) for pattern in item_layers for layer in layers):
+            digest.update(item.encode())
+    return digest.hexdigest()
+
+
+class PageCache(cache.FileCache):
+    # A persistent store of plotted pages, so that only the pages affected by a board change are plotted again.
+    # Pages are keyed on the board items drawn on the plotted layers, the plot arguments (excluding the output path),
+    # and any other inputs such as the project file.
+
+    def __init__(self, path: str, max_size: int, version: list[str]):
+        super().__init__(path, max_size, version, ".pdf")
+
+    def make_key(self, input_pcb: str, layers: list[str], args: list[str], inputs: list[str] = None) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": self.version,
+            "board": hash_board_layers(input_pcb, layers),
+            "inputs": cache.hash_inputs(inputs or []),
+            "args": cache.strip_output(args),
+        }).encode())
+        return digest.hexdigest()
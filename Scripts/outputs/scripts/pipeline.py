@@ -0,0 +1,258 @@
+import os, sys, threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from cache import OutputCache
+import tracing
+
+
+class Cancelled(Exception):
+    # Raised by a stage that was stopped because of a failure elsewhere.
+    # It is never raised from the pipeline in place of that failure.
+    pass
+
+class Stage():
+    # The inputs are the files the stage reads. They are hashed into the cache key, and used to select
+    # the stages to re-run when files change.
+    # A stage may be cached if it provides a key function. The key returns the arguments that
+    # determine the stage output (excluding the contents of the input files, which are hashed separately).
+    # The result of a cached stage must be json serialisable.
+    # A stage may also provide a commands function, which returns the kicad-cli commands it will run.
+    # These may be batched into a jobset ahead of the stage.
+    # Stages listed in after are run ahead of this stage whenever it runs, without depending on their results.
+    # So unlike depends, a change to their inputs does not cause this stage to be re-run.
+
+    def __init__(self, name: str, title: str, run: callable, depends: list[str] = None,
+                 inputs: list[str] = None, outputs: list[str] = None, key: callable = None,
+                 commands: callable = None, after: list[str] = None):
+        self.name = name
+        self.title = title
+        self.run = run
+        self.depends = depends or []
+        self.after = after or []
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.key = key
+        self.commands = commands
+        self.result = None
+        # The pipeline the stage was last added to, which is the one that runs it
+        self.pipeline = None
+        # Stages of a group (ie, one project of a batch) are stopped together when one of them fails
+        self.group = None
+
+    def __repr__(self):
+        return f"<stage {self.name}>"
+
+class StageOutput():
+    # Stands in for sys.stdout while the pipeline is running.
+    # Anything a stage prints is held until that stage completes, so the output of stages
+    # running at the same time does not get interleaved.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.buffer = []
+
+    def release(self) -> str:
+        text = "".join(self._local.buffer)
+        self._local.buffer = None
+        return text
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+def print_status(text: str):
+    # Prints immediately, even from within a running stage. This is for progress reports on long stages.
+    stream = sys.stdout.stream if isinstance(sys.stdout, StageOutput) else sys.stdout
+    stream.write(text + "\n")
+    stream.flush()
+
+class Pipeline():
+    def __init__(self, cache: OutputCache = None):
+        self.stages: dict[str, Stage] = {}
+        self.cache = cache
+        self.selected: set[str] | None = None
+        self.completed: set[str] = set()
+        self.failures: dict[str, BaseException] = {}
+
+    def add(self, stage: Stage) -> Stage:
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage \"{stage.name}\"")
+        for name in stage.depends + stage.after:
+            # Requiring dependencies to be added first also rules out cycles.
+            if name not in self.stages:
+                raise ValueError(f"Stage \"{stage.name}\" depends on unknown stage \"{name}\"")
+        self.stages[stage.name] = stage
+        stage.pipeline = self
+        return stage
+
+    def names(self) -> list[str]:
+        return list(self.stages.keys())
+
+    def result(self, name: str):
+        return self.stages[name].result
+
+    def is_cached(self, stage: Stage) -> bool:
+        if self.cache is None or stage.key is None:
+            return False
+        return self.cache.contains(self._make_key(stage))
+
+    def get_after(self, stage: Stage) -> list[Stage]:
+        # Returns the stages which are run after the given stage
+        return [ s for s in self.stages.values() if stage.name in s.after ]
+
+    def will_run(self, stage: Stage) -> bool:
+        # True if the stage is selected for the current run, and will not be restored from the cache
+        if self.selected is not None and stage.name not in self.selected:
+            return False
+        return not self.is_cached(stage)
+
+    def get_dependencies(self, names: list[str]) -> set[str]:
+        # Returns the named stages, along with all the stages they depend on
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending += self.stages[name].depends
+        return selected
+
+    def affected_by(self, paths: list[str]) -> set[str]:
+        # Returns the stages which read any of the given files, along with all the stages that depend on them.
+        paths = { os.path.abspath(path) for path in paths }
+        affected = set()
+        for stage in self.stages.values():
+            # Stages are added after their dependencies, so one pass is enough.
+            if any(os.path.abspath(path) in paths for path in stage.inputs) or any(name in affected for name in stage.depends):
+                affected.add(stage.name)
+        return affected
+
+    def keep_results(self, previous: "Pipeline"):
+        # Takes the results of stages from an earlier pipeline, for stages that are not re-run.
+        for name, stage in self.stages.items():
+            if name in previous.stages:
+                stage.result = previous.stages[name].result
+
+    def run(self, jobs: int = 1, only: set[str] = None):
+        # Runs the stages on a pool of at most `jobs` workers. A stage is started once all of its
+        # dependencies are done, in the order the stages were added.
+        # If only is given, just those stages and the stages they come after are run. The other stages are taken as done,
+        # keeping their last result.
+        # If a stage fails, no further stages are started. Running stages are allowed to finish,
+        # and then the first exception is raised. Stages cancelled by that failure do not replace it.
+        # If the stage is in a group, only the rest of its group is stopped, and the failure is left in self.failures.
+        # The stages which completed are left in self.completed.
+        jobs = max(jobs, 1)
+        self.selected = None
+        if only is not None:
+            self.selected = set(only) | { name for stage in self.stages.values() if stage.name in only for name in stage.after }
+        pending = [ stage for stage in self.stages.values() if self.selected is None or stage.name in self.selected ]
+        running = {}
+        done = set(self.stages.keys()) - { stage.name for stage in pending }
+        self.completed = set()
+        self.failures = {}
+        failure = None
+
+        output = StageOutput(sys.stdout)
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                while True:
+                    if failure is None:
+                        for stage in list(pending):
+                            if len(running) >= jobs:
+                                break
+                            if all(name in done for name in stage.depends + stage.after):
+                                pending.remove(stage)
+                                print(stage.title)
+                                running[executor.submit(self._run_stage, stage, output)] = stage
+
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        text, error = future.result()
+                        if stage.group is not None:
+                            text = "".join(f"{stage.group}: {line}" for line in text.splitlines(keepends=True))
+                        output.stream.write(text)
+                        if error is not None and stage.group is not None:
+                            previous = self.failures.get(stage.group)
+                            if previous is None or isinstance(previous, Cancelled):
+                                self.failures[stage.group] = error
+                            pending = [ s for s in pending if s.group != stage.group ]
+                        elif error is not None:
+                            if failure is None or isinstance(failure, Cancelled):
+                                failure = error
+                        else:
+                            done.add(stage.name)
+                            self.completed.add(stage.name)
+        finally:
+            sys.stdout = output.stream
+            self.selected = None
+
+        if failure is not None:
+            raise failure
+
+    def _make_key(self, stage: Stage) -> str:
+        # The output paths are part of the key, as they may not appear in the stage arguments.
+        return self.cache.make_key(stage.inputs, [stage.outputs, stage.key()])
+
+    def _run_stage(self, stage: Stage, output: StageOutput) -> tuple[str, BaseException]:
+        output.capture()
+        error = None
+        with tracing.span(stage.name, "stage") as span:
+            try:
+                stage.result = self._execute(stage, span)
+            except BaseException as e:
+                error = e
+            span.args["output_size"] = sum(tracing.get_output_size(path) for path in stage.outputs)
+        return output.release(), error
+
+    def _execute(self, stage: Stage, span: tracing.Span):
+        if self.cache is None or stage.key is None:
+            return stage.run()
+
+        key = self._make_key(stage)
+        entry = self.cache.restore(key, stage.outputs)
+        span.args["cached"] = entry is not None
+        if entry is not None:
+            print(f"Restored {stage.name} from cache")
+            return entry["result"]
+
+        result = stage.run()
+        self.cache.store(key, stage.outputs, result)
+        return result
+
+
+def interleave(pipelines: dict[str, Pipeline], cache: OutputCache = None) -> Pipeline:
+    # Combines the pipelines of several projects into one, so they share a single pool of workers.
+    # Stage names are prefixed with the project name, and the stages of each project form a group.
+    # Stages are taken from each project in turn, so the checks and fab outputs of every project are
+    # started ahead of the slower renders and animations of any one project.
+    # The stages are moved rather than copied, as stage functions read the results of other stages from their own pipeline.
+    combined = Pipeline(cache)
+    queues = [ (prefix, list(p.stages.values())) for prefix, p in pipelines.items() ]
+    while any(queue for _, queue in queues):
+        for prefix, queue in queues:
+            if queue:
+                stage = queue.pop(0)
+                stage.name = f"{prefix}/{stage.name}"
+                stage.title = f"{prefix}: {stage.title}"
+                stage.depends = [ f"{prefix}/{name}" for name in stage.depends ]
+                stage.after = [ f"{prefix}/{name}" for name in stage.after ]
+                stage.group = prefix
+                combined.add(stage)
+    return combined
@@ -0,0 +1,159 @@
+import json, hashlib, threading
+from typing import Iterable, Iterator
+import cache
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Reads the ERC and DRC reports written by kicad-cli.
+# Each violation is given a fingerprint from its type, sheet, and the description and position of its items.
+# The fingerprint stays the same from run to run while the violation remains, so violations can be compared
+# against a baseline, and only new violations are shown.
+# If ijson is installed, reports are read as a stream in a single pass, rather than loaded whole.
+
+# The lists of violations in a DRC report, by ijson prefix, and the section they are filed under
+DRC_SECTIONS = {
+    "schematic_parity.item":    "schematic_parity",
+    "unconnected_items.item":   "unconnected_items",
+    "violations.item":          "violations",
+}
+
+class Violation():
+    __slots__ = ["section", "sheet", "type", "severity", "description", "items", "fingerprint"]
+
+    def __init__(self, section: str, sheet: str, data: dict):
+        self.section = section
+        self.sheet = sheet
+        self.type = data.get("type", "")
+        self.severity = data.get("severity", "")
+        self.description = data.get("description", "")
+        self.items = [ get_item(item) for item in data.get("items", []) ]
+        # The item uuids are left out, as they are not kept when parts are re-annotated or footprints updated
+        key = repr((section, sheet, self.type, sorted(self.items)))
+        self.fingerprint = hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def __repr__(self):
+        return f"<violation {self.type}; {self.fingerprint}>"
+
+    def to_dict(self) -> dict:
+        return {
+            "section": self.section,
+            "sheet": self.sheet,
+            "type": self.type,
+            "severity": self.severity,
+            "description": self.description,
+            "items": self.items,
+        }
+
+def get_item(item: dict) -> tuple[str, float, float]:
+    pos = item.get("pos", {})
+    return (item.get("description", ""), round(float(pos.get("x", 0)), 3), round(float(pos.get("y", 0)), 3))
+
+def get_prefix(node, parts: list[str]) -> Iterator:
+    # Yields the values at an ijson style prefix within a loaded json document
+    if not parts:
+        yield node
+    elif parts[0] == "item":
+        for child in node if type(node) is list else []:
+            yield from get_prefix(child, parts[1:])
+    elif type(node) is dict and parts[0] in node:
+        yield from get_prefix(node[parts[0]], parts[1:])
+
+def iter_values(path: str, prefixes: Iterable[str]) -> Iterator[tuple[str, object]]:
+    # Yields the prefix and value of each json value at one of the prefixes, ie "violations.item", in the order they appear.
+    # With ijson, the file is read once as a stream of events, and only the value being built is held.
+    prefixes = set(prefixes)
+    if ijson is not None:
+        with open(path, "rb") as f:
+            builder = None
+            for prefix, event, value in ijson.parse(f, use_float=True):
+                if builder is not None:
+                    builder.event(event, value)
+                    # The value ends with the end event at its own prefix. Nested values have longer prefixes.
+                    if prefix == current and event in ("end_map", "end_array"):
+                        yield current, builder.value
+                        builder = None
+                elif prefix in prefixes:
+                    if event in ("start_map", "start_array"):
+                        builder = ijson.ObjectBuilder()
+                        builder.event(event, value)
+                        current = prefix
+                    elif event not in ("map_key", "end_map", "end_array"):
+                        yield prefix, value
+        return
+
+    with open(path, "r", encoding="utf-8") as f:
+        document = json.load(f)
+    for prefix in sorted(prefixes):
+        for value in get_prefix(document, prefix.split(".")):
+            yield prefix, value
+
+def index_violations(violations: Iterable[Violation]) -> dict[str, Violation]:
+    # Returns the violations by fingerprint. Repeats of a fingerprint are numbered in the order they appear.
+    index = {}
+    for violation in violations:
+        fingerprint = violation.fingerprint
+        count = 1
+        while fingerprint in index:
+            count += 1
+            fingerprint = f"{violation.fingerprint}-{count}"
+        violation.fingerprint = fingerprint
+        index[fingerprint] = violation
+    return index
+
+def load_erc(path: str) -> dict[str, Violation]:
+    # Sheets are built one at a time, as the sheet path is needed to tell instances of the same sheet apart
+    def iter_violations():
+        for _, sheet in iter_values(path, ["sheets.item"]):
+            for data in sheet.get("violations", []):
+                yield Violation("erc", sheet.get("path", "/"), data)
+    return index_violations(iter_violations())
+
+def load_drc(path: str) -> dict[str, Violation]:
+    return index_violations(Violation(DRC_SECTIONS[prefix], "", data) for prefix, data in iter_values(path, DRC_SECTIONS))
+
+def get_section(index: dict[str, Violation], section: str) -> list[Violation]:
+    return [ v for v in index.values() if v.section == section ]
+
+
+# The baseline file holds the accepted violations of each report, by fingerprint.
+# The ERC and DRC run in parallel, and share the file.
+_baseline_lock = threading.Lock()
+
+def read_baseline(path: str) -> dict[str, dict[str, dict]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def load_baseline(path: str, report: str) -> dict[str, dict]:
+    with _baseline_lock:
+        return read_baseline(path).get(report, {})
+
+def update_baseline(path: str, report: str, index: dict[str, Violation]):
+    with _baseline_lock:
+        baseline = read_baseline(path)
+        baseline[report] = { fingerprint: v.to_dict() for fingerprint, v in index.items() }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+class ReportCache(cache.FileCache):
+    # A persistent store of ERC and DRC reports, so the checks are not run again on an unchanged design.
+    # Reports are keyed on the input files and the check arguments (excluding the output path).
+
+    def __init__(self, path: str, max_size: int, version: list[str]):
+        super().__init__(path, max_size, version, ".json")
+
+    def make_key(self, inputs: list[str], args: list[str]) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": self.version,
+            "inputs": cache.hash_inputs(inputs),
+            "args": cache.strip_output(args),
+        }).encode())
+        return digest.hexdigest()
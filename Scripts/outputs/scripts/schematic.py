@@ -0,0 +1,159 @@
+import os, re, threading
+import sexpr, cache
+from bom import Component
+
+# Reads the BOM components straight from the .kicad_sch files, rather than through a python-bom export.
+# Symbols are resolved per sheet instance, so a sheet used more than once gives a component per instance.
+
+# Items of a schematic file that are needed. Everything else (wires, labels) is skipped unparsed.
+# lib_symbols is only scanned for the names of its units.
+SCHEMATIC_ITEMS = { "uuid", "symbol", "sheet", "symbol_instances" }
+
+# Properties which are not reported as fields
+COMPONENT_PROPERTIES = { "Reference", "Value" }
+
+LIB_SYMBOL_RE = re.compile(r'\(symbol\s+"((?:[^"\\]|\\.)*)"')
+UNIT_RE = re.compile(r'_(\d+)_\d+$')
+
+def get_unit_counts(lib_symbols: str) -> dict[str, int]:
+    # Returns the number of units of each library symbol. Each unit is drawn by a sub-symbol named
+    # <name>_<unit>_<style>, with unit 0 shared by all units. These are found by name, without parsing the symbols.
+    counts = {}
+    name = None
+    for match in LIB_SYMBOL_RE.finditer(lib_symbols):
+        symbol = match.group(1)
+        unit = UNIT_RE.search(symbol)
+        if name is not None and unit and symbol[:unit.start()] == name.split(":")[-1]:
+            counts[name] = max(counts[name], int(unit.group(1)))
+        else:
+            name = symbol
+            counts[name] = 1
+    return counts
+
+class SchematicFile():
+    def __init__(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if not text.lstrip().startswith("(kicad_sch"):
+            raise ValueError(f"\"{path}\" is not a KiCad schematic")
+
+        items = []
+        self.unit_counts = {}
+        for item in sexpr.split_items(text):
+            name = sexpr.get_name(item)
+            if name in SCHEMATIC_ITEMS:
+                items.append(sexpr.parse(item))
+            elif name == "lib_symbols":
+                self.unit_counts.update(get_unit_counts(item))
+        self.path = path
+        self.uuid = next((item[1] for item in items if item[0] == "uuid" and len(item) > 1), "")
+        self.symbols = [ item for item in items if item[0] == "symbol" ]
+        self.sheets = [ item for item in items if item[0] == "sheet" ]
+
+        # Schematics before KiCad 7 store the symbol references for all sheets in the root file
+        self.symbol_instances = {}
+        for item in items:
+            if item[0] == "symbol_instances":
+                for path in sexpr.find_all(item, "path"):
+                    self.symbol_instances[path[1]] = path
+
+_files = {}
+_files_lock = threading.Lock()
+
+def read_file(path: str) -> SchematicFile:
+    # Parsed files are remembered for the life of the process, keyed on their contents.
+    # In watch mode this means only the edited sheets are parsed again.
+    digest = cache.hash_file(path)
+    with _files_lock:
+        entry = _files.get(os.path.abspath(path))
+    if entry is not None and entry[0] == digest:
+        return entry[1]
+    schematic = SchematicFile(path)
+    with _files_lock:
+        _files[os.path.abspath(path)] = (digest, schematic)
+    return schematic
+
+def get_properties(node: list) -> dict[str, str]:
+    return { prop[1]: prop[2] for prop in sexpr.find_all(node, "property") if len(prop) > 2 }
+
+def get_sheet_file(sheet: list, parent: str) -> str | None:
+    properties = get_properties(sheet)
+    name = properties.get("Sheetfile", properties.get("Sheet file"))
+    if not name:
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(parent), name))
+
+def get_sheet_files(input_sch: str) -> list[str]:
+    # Returns the schematic and all of its sub-sheets
+    sheets = [input_sch]
+    for path in sheets:
+        for sheet in read_file(path).sheets:
+            sheet_path = get_sheet_file(sheet, path)
+            if sheet_path and sheet_path not in sheets and os.path.exists(sheet_path):
+                sheets.append(sheet_path)
+    return sheets
+
+def get_reference(symbol: list, sheet_path: str, legacy_path: str, root: SchematicFile) -> str | None:
+    # Returns the reference of a symbol on the given sheet instance. All units of a part share the same reference.
+    uuid = sexpr.get_value(symbol, "uuid", "")
+    instances = sexpr.find(symbol, "instances")
+    if instances is not None:
+        for project in sexpr.find_all(instances, "project"):
+            for path in sexpr.find_all(project, "path"):
+                if path[1] == sheet_path:
+                    return sexpr.get_value(path, "reference")
+
+    path = root.symbol_instances.get(f"{legacy_path}/{uuid}")
+    if path is not None:
+        return sexpr.get_value(path, "reference")
+
+    # Symbols without instance data use the reference they were drawn with
+    return get_properties(symbol).get("Reference")
+
+def is_multi_unit(symbol: list, schematic: SchematicFile) -> bool:
+    name = sexpr.get_value(symbol, "lib_name") or sexpr.get_value(symbol, "lib_id", "")
+    return schematic.unit_counts.get(name, 1) > 1
+
+def load_components(input_sch: str) -> list[Component]:
+    # Returns the components in the BOM, with the units of multi-unit symbols combined.
+    # As in kicad-cli, only the units of multi-unit symbols are combined by reference. Other symbols are kept by
+    # their sheet instance and uuid, so unannotated parts (ie, several R?) each give a component.
+    components = {}
+    root = read_file(input_sch)
+
+    def walk(schematic: SchematicFile, sheet_path: str, legacy_path: str, parents: list[str]):
+        for symbol in schematic.symbols:
+            if sexpr.get_value(symbol, "in_bom", "yes") != "yes":
+                continue
+            ref = get_reference(symbol, sheet_path, legacy_path, root)
+            # Power symbols and other virtual parts are hidden behind a '#'
+            if not ref or ref.startswith("#"):
+                continue
+
+            properties = get_properties(symbol)
+            dnp = sexpr.get_value(symbol, "dnp", "no") == "yes"
+            key = ref if is_multi_unit(symbol, schematic) else (sheet_path, sexpr.get_value(symbol, "uuid", ""))
+            component = components.get(key)
+            if component is None:
+                footprint = properties.get("Footprint", "")
+                if ':' in footprint:
+                    lib, footprint = footprint.split(':', maxsplit=1)
+                fields = { name: value for name, value in properties.items() if value and name not in COMPONENT_PROPERTIES }
+                components[key] = Component(ref, properties.get("Value", ""), footprint, 1, fields, not dnp)
+            else:
+                # Another unit of the same part. Fields missing from the first unit are filled in.
+                for name, value in properties.items():
+                    if value and name not in COMPONENT_PROPERTIES:
+                        component.fields.setdefault(name, value)
+                if dnp:
+                    component.fitted = False
+
+        for sheet in schematic.sheets:
+            path = get_sheet_file(sheet, schematic.path)
+            if path is None or path in parents:
+                continue
+            uuid = sexpr.get_value(sheet, "uuid", "")
+            walk(read_file(path), f"{sheet_path}/{uuid}", f"{legacy_path}/{uuid}", parents + [path])
+
+    walk(root, f"/{root.uuid}", "", [root.path])
+    return sorted(components.values(), key=lambda c: c.ref)
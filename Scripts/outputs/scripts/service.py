@@ -0,0 +1,395 @@
+import os, sys, io, json, time, uuid, glob, shutil, hashlib, tarfile, argparse, threading, subprocess, socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import output, batch, cache, schematic
+
+# A long running service which queues output jobs from everyone using the same machine, so that their
+# kicad-cli commands do not all run at once. Each job runs output.py in its own process and directory.
+# Jobs are started in the order they are submitted, while the number of kicad-cli commands and their
+# estimated memory fit within the limits. The caches are shared by all jobs.
+#
+#   POST /jobs                  {"input": "/path/to/board.kicad_pro", "args": ["--layers", "4"]}
+#   POST /jobs?arg=--layers&arg=4&input=board/board.kicad_pro
+#                               with a tar (or tar.gz) of the project as the body. The input is only needed
+#                               if the archive holds more than one project.
+#   GET  /jobs                  lists the jobs
+#   GET  /jobs/<id>?wait=60     returns the job, waiting up to 60 seconds for it to finish
+#
+# A job with the same input files and options as a job that is already queued or running is not run again.
+# The existing job is returned instead.
+# Usage: python3 scripts/service.py [--port 8765 | --socket /tmp/kicad-outputs.sock] [--dir .output-service]
+
+OUTPUT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output.py")
+
+# Options set by the service for each job, which cannot be given with the job
+SERVICE_OPTIONS = { "input", "manifest", "output", "jobs", "max_commands", "cache_dir", "trace", "watch", "wait_on_done" }
+
+# The longest a request may wait for a job to finish
+MAX_WAIT = 600
+
+class Job():
+    def __init__(self, id: str, key: str, directory: str, cwd: str, input_file: str, args: list[str], options: argparse.Namespace):
+        self.id = id
+        self.key = key
+        self.directory = directory
+        self.cwd = cwd
+        self.input_file = input_file
+        self.args = args
+        self.options = options
+        self.status = "queued"
+        self.error = None
+        self.bundles = []
+        self.slots = 0
+        self.memory = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return f"<job {self.id}>"
+
+    @property
+    def output_dir(self) -> str:
+        return os.path.join(self.directory, "outputs")
+
+    @property
+    def log_file(self) -> str:
+        return os.path.join(self.directory, "output.log")
+
+    @property
+    def trace_file(self) -> str:
+        return os.path.join(self.directory, "trace.json")
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "input": self.input_file + ".kicad_pro",
+            "args": self.args,
+            "error": self.error,
+            "bundles": self.bundles,
+            "outputs": self.output_dir,
+            "log": self.log_file,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+def parse_job_args(args: list[str]) -> argparse.Namespace:
+    # Parses the job options with the output.py argument parser, raising a ValueError rather than exiting
+    argparser = output.get_argparser()
+    def error(message: str):
+        raise ValueError(message)
+    argparser.error = error
+    # The service options are left out of the namespace unless they are given, so they are rejected even
+    # when given with their default value
+    for action in argparser._actions:
+        if action.dest in SERVICE_OPTIONS:
+            action.default = argparse.SUPPRESS
+    try:
+        options = argparser.parse_args(args)
+    except SystemExit:
+        raise ValueError("Invalid job arguments")
+    fixed = [ key for key in SERVICE_OPTIONS if hasattr(options, key) ]
+    if fixed:
+        raise ValueError(f"Options set by the service: {', '.join('--' + key.replace('_', '-') for key in sorted(fixed))}")
+    if options.update_baseline:
+        raise ValueError("--update-baseline cannot be used with the service")
+    return options
+
+def make_key(files: list[str], options: argparse.Namespace, extra: str = "") -> str:
+    # Identifies a job by the contents of its input files and its options
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "files": cache.hash_inputs(files),
+        "options": sorted((key, repr(value)) for key, value in vars(options).items()),
+        "extra": extra,
+    }).encode())
+    return digest.hexdigest()
+
+def get_project_files(input_file: str, options: argparse.Namespace, cwd: str) -> list[str]:
+    files = [input_file + ".kicad_pro", input_file + ".kicad_pcb"] + schematic.get_sheet_files(input_file + ".kicad_sch")
+    # A baseline need not exist yet, as output.py treats a missing one as empty
+    optional = [ os.path.join(cwd, path) for path in [options.variants, options.baseline] if path ]
+    return files + [ path for path in optional if os.path.exists(path) ]
+
+def extract_project(data: bytes, path: str):
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(path, filter="data")
+            return
+        # Without extraction filters, only plain files and directories within the path are extracted
+        root = os.path.realpath(path)
+        for member in tar.getmembers():
+            target = os.path.realpath(os.path.join(path, member.name))
+            if not (member.isfile() or member.isdir()) or os.path.commonpath([root, target]) != root:
+                raise ValueError(f"Unsafe archive member \"{member.name}\"")
+        tar.extractall(path)
+
+
+class JobQueue():
+    def __init__(self, directory: str, jobs: int, max_commands: int, max_memory: int = None, command_memory: int = 1000000000,
+                 cache_dir: str = None, keep: int = 50):
+        self.directory = directory
+        self.jobs_per_job = max(1, min(jobs, max_commands))
+        self.max_commands = max_commands
+        self.max_memory = max_memory
+        self.command_memory = command_memory
+        self.observed_memory = 0
+        self.cache_dir = cache_dir or os.path.join(directory, "cache")
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.jobs: dict[str, Job] = {}
+        # Queued and running jobs, by key
+        self.active: dict[str, Job] = {}
+        self.queue: list[Job] = []
+        self.commands = 0
+        self.memory = 0
+        os.makedirs(os.path.join(directory, "jobs"), exist_ok=True)
+
+    def new_job_dir(self) -> tuple[str, str]:
+        id = uuid.uuid4().hex[:12]
+        path = os.path.join(self.directory, "jobs", id)
+        os.makedirs(path)
+        return id, path
+
+    def find(self, key: str) -> Job | None:
+        with self.lock:
+            return self.active.get(key)
+
+    def submit(self, job: Job) -> tuple[Job, bool]:
+        # Queues the job, unless an identical job is queued or running. Returns the job and whether it is new.
+        with self.lock:
+            existing = self.active.get(job.key)
+            if existing is not None:
+                shutil.rmtree(job.directory, ignore_errors=True)
+                return existing, False
+            self.jobs[job.id] = job
+            self.active[job.key] = job
+            self.queue.append(job)
+            print(f"Queued job {job.id} for {job.input_file}")
+            self._schedule()
+        return job, True
+
+    def get_command_memory(self) -> int:
+        # The largest peak memory seen from a kicad-cli command, or the default until one has been seen
+        return self.observed_memory or self.command_memory
+
+    def _schedule(self):
+        # Starts queued jobs in order while they fit in the limits. A job is always started if nothing else is
+        # running, so a job larger than the limits still runs.
+        while self.queue:
+            job = self.queue[0]
+            slots = self.jobs_per_job
+            memory = slots * self.get_command_memory()
+            if self.commands and self.commands + slots > self.max_commands:
+                break
+            if self.memory and self.max_memory and self.memory + memory > self.max_memory:
+                break
+            self.queue.pop(0)
+            job.slots = slots
+            job.memory = memory
+            self.commands += slots
+            self.memory += memory
+            job.status = "running"
+            job.started = time.time()
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job: Job):
+        print(f"Started job {job.id} with {job.slots} commands")
+        # The service options go last, so they take precedence over anything in the job arguments
+        command = [ sys.executable, OUTPUT_SCRIPT ] + job.args + [
+            "--input", job.input_file + ".kicad_pro",
+            "--output", job.output_dir,
+            "--jobs", str(job.slots),
+            "--max-commands", str(job.slots),
+            "--cache-dir", self.cache_dir,
+            "--trace", job.trace_file,
+        ]
+        try:
+            with open(job.log_file, "w") as log:
+                returncode = subprocess.run(command, cwd=job.cwd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT).returncode
+            if returncode != 0:
+                job.error = f"output.py failed with code {returncode}. See {job.log_file}"
+        except OSError as e:
+            job.error = str(e)
+
+        job.bundles = sorted(glob.glob(os.path.join(job.output_dir, f"*.{job.options.compression}")))
+        peak = self.read_peak_memory(job.trace_file)
+        with self.lock:
+            job.status = "failed" if job.error else "done"
+            job.finished = time.time()
+            self.observed_memory = max(self.observed_memory, peak)
+            self.commands -= job.slots
+            self.memory -= job.memory
+            del self.active[job.key]
+            self._prune()
+            self._schedule()
+        print(f"Job {job.id} {job.status} in {job.finished - job.started:.1f}s")
+        job.done.set()
+
+    def read_peak_memory(self, trace_file: str) -> int:
+        try:
+            with open(trace_file, "r") as f:
+                events = json.load(f)["traceEvents"]
+        except (OSError, ValueError, KeyError):
+            return 0
+        return max([ e["args"].get("max_rss", 0) for e in events if e["cat"] == "command" ], default=0)
+
+    def _prune(self):
+        # Removes the oldest finished jobs beyond the number to keep
+        finished = sorted((j for j in self.jobs.values() if j.finished is not None), key=lambda j: j.finished)
+        for job in finished[:max(len(finished) - self.keep, 0)]:
+            shutil.rmtree(job.directory, ignore_errors=True)
+            del self.jobs[job.id]
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = f"KicadOutputs/{output.SCRIPT_VERSION}"
+
+    def send_json(self, code: int, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def do_GET(self):
+        queue: JobQueue = self.server.queue
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            with queue.lock:
+                jobs = list(queue.jobs.values())
+            self.send_json(200, [ job.to_dict() for job in jobs ])
+            return
+        job = None
+        if len(parts) == 2 and parts[0] == "jobs":
+            # Looked up under the lock, as finished jobs may be pruned at any time
+            with queue.lock:
+                job = queue.jobs.get(parts[1])
+        if job is not None:
+            wait = parse_qs(url.query).get("wait", ["0"])[0]
+            if not wait.replace(".", "", 1).isdigit():
+                self.send_json(400, { "error": "wait must be a number of seconds" })
+                return
+            job.done.wait(min(float(wait), MAX_WAIT))
+            self.send_json(200, job.to_dict())
+        else:
+            self.send_json(404, { "error": "Not found" })
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.strip("/") != "jobs":
+            self.send_json(404, { "error": "Not found" })
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > self.server.max_upload:
+            self.send_json(413, { "error": "Upload too large" })
+            return
+        body = self.rfile.read(length)
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                job, new = self.submit_path(json.loads(body))
+            else:
+                job, new = self.submit_upload(body, parse_qs(url.query))
+        except (ValueError, OSError, tarfile.TarError) as e:
+            self.send_json(400, { "error": str(e) })
+            return
+        self.send_json(202 if new else 200, dict(job.to_dict(), duplicate=not new))
+
+    def submit_path(self, request: dict) -> tuple[Job, bool]:
+        # A project on this machine. The job runs in the project directory, so relative paths in its options
+        # are taken from there, as they would be when running output.py by hand.
+        if "input" not in request:
+            raise ValueError("No input given")
+        args = [ str(arg) for arg in request.get("args", []) ]
+        options = parse_job_args(args)
+        files = batch.find_files(os.path.abspath(request["input"]))
+        if len(files) > 1:
+            raise ValueError(f"Multiple files match \"{request['input']}\"")
+        input_file = files[0]
+        cwd = os.path.dirname(input_file)
+        key = make_key(get_project_files(input_file, options, cwd), options)
+
+        queue: JobQueue = self.server.queue
+        existing = queue.find(key)
+        if existing is not None:
+            return existing, False
+        id, directory = queue.new_job_dir()
+        return queue.submit(Job(id, key, directory, cwd, input_file, args, options))
+
+    def submit_upload(self, data: bytes, query: dict) -> tuple[Job, bool]:
+        # A tar of a project, which is extracted into the job directory
+        args = query.get("arg", [])
+        options = parse_job_args(args)
+        pattern = query.get("input", [None])[0]
+        key = make_key([], options, hashlib.sha256(data).hexdigest() + (pattern or ""))
+
+        queue: JobQueue = self.server.queue
+        existing = queue.find(key)
+        if existing is not None:
+            return existing, False
+        id, directory = queue.new_job_dir()
+        try:
+            project_dir = os.path.join(directory, "project")
+            extract_project(data, project_dir)
+            if pattern:
+                files = batch.find_files(os.path.join(project_dir, pattern))
+            else:
+                files = [ os.path.splitext(path)[0] for path in glob.glob(os.path.join(project_dir, "**", "*.kicad_pro"), recursive=True) ]
+            if len(files) != 1:
+                raise ValueError(f"Found {len(files)} projects in the upload. Choose one with the input parameter.")
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return queue.submit(Job(id, key, directory, os.path.dirname(files[0]), files[0], args, options))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Local service that queues output jobs for kicad projects")
+    argparser.add_argument("--port", type=int, help="Port to listen on, on localhost only", default=8765)
+    argparser.add_argument("--socket", type=str, help="Unix socket to listen on, rather than a port", default=None)
+    argparser.add_argument("--dir", type=str, help="Directory for the jobs and the shared caches", default=".output-service")
+    argparser.add_argument("--jobs", "-j", type=int, help="Number of stages each job runs in parallel", default=max(1, (os.cpu_count() or 1) // 2))
+    argparser.add_argument("--max-commands", type=int, help="Maximum number of kicad-cli commands running across all jobs", default=os.cpu_count() or 1)
+    argparser.add_argument("--max-memory", type=int, help="Maximum memory in MB for the commands of all running jobs. Each command is estimated to use the most memory seen from one so far.", default=None)
+    argparser.add_argument("--command-memory", type=int, help="Estimated memory in MB of a kicad-cli command, until one has been measured", default=1000)
+    argparser.add_argument("--cache-dir", type=str, help="Cache directory shared by the jobs", default=None)
+    argparser.add_argument("--keep-jobs", type=int, help="Number of finished jobs to keep the outputs of", default=50)
+    argparser.add_argument("--max-upload", type=int, help="Maximum size in MB of an uploaded project", default=500)
+    args = argparser.parse_args()
+
+    directory = os.path.abspath(args.dir)
+    queue = JobQueue(directory, args.jobs, args.max_commands, args.max_memory * 1000000 if args.max_memory else None,
+                     args.command_memory * 1000000, os.path.abspath(args.cache_dir) if args.cache_dir else None, args.keep_jobs)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+        address = f"http://127.0.0.1:{args.port}"
+    server.queue = queue
+    server.max_upload = args.max_upload * 1000000
+
+    print(f"Output service {output.SCRIPT_VERSION} listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
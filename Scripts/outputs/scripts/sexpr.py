@@ -0,0 +1,73 @@
+import re
+
+# Minimal helpers for the s-expression files KiCad writes (.kicad_pcb, .kicad_sch).
+
+TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[()]')
+NAME_RE = re.compile(r'\(\s*([^\s()"]+)')
+
+def split_items(text: str) -> list[str]:
+    # Returns the text of each item directly within the root list.
+    items = []
+    depth = 0
+    start = 0
+    for match in TOKEN_RE.finditer(text):
+        token = match.group()
+        if token == "(":
+            depth += 1
+            if depth == 2:
+                start = match.start()
+        elif token == ")":
+            if depth == 2:
+                items.append(text[start:match.end()])
+            depth -= 1
+    return items
+
+def get_name(item: str) -> str | None:
+    match = NAME_RE.match(item)
+    return match.group(1) if match else None
+
+PARSE_RE = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+ESCAPE_RE = re.compile(r'\\(.)')
+ESCAPES = { "n": "\n", "t": "\t" }
+
+def unescape(text: str) -> str:
+    if "\\" not in text:
+        return text
+    return ESCAPE_RE.sub(lambda m: ESCAPES.get(m.group(1), m.group(1)), text)
+
+def parse(text: str) -> list:
+    # Parses a single s-expression into nested lists. Strings and atoms are both returned as str.
+    stack = [[]]
+    for opening, closing, string, atom in PARSE_RE.findall(text):
+        if opening:
+            node = []
+            stack[-1].append(node)
+            stack.append(node)
+        elif closing:
+            if len(stack) == 1:
+                raise ValueError("Unbalanced s-expression")
+            stack.pop()
+        elif atom:
+            stack[-1].append(atom)
+        else:
+            stack[-1].append(unescape(string))
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError("Expected a single s-expression")
+    return stack[0][0]
+
+def find(node: list, name: str) -> list | None:
+    # Returns the first child list with the given name
+    for child in node:
+        if type(child) is list and child and child[0] == name:
+            return child
+    return None
+
+def find_all(node: list, name: str) -> list[list]:
+    return [ child for child in node if type(child) is list and child and child[0] == name ]
+
+def get_value(node: list, name: str, default: str = None) -> str | None:
+    # Returns the first value of the named child, ie "10k" for (value "10k")
+    child = find(node, name)
+    if child is None or len(child) < 2:
+        return default
+    return child[1]
@@ -0,0 +1,154 @@
+import os, sys, time, json, threading, subprocess, contextlib, contextvars
+from concurrent.futures import Executor, Future
+
+# Records how long each stage and command takes, along with the CPU time and peak memory of each child process.
+# Spans are kept for the life of the process, and can be printed as a summary or written as a Chrome trace
+# (which can be opened in chrome://tracing or https://ui.perfetto.dev).
+
+class Span():
+    def __init__(self, name: str, category: str, stage: str = None, args: dict = None):
+        self.name = name
+        self.category = category
+        self.stage = stage
+        self.args = args or {}
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+_spans = []
+_spans_lock = threading.Lock()
+_origin = time.perf_counter()
+
+# The stage running in the current context. Pools started within a stage should use submit(), so this is carried over.
+_current_stage = contextvars.ContextVar("stage", default=None)
+
+@contextlib.contextmanager
+def span(name: str, category: str, args: dict = None):
+    s = Span(name, category, _current_stage.get(), args)
+    token = _current_stage.set(name) if category == "stage" else None
+    try:
+        yield s
+    finally:
+        s.end = time.perf_counter()
+        if token is not None:
+            _current_stage.reset(token)
+        with _spans_lock:
+            _spans.append(s)
+
+def clear():
+    with _spans_lock:
+        _spans.clear()
+
+def submit(executor: Executor, fn: callable, *args, **kwargs) -> Future:
+    # Submits a task to the executor, keeping track of the stage it was submitted from
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def get_spans(category: str = None) -> list[Span]:
+    with _spans_lock:
+        return [ s for s in _spans if category is None or s.category == category ]
+
+def get_output_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(get_output_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def get_max_rss(usage) -> int:
+    # ru_maxrss is in KB, except on macOS where it is in bytes.
+    # On Linux this includes the memory of this process when the child was forked, so small commands all
+    # report about the same size. It is only meaningful for commands that use more than that, ie renders.
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+def wait_process(process: subprocess.Popen, s: Span) -> tuple[int, bytes, bytes]:
+    # Waits for a process started with piped output, recording its CPU time and peak memory on the span.
+    # wait4 gives the usage of just this child, even while other commands are running in parallel.
+    # It is not available on Windows, where only the wall time is recorded.
+    if not hasattr(os, "wait4"):
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout, stderr
+
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    reader.start()
+    stdout = process.stdout.read()
+    reader.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Popen has already reaped the process, which it may do when the process is terminated
+        return process.wait(), stdout, stderr[0]
+    process.returncode = os.waitstatus_to_exitcode(status)
+    s.args["cpu"] = usage.ru_utime + usage.ru_stime
+    s.args["max_rss"] = get_max_rss(usage)
+    return process.returncode, stdout, stderr[0]
+
+
+def format_size(size: int | None) -> str:
+    if size is None:
+        return "-"
+    for unit in ["B", "KB", "MB"]:
+        if size < 1000:
+            return f"{size:.0f}{unit}"
+        size /= 1000
+    return f"{size:.1f}GB"
+
+def format_time(seconds: float | None) -> str:
+    return "-" if seconds is None else f"{seconds:.2f}s"
+
+def print_table(header: list[str], rows: list[list[str]]):
+    # The first column is left aligned, and the rest right aligned
+    widths = [ max(len(row[i]) for row in rows + [header]) for i in range(len(header)) ]
+    for row in [header] + rows:
+        print("  ".join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(row, widths))))
+
+def print_summary():
+    # Prints a line per stage, with the totals of the commands it ran
+    stages = get_spans("stage")
+    if not stages:
+        return
+    commands = get_spans("command")
+
+    rows = []
+    for stage in sorted(stages, key=lambda s: s.start):
+        stage_commands = [ c for c in commands if c.stage == stage.name ]
+        cpu = [ c.args["cpu"] for c in stage_commands if "cpu" in c.args ]
+        rss = [ c.args["max_rss"] for c in stage_commands if "max_rss" in c.args ]
+        rows.append([
+            stage.name + (" (cached)" if stage.args.get("cached") else ""),
+            format_time(stage.duration),
+            str(len(stage_commands)),
+            format_time(sum(cpu) if cpu else None),
+            format_size(max(rss) if rss else None),
+            format_size(stage.args.get("output_size")),
+        ])
+
+    print_table(["Stage", "Time", "Commands", "CPU", "Peak RSS", "Output"], rows)
+    wall = max(s.end for s in stages) - min(s.start for s in stages)
+    busy = sum(s.duration for s in stages)
+    print(f"Total {format_time(wall)} ({format_time(busy)} of stage time)")
+
+def write_chrome_trace(path: str):
+    # Writes the spans in the Chrome trace event format
+    spans = get_spans()
+    threads = {}
+    events = []
+    for s in sorted(spans, key=lambda s: s.start):
+        tid = threads.setdefault(s.thread, len(threads) + 1)
+        events.append({
+            "name": s.name,
+            "cat": s.category,
+            "ph": "X",
+            "ts": round((s.start - _origin) * 1e6),
+            "dur": round(s.duration * 1e6),
+            "pid": 1,
+            "tid": tid,
+            "args": dict(s.args, stage=s.stage) if s.stage else s.args,
+        })
+    with open(path, "w") as f:
+        json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f, indent=1)
@@ -0,0 +1,63 @@
+import re, json
+from bom import Component
+
+# Assembly variants are defined in a json file, ie:
+# {
+#     "variants": {
+#         "full": {},
+#         "lite": { "dnp": ["U3", "J2"] },
+#         "proto": { "fit": ["R10"], "fields": ["MPN"] }
+#     }
+# }
+# "dnp" lists parts which are not fitted, in addition to those marked DNP in the schematic.
+# "fit" lists parts which are fitted, even though they are marked DNP in the schematic.
+# "fields" lists the BOM fields, ie the supplier part number. This defaults to the fields for --format.
+
+VARIANT_KEYS = { "dnp", "fit", "fields" }
+NAME_RE = re.compile(r'^[A-Za-z0-9_\-]+$')
+
+class Variant():
+    def __init__(self, name: str = None, dnp: list[str] = None, fit: list[str] = None, fields: list[str] = None):
+        self.name = name
+        self.dnp = set(dnp or [])
+        self.fit = set(fit or [])
+        self.fields = fields
+
+    def __repr__(self):
+        return f"<variant {self.name}>"
+
+    def is_fitted(self, component: Component) -> bool:
+        if component.ref in self.dnp:
+            return False
+        if component.ref in self.fit:
+            return True
+        return component.fitted
+
+    def apply(self, components: list[Component]) -> list[Component]:
+        # Returns the components with their fitting changed to suit this variant
+        result = []
+        for c in components:
+            fitted = self.is_fitted(c)
+            result.append(c if fitted == c.fitted else Component(c.ref, c.value, c.footprint, c.quantity, c.fields, fitted))
+        return result
+
+    def get_unknown_refs(self, components: list[Component]) -> list[str]:
+        refs = { c.ref for c in components }
+        return sorted((self.dnp | self.fit) - refs)
+
+def load_variants(path: str, fields: list[str] = []) -> list[Variant]:
+    with open(path, "r") as f:
+        config = json.load(f)
+
+    variants = []
+    for name, definition in config.get("variants", {}).items():
+        if not NAME_RE.match(name):
+            raise ValueError(f"Variant name \"{name}\" may only contain letters, numbers, '-' and '_'")
+        unknown = set(definition) - VARIANT_KEYS
+        if unknown:
+            raise ValueError(f"Unknown options for variant \"{name}\": {', '.join(sorted(unknown))}")
+        variants.append(Variant(name, definition.get("dnp"), definition.get("fit"), definition.get("fields", fields)))
+
+    if not variants:
+        raise ValueError(f"No variants defined in \"{path}\"")
+    return variants
@@ -0,0 +1,52 @@
+import os, time
+
+# Polls a set of files for changes. Polling is used rather than file system events, as it needs no extra
+# packages and behaves the same on every platform. Only a handful of project files are watched, so it is cheap.
+
+class FileWatcher():
+    def __init__(self, paths: list[str], interval: float = 0.5, settle: float = 0.5):
+        self.interval = interval
+        self.settle = settle
+        self.watch(paths)
+
+    def watch(self, paths: list[str]):
+        # Sets the files to watch. Files that were already watched keep their last seen state, so a change
+        # made since then is still picked up. New files are taken as they are now.
+        previous = getattr(self, "state", {})
+        self.paths = list(dict.fromkeys(paths))
+        current = self.snapshot()
+        self.state = { path: previous.get(path, current[path]) for path in self.paths }
+
+    def snapshot(self) -> dict[str, tuple[int, int] | None]:
+        state = {}
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                state[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                state[path] = None
+        return state
+
+    def wait(self) -> list[str]:
+        # Blocks until any of the files change. KiCad writes several files when saving, and a file may be
+        # briefly missing while it is replaced, so this waits until nothing has changed for the settle time.
+        # Returns the files that changed.
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            if current == self.state:
+                continue
+
+            settled_at = time.monotonic()
+            while time.monotonic() - settled_at < self.settle:
+                time.sleep(min(self.interval, self.settle))
+                latest = self.snapshot()
+                if latest != current:
+                    current = latest
+                    settled_at = time.monotonic()
+
+            changed = [ path for path in self.paths if current[path] != self.state[path] ]
+            self.state = current
+            # A file may have been created and removed again while settling
+            if changed:
+                return changed
@@ -0,0 +1,5 @@
+import os, sys
+
+# The scripts are run directly rather than installed, so the tests import them from the scripts directory
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
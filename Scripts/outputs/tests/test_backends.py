@@ -0,0 +1,38 @@
+import os
+import backends
+
+
+def test_lookup_is_kept_until_the_directories_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(backends, "_probes", {})
+    monkeypatch.setattr(backends, "_search_idents", {})
+    probe_file = str(tmp_path / "probes.json")
+    monkeypatch.setattr(backends, "_probe_file", probe_file)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+
+    calls = []
+    def find():
+        calls.append(1)
+        return (bin_dir / "tool").exists()
+
+    assert backends.lookup("tool", [str(bin_dir)], find) is False
+    assert backends.lookup("tool", [str(bin_dir)], find) is False
+    assert len(calls) == 1
+
+    # A later run reads the result from the probe file
+    monkeypatch.setattr(backends, "_probes", {})
+    monkeypatch.setattr(backends, "_search_idents", {})
+    backends.set_probe_file(probe_file)
+    assert backends.lookup("tool", [str(bin_dir)], find) is False
+    assert len(calls) == 1
+
+    # Installing the tool changes the directory, so it is looked for again
+    (bin_dir / "tool").write_text("")
+    os.utime(bin_dir, ns=(0, os.stat(bin_dir).st_mtime_ns + 1000000))
+    monkeypatch.setattr(backends, "_search_idents", {})
+    assert backends.lookup("tool", [str(bin_dir)], find) is True
+    assert len(calls) == 2
+
+def test_lazy_module_is_imported_on_first_use():
+    module = backends.LazyModule("json")
+    assert module.dumps([1]) == "[1]"
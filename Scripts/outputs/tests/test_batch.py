@@ -0,0 +1,45 @@
+import os, json
+import pytest
+import batch, output
+
+
+@pytest.fixture
+def projects(tmp_path):
+    for name in ["alpha", "beta"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / f"{name}.kicad_pro").write_text("")
+    return tmp_path
+
+def parse_args(args: list[str] = []):
+    return output.get_argparser().parse_args(args)
+
+def write_manifest(path, projects: list[dict]) -> str:
+    path.write_text(json.dumps({ "projects": projects }))
+    return str(path)
+
+def test_manifest_options_and_paths(projects):
+    manifest = write_manifest(projects / "boards.json", [
+        { "input": "alpha/*.kicad_pro", "layers": 4 },
+        { "input": "beta/beta.kicad_pro", "name": "beta-v2", "baseline": "beta/baseline.json" },
+    ])
+    alpha, beta = batch.load_manifest(manifest, parse_args())
+    assert alpha.name == "alpha" and alpha.args.layers == 4
+    assert beta.name == "beta-v2" and beta.args.layers == 2
+    assert beta.args.baseline == os.path.join(str(projects), "beta/baseline.json")
+    assert alpha.input_file == os.path.join(str(projects), "alpha", "alpha")
+
+@pytest.mark.parametrize("option", [ { "jobs": 2 }, { "output": "elsewhere" }, { "stages": "bom" }, { "no-such-option": 1 } ])
+def test_manifest_rejects_options(projects, option):
+    manifest = write_manifest(projects / "boards.json", [ dict({ "input": "alpha/*.kicad_pro" }, **option) ])
+    with pytest.raises(ValueError, match="cannot be set"):
+        batch.load_manifest(manifest, parse_args())
+
+def test_name_needs_one_project(projects):
+    patterns = [ str(projects / "*" / "*.kicad_pro") ]
+    with pytest.raises(ValueError, match="--name"):
+        batch.find_projects(patterns, parse_args(["--name", "board"]))
+    assert [ p.name for p in batch.find_projects(patterns, parse_args()) ] == ["alpha", "beta"]
+
+def test_missing_input(projects):
+    with pytest.raises(FileNotFoundError):
+        batch.find_projects([ str(projects / "gamma" / "*.kicad_pro") ], parse_args())
@@ -0,0 +1,36 @@
+import bom
+
+
+def part(ref: str, value: str = "10k", footprint: str = "R_0402", **fields) -> bom.Component:
+    return bom.Component(ref, value, footprint, 1, fields)
+
+def group(parts: list[bom.Component], check_fields: list[str] = []) -> bom.GroupIndex:
+    index = bom.GroupIndex(bom.DEFAULT_GROUP_KEYS, check_fields)
+    for p in parts:
+        index.add(p)
+    return index
+
+def test_first_value_wins():
+    # The first part of a group sets each field. Later parts only fill in fields it was missing.
+    index = group([ part("R2", MPN="A"), part("R10", MPN="B", Note="later"), part("R1", MPN="C") ])
+    [ g ] = index.get_components()
+    assert g.fields == { "MPN": "A", "Note": "later" }
+    assert g.ref == "R1,R2,R10"
+    assert g.quantity == 3
+
+def test_conflicts_compare_all_fields():
+    # A part lacking a field the first part had, or having one the first part lacked, is a conflict
+    index = group([ part("R1", MPN="A"), part("R2"), part("R3", MPN="A") ], ["MPN"])
+    assert index.get_conflicts() == [ "MPN differs between parts grouped as R_0402 10k: \"A\" (R1), \"\" (R2)" ]
+    index = group([ part("C1", LCSC="C1525"), part("C2", LCSC="C1525") ], ["LCSC"])
+    assert index.get_conflicts() == []
+    index = group([ part("C1"), part("C2", LCSC="C1525") ], ["LCSC"])
+    assert index.get_conflicts() == [ "LCSC differs between parts grouped as R_0402 10k: \"\" (C1), \"C1525\" (C2)" ]
+
+def test_unchecked_fields_are_not_conflicts():
+    index = group([ part("R1", MPN="A"), part("R2", MPN="B") ], ["LCSC"])
+    assert index.get_conflicts() == []
+
+def test_ranges():
+    refs = [ "R1", "R2", "R3", "R5", "R10", "R11", "C1" ]
+    assert bom.compress_refs(sorted(refs, key=bom.natural_key)) == [ "C1", "R1-R3", "R5", "R10", "R11" ]
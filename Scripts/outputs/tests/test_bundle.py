@@ -0,0 +1,66 @@
+import os, tarfile, zipfile
+import pytest
+import bundle
+
+FILES = {
+    "board.png": bytes(range(256)) * 4,
+    "board.csv": b"Designator,Value\n" * 200,
+    "Gerber/board-F_Cu.gbr": b"G04 copper*\n" * 100,
+    "Gerber/board-B_Cu.gbr": b"G04 copper*\n" * 50,
+    "Gerber/drill/board.drl": b"M48\n",
+}
+
+def make_tree(path, mtime: int):
+    # The files are written in reverse order, so the directory listing order differs between trees
+    for name, data in reversed(list(FILES.items())):
+        file = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, "wb") as f:
+            f.write(data)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.utime(os.path.join(root, name), (mtime, mtime))
+    return str(path)
+
+@pytest.mark.parametrize("extn", ["zip", "tar.gz"])
+def test_archives_are_reproducible(tmp_path, extn):
+    archives = []
+    for i, (mtime, jobs) in enumerate([(1000000000, 1), (1600000000, 4)]):
+        tree = make_tree(tmp_path / f"tree{i}", mtime)
+        output_file = str(tmp_path / f"out{i}.{extn}")
+        bundle.bundle(tree, output_file, jobs=jobs)
+        with open(output_file, "rb") as f:
+            archives.append(f.read())
+    assert archives[0] == archives[1]
+
+def test_zip_reads_back(tmp_path):
+    tree = make_tree(tmp_path / "tree", 1000000000)
+    output_file = str(tmp_path / "out.zip")
+    release_file = str(tmp_path / "release.zip")
+    bundle.bundle_all(tree, [(output_file, None), (release_file, ["Gerber"])], jobs=2)
+
+    with zipfile.ZipFile(output_file) as z:
+        assert z.testzip() is None
+        assert { name for name in z.namelist() if not name.endswith("/") } == set(FILES)
+        for name, data in FILES.items():
+            assert z.read(name) == data
+        # Already compressed files are stored
+        assert z.getinfo("board.png").compress_type == zipfile.ZIP_STORED
+        assert z.getinfo("board.csv").compress_type == zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(release_file) as z:
+        assert z.testzip() is None
+        assert { name for name in z.namelist() if not name.endswith("/") } == { name for name in FILES if name.startswith("Gerber/") }
+
+def test_tar_reads_back(tmp_path):
+    tree = make_tree(tmp_path / "tree", 1000000000)
+    output_file = str(tmp_path / "out.tar.gz")
+    bundle.bundle(tree, output_file, jobs=2)
+
+    with tarfile.open(output_file, "r:gz") as tar:
+        members = tar.getmembers()
+        assert { m.name for m in members if m.isfile() } == set(FILES)
+        assert { m.name for m in members if m.isdir() } == { "Gerber", "Gerber/drill" }
+        for m in members:
+            assert m.mtime == bundle.get_timestamp()
+            if m.isfile():
+                assert tar.extractfile(m).read() == FILES[m.name]
@@ -0,0 +1,80 @@
+import os
+import cache, pipeline
+
+
+def write(path, text: str) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+def read(path) -> str:
+    with open(path, "r") as f:
+        return f.read()
+
+def test_restore_outputs(tmp_path):
+    outputs = cache.OutputCache(str(tmp_path / "cache"), 1000000, ["1"])
+    board = write(tmp_path / "board.kicad_pcb", "board")
+    gerbers = tmp_path / "out" / "gerbers"
+    bom = write(tmp_path / "out" / "bom.csv", "R1,10k")
+    write(gerbers / "F_Cu.gbr", "copper")
+
+    key = outputs.make_key([board], ["gerbers"])
+    outputs.store(key, [str(gerbers), bom], {"count": 1})
+    os.remove(bom)
+    os.remove(gerbers / "F_Cu.gbr")
+
+    entry = outputs.restore(key, [str(gerbers), bom])
+    assert entry["result"] == {"count": 1}
+    assert read(bom) == "R1,10k"
+    assert read(gerbers / "F_Cu.gbr") == "copper"
+
+def test_key_follows_inputs(tmp_path):
+    outputs = cache.OutputCache(str(tmp_path / "cache"), 1000000, ["1"])
+    board = write(tmp_path / "board.kicad_pcb", "board")
+    key = outputs.make_key([board], ["gerbers"])
+    assert outputs.make_key([board], ["drill"]) != key
+    assert cache.OutputCache(str(tmp_path / "cache"), 1000000, ["2"]).make_key([board], ["gerbers"]) != key
+    write(tmp_path / "board.kicad_pcb", "changed")
+    os.utime(board, ns=(1, 1))
+    assert outputs.make_key([board], ["gerbers"]) != key
+
+def test_incomplete_outputs_are_not_stored(tmp_path):
+    outputs = cache.OutputCache(str(tmp_path / "cache"), 1000000, ["1"])
+    bom = write(tmp_path / "bom.csv", "R1,10k")
+    outputs.store("key", [bom, str(tmp_path / "missing.pdf")])
+    assert not outputs.contains("key")
+    assert outputs.restore("key", [bom]) is None
+
+def test_evicts_least_recently_used(tmp_path):
+    outputs = cache.OutputCache(str(tmp_path / "cache"), 15, ["1"])
+    for i, name in enumerate(["old", "used", "new"]):
+        path = write(tmp_path / f"{name}.txt", "0123456789")
+        outputs.store(name, [path])
+        os.utime(os.path.join(outputs.path, name, cache.ENTRY_FILE), (i, i))
+    outputs.restore("old", [str(tmp_path / "old.txt")])
+    outputs.evict()
+    assert [ name for name in ["old", "used", "new"] if outputs.contains(name) ] == ["old"]
+
+def test_pipeline_restores_cached_stage(tmp_path):
+    board = write(tmp_path / "board.kicad_pcb", "board")
+    output_file = str(tmp_path / "out" / "bom.csv")
+    runs = []
+
+    def export():
+        runs.append(1)
+        write(output_file, "R1,10k")
+        return "bom"
+
+    def make_pipeline() -> pipeline.Pipeline:
+        stages = pipeline.Pipeline(cache.OutputCache(str(tmp_path / "cache"), 1000000, ["1"]))
+        stages.add(pipeline.Stage("bom", "Generating BOM", export, inputs=[board], outputs=[output_file], key=lambda: ["bom"]))
+        return stages
+
+    make_pipeline().run()
+    os.remove(output_file)
+    stages = make_pipeline()
+    stages.run()
+    assert len(runs) == 1
+    assert stages.result("bom") == "bom"
+    assert read(output_file) == "R1,10k"
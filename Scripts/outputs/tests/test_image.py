@@ -0,0 +1,78 @@
+import pytest
+import image
+
+
+def test_vp9_speeds_follow_presets():
+    speeds = [ image.get_vp9_speed(preset) for preset in image.FFMPEG_PRESETS ]
+    assert speeds[0] == image.VP9_MAX_SPEED
+    assert speeds[-1] == 0
+    assert speeds == sorted(speeds, reverse=True)
+    # medium sits in the middle of the range, rather than at the slowest speed
+    assert 0 < image.get_vp9_speed("medium") < image.VP9_MAX_SPEED
+    assert image.get_vp9_speed("slow") > image.get_vp9_speed("veryslow")
+
+def test_ffmpeg_codec_args():
+    assert image.get_ffmpeg_codec_args(".webm", "medium", 30) == ["-deadline", "good", "-cpu-used", "2", "-crf", "30", "-b:v", "0"]
+    assert image.get_ffmpeg_codec_args(".mp4", "medium", 23) == ["-preset", "medium", "-crf", "23"]
+
+def read_gif_blocks(data: bytes) -> tuple[list[bytes], list[int]]:
+    # Returns the graphic control extensions, and the packed fields of each image descriptor, after the global palette
+    i = 13 + (3 << ((data[10] & 0x07) + 1) if data[10] & 0x80 else 0)
+    controls = []
+    descriptors = []
+    while data[i] != 0x3B:
+        if data[i] == 0x21:
+            if data[i + 1] == 0xF9:
+                controls.append(data[i + 3:i + 7])
+            i += 2
+        else:
+            packed = data[i + 9]
+            descriptors.append(packed)
+            i += 10 + (3 << ((packed & 0x07) + 1) if packed & 0x80 else 0) + 1
+        # Skip the data sub-blocks
+        while data[i]:
+            i += data[i] + 1
+        i += 1
+    return controls, descriptors
+
+def test_gif_writer(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    frames = {}
+    for name, colour, pos in [("a", (255, 0, 0, 255), (2, 2)), ("b", (0, 255, 0, 255), (20, 10)), ("c", (0, 0, 255, 255), (25, 25))]:
+        img = Image.new("RGBA", (40, 40), (0, 0, 0, 0))
+        img.paste(colour, (pos[0], pos[1], pos[0] + 10, pos[1] + 10))
+        frames[name] = str(tmp_path / f"{name}.png")
+        img.save(frames[name])
+
+    # Repeated frames are rendered once, so they share a source
+    sources = [ frames[name] for name in "aabccc" ]
+    dst = str(tmp_path / "anim.gif")
+    image.make_animation(sources, dst, framerate=10, bbox=(0, 0, 40, 40))
+
+    gif = Image.open(dst)
+    assert gif.n_frames == 3
+    durations = []
+    for i, (colour, centre) in enumerate([((255, 0, 0, 255), (7, 7)), ((0, 255, 0, 255), (25, 15)), ((0, 0, 255, 255), (30, 30))]):
+        gif.seek(i)
+        durations.append(gif.info["duration"])
+        frame = gif.convert("RGBA")
+        assert frame.getpixel(centre) == colour
+        # The rest of the frame is transparent, including where earlier frames were drawn
+        assert frame.getpixel((0, 39))[3] == 0
+        if i > 0:
+            assert frame.getpixel((7, 7))[3] == 0
+    assert durations == [200, 100, 300]
+
+    with open(dst, "rb") as f:
+        data = f.read()
+    # One global palette, and no frame has a palette of its own
+    assert data[10] & 0x80
+    controls, descriptors = read_gif_blocks(data)
+    assert len(descriptors) == 3
+    assert not any(packed & 0x80 for packed in descriptors)
+    # Every frame marks the reserved palette index as transparent, and is cleared before the next
+    for control in controls:
+        assert control[0] & 0x01
+        assert control[0] >> 2 & 0x07 == 2
+        assert control[3] == image.GIF_TRANSPARENT
+    assert [ control[1] | control[2] << 8 for control in controls ] == [20, 10, 30]
@@ -0,0 +1,28 @@
+import os
+import pytest
+import jobset, output
+
+
+def test_render_sides_are_kept(tmp_path):
+    for side in ["top", "bottom", "left", "right", "front", "back"]:
+        args = output.export_pcb_render_command("board.kicad_pcb", str(tmp_path / "render.png"), side, 0.9, (800, 600), "0,0,45")
+        job = jobset.create_job(args, str(tmp_path))
+        assert job["type"] == "pcb_render"
+        assert job["settings"]["side"] == side
+    assert job["settings"]["zoom"] == 0.9
+    assert (job["settings"]["width"], job["settings"]["height"]) == (800, 600)
+    assert job["settings"]["rotation_z"] == 45.0
+    assert job["settings"]["output_filename"] == "render.png"
+
+def test_pos_sides_are_translated(tmp_path):
+    args = output.export_pcb_pos_command("board.kicad_pcb", str(tmp_path / "fab" / "pos.csv"))
+    job = jobset.create_job(args, str(tmp_path))
+    assert job["type"] == "pcb_export_pos"
+    assert job["settings"]["side"] == "both"
+    assert job["settings"]["output_filename"] == os.path.join("fab", "pos.csv")
+    args = [ "kicad-cli", "pcb", "export", "pos", "board.kicad_pcb", "--side", "top" ]
+    assert jobset.create_job(args, str(tmp_path))["settings"]["side"] == "front"
+
+def test_unsupported_options_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        jobset.create_job([ "kicad-cli", "pcb", "render", "board.kicad_pcb", "--light-top", "1" ], str(tmp_path))
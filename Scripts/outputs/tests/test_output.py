@@ -0,0 +1,111 @@
+import os, sys, time, subprocess
+import pytest
+import output, pipeline
+
+
+def test_jobset_commands_do_not_outlive_the_run():
+    # A command left by the jobset, ie for a stage that failed, must not be skipped by a later run
+    def fail():
+        raise RuntimeError("failed")
+    stages = pipeline.Pipeline()
+    stages.add(pipeline.Stage("jobset", "Running jobset", lambda: output._completed_commands.add(("true",))))
+    stages.add(pipeline.Stage("export", "Running export", fail, after=["jobset"]))
+    with pytest.raises(RuntimeError):
+        output.run_stages(stages, 1)
+    assert not output._completed_commands
+
+def test_gate_cancels_running_commands():
+    # A failed check terminates the commands still running, and its failure is raised rather than the cancellation
+    group = output._command_group.get()
+
+    def check():
+        while not group.processes:
+            time.sleep(0.01)
+        output.cancel_commands()
+        raise output.CheckFailed("ERC failed")
+
+    stages = pipeline.Pipeline()
+    stages.add(pipeline.Stage("export", "Exporting", lambda: output.run_command([sys.executable, "-c", "import time; time.sleep(30)"])))
+    stages.add(pipeline.Stage("erc", "Running ERC", check))
+    start = time.monotonic()
+    try:
+        with pytest.raises(output.CheckFailed):
+            output.run_stages(stages, 2)
+    finally:
+        output.reset_cancel()
+    assert time.monotonic() - start < 10
+    assert not group.processes
+
+def test_select_stages(tmp_path):
+    kept = tmp_path / "render.png"
+    removed = tmp_path / "bom.csv"
+    kept.write_text("render")
+    removed.write_text("bom")
+    stages = pipeline.Pipeline()
+    stages.add(pipeline.Stage("erc", "Running ERC", lambda: None))
+    stages.add(pipeline.Stage("bom", "Generating BOM", lambda: None, depends=["erc"], outputs=[str(removed)]))
+    stages.add(pipeline.Stage("render", "Rendering", lambda: None, outputs=[str(kept)]))
+
+    assert output.select_stages(stages, ["bom"]) == {"bom", "erc"}
+    # The old outputs of the selected stages are removed, and others are left in place
+    assert not removed.exists()
+    assert kept.exists()
+    with pytest.raises(ValueError, match="Unknown stages pcb"):
+        output.select_stages(stages, ["pcb"])
+
+def test_parser_does_not_load_exports():
+    # Importing output.py and building the parser must not load the export modules.
+    # Run in a new process, as other tests have already imported them.
+    code = "\n".join([
+        "import sys, output",
+        "output.get_argparser().parse_args([])",
+        "print(','.join(sorted(m for m in ['bom', 'image', 'bundle', 'schematic', 'PIL', 'numpy', 'pypdf'] if m in sys.modules)))",
+    ])
+    scripts = os.path.dirname(output.__file__)
+    result = subprocess.run([sys.executable, "-c", code], cwd=scripts, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
+
+def test_argument_choices_match_modules():
+    import bom, bundle, image
+    assert output.ANIMATION_FORMATS == image.ANIMATION_FORMATS
+    assert output.FFMPEG_PRESETS == image.FFMPEG_PRESETS
+    assert output.BOM_GROUP_KEYS == bom.DEFAULT_GROUP_KEYS
+    assert output.COMPRESSION_FORMATS == bundle.SUPPORTED_FORMATS
+
+def fake_probe_renderer(renders: list, half_size: tuple[float, float]):
+    # Stands in for kicad-cli, drawing an opaque board centered in the frame which scales linearly with zoom
+    from PIL import Image
+    def run_render(input_pcb, args, render_cache = None):
+        zoom = float(args[args.index("--zoom") + 1])
+        width, height = int(args[args.index("--width") + 1]), int(args[args.index("--height") + 1])
+        renders.append(zoom)
+        img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        dx, dy = half_size[0] * zoom, half_size[1] * zoom
+        img.paste((0, 128, 0, 255), (round(width / 2 - dx), round(height / 2 - dy), round(width / 2 + dx), round(height / 2 + dy)))
+        img.save(args[args.index("--output") + 1])
+        return False
+    return run_render
+
+def test_find_framing(tmp_path, monkeypatch):
+    # At zoom 0.5 the board covers 4/5 of the probe's width and 2/5 of its height
+    renders = []
+    monkeypatch.setattr(output, "run_render", fake_probe_renderer(renders, (160, 80)))
+    zoom, resolution = output.find_framing("board.kicad_pcb", str(tmp_path), "top", 0.5, 380)
+    assert renders == [0.5]
+    assert zoom == pytest.approx(0.5 * output.AUTO_FRAME_FILL / 0.4)
+    assert resolution == (400, 200)
+    assert not os.listdir(tmp_path)
+
+def test_find_framing_zooms_out_of_clipped_board(tmp_path, monkeypatch):
+    # At zoom 1 the board is wider than the probe, so the zoom is halved before it is measured
+    renders = []
+    monkeypatch.setattr(output, "run_render", fake_probe_renderer(renders, (160, 80)))
+    zoom, resolution = output.find_framing("board.kicad_pcb", str(tmp_path), "top", 1.0, 380)
+    assert renders == [1.0, 0.5]
+    assert zoom == pytest.approx(0.5 * output.AUTO_FRAME_FILL / 0.4)
+    assert resolution == (400, 200)
+
+def test_find_framing_rejects_empty_probe(tmp_path, monkeypatch):
+    monkeypatch.setattr(output, "run_render", fake_probe_renderer([], (0, 0)))
+    with pytest.raises(Exception, match = "fully transparent"):
+        output.find_framing("board.kicad_pcb", str(tmp_path), "top", 0.5, 380)
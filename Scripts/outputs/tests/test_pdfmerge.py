@@ -0,0 +1,72 @@
+import os
+import pytest
+import pdfmerge
+
+pypdf = pytest.importorskip("pypdf")
+generic = pypdf.generic
+
+
+def write_pdf(path: str, texts: list[str]):
+    # Each page draws its text with a font shared by all pages of the file
+    writer = pypdf.PdfWriter()
+    font = writer._add_object(generic.DictionaryObject({
+        generic.NameObject("/Type"): generic.NameObject("/Font"),
+        generic.NameObject("/Subtype"): generic.NameObject("/Type1"),
+        generic.NameObject("/BaseFont"): generic.NameObject("/Helvetica"),
+    }))
+    for text in texts:
+        page = writer.add_blank_page(200, 200)
+        content = generic.DecodedStreamObject()
+        content.set_data(f"BT /F1 12 Tf 20 100 Td ({text}) Tj ET".encode())
+        page[generic.NameObject("/Contents")] = writer._add_object(content)
+        page[generic.NameObject("/Resources")] = generic.DictionaryObject({
+            generic.NameObject("/Font"): generic.DictionaryObject({ generic.NameObject("/F1"): font }),
+        })
+    writer.write(path)
+    return path
+
+def test_merge_pages_and_bookmarks(tmp_path):
+    files = [
+        write_pdf(str(tmp_path / "a.pdf"), ["alpha"]),
+        write_pdf(str(tmp_path / "b.pdf"), ["beta", "gamma"]),
+    ]
+    output = str(tmp_path / "out.pdf")
+    pdfmerge.merge_pdf(iter(files), output, ["Top", "Bottom"], backend="pypdf")
+
+    reader = pypdf.PdfReader(output, strict=True)
+    assert [ page.extract_text() for page in reader.pages ] == ["alpha", "beta", "gamma"]
+    assert [ (item.title, reader.get_destination_page_number(item)) for item in reader.outline ] == [ ("Top", 0), ("Bottom", 1) ]
+    # The font shared by the pages of b.pdf is written once
+    fonts = { page["/Resources"]["/Font"].raw_get("/F1").idnum for page in reader.pages[1:] }
+    assert len(fonts) == 1
+
+def test_merge_without_titles(tmp_path):
+    files = [ write_pdf(str(tmp_path / "a.pdf"), ["alpha"]) ]
+    output = str(tmp_path / "out.pdf")
+    pdfmerge.merge_pdf(files, output, backend="pypdf")
+    reader = pypdf.PdfReader(output, strict=True)
+    assert len(reader.pages) == 1
+    assert reader.outline == []
+
+def test_pages_are_written_as_files_arrive(tmp_path):
+    output = str(tmp_path / "out.pdf")
+
+    def files():
+        yield write_pdf(str(tmp_path / "a.pdf"), ["alpha"])
+        # The first file is already in the output before the next is made
+        assert os.path.getsize(output) > 100
+        yield write_pdf(str(tmp_path / "b.pdf"), ["beta"])
+
+    pdfmerge.merge_pdf(files(), output, ["A", "B"], backend="pypdf")
+    assert len(pypdf.PdfReader(output).pages) == 2
+
+def test_failed_merge_removes_output(tmp_path):
+    output = str(tmp_path / "out.pdf")
+
+    def files():
+        yield write_pdf(str(tmp_path / "a.pdf"), ["alpha"])
+        raise RuntimeError("plot failed")
+
+    with pytest.raises(RuntimeError):
+        pdfmerge.merge_pdf(files(), output, ["A", "B"], backend="pypdf")
+    assert not os.path.exists(output)
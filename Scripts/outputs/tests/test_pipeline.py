@@ -0,0 +1,150 @@
+import time, threading
+import pytest
+import pipeline
+
+
+def make_stage(name: str, log: list, **kwargs) -> pipeline.Stage:
+    def run():
+        log.append(name)
+        return name
+    return pipeline.Stage(name, f"Running {name}", run, **kwargs)
+
+def failing_stage(name: str, error: BaseException, wait: threading.Event = None, **kwargs) -> pipeline.Stage:
+    def run():
+        if wait is not None:
+            wait.wait(5)
+        raise error
+    return pipeline.Stage(name, f"Running {name}", run, **kwargs)
+
+
+def test_failure_stops_later_stages():
+    log = []
+    stages = pipeline.Pipeline()
+    stages.add(make_stage("erc", log))
+    stages.add(failing_stage("gerbers", ValueError("plot failed")))
+    stages.add(make_stage("drill", log))
+    stages.add(make_stage("bundle", log, depends=["erc"]))
+
+    with pytest.raises(ValueError, match="plot failed"):
+        stages.run(1)
+    assert log == ["erc"]
+    assert stages.completed == {"erc"}
+
+def test_running_stages_finish_after_failure():
+    log = []
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.1)
+        log.append("render")
+
+    stages = pipeline.Pipeline()
+    stages.add(pipeline.Stage("render", "Rendering", slow))
+    stages.add(failing_stage("gerbers", ValueError("plot failed"), started))
+    stages.add(make_stage("drill", log))
+
+    with pytest.raises(ValueError):
+        stages.run(2)
+    # The render was running when the plot failed, so it completes. The drill files are not started.
+    assert log == ["render"]
+    assert stages.completed == {"render"}
+
+def test_cancelled_stage_does_not_hide_failure():
+    # An export is cancelled by a failed check, and finishes first. The check's failure is still the one raised.
+    cancelled = threading.Event()
+
+    def export():
+        cancelled.set()
+        raise pipeline.Cancelled("export cancelled")
+
+    stages = pipeline.Pipeline()
+    stages.add(pipeline.Stage("export", "Exporting", export))
+    stages.add(failing_stage("erc", ValueError("ERC failed"), cancelled))
+    with pytest.raises(ValueError, match="ERC failed"):
+        stages.run(2)
+
+def test_group_failure_prefers_real_error():
+    cancelled = threading.Event()
+
+    def export():
+        cancelled.set()
+        raise pipeline.Cancelled("export cancelled")
+
+    stages = pipeline.Pipeline()
+    stages.add(pipeline.Stage("export", "Exporting", export))
+    stages.add(failing_stage("erc", ValueError("ERC failed"), cancelled))
+    combined = pipeline.interleave({"a": stages})
+    combined.run(2)
+    assert str(combined.failures["a"]) == "ERC failed"
+
+def test_group_failure_stops_only_its_group():
+    log = []
+    a = pipeline.Pipeline()
+    a.add(failing_stage("erc", ValueError("ERC failed")))
+    a.add(make_stage("a-gerbers", log))
+    b = pipeline.Pipeline()
+    b.add(make_stage("b-erc", log))
+    b.add(make_stage("b-gerbers", log))
+
+    combined = pipeline.interleave({"a": a, "b": b})
+    combined.run(1)
+    assert log == ["b-erc", "b-gerbers"]
+    assert list(combined.failures) == ["a"]
+    assert combined.completed == {"b/b-erc", "b/b-gerbers"}
+
+
+def test_after_orders_without_affecting():
+    log = []
+    stages = pipeline.Pipeline()
+    stages.add(make_stage("jobset", log))
+    stages.add(make_stage("sch", log, inputs=["board.kicad_sch"], after=["jobset"]))
+    stages.add(make_stage("pcb", log, inputs=["board.kicad_pcb"], after=["jobset"]))
+
+    # A change to one file only affects the stage that reads it
+    assert stages.affected_by(["board.kicad_pcb"]) == {"pcb"}
+
+    # The stages it comes after are run with it, and first
+    stages.run(2, {"pcb"})
+    assert log == ["jobset", "pcb"]
+    assert stages.completed == {"jobset", "pcb"}
+
+def test_get_after_follows_interleave():
+    stages = pipeline.Pipeline()
+    jobset = stages.add(make_stage("jobset", []))
+    stages.add(make_stage("gerbers", [], after=["jobset"]))
+    combined = pipeline.interleave({"a": stages})
+    assert jobset.pipeline is combined
+    assert [ s.name for s in combined.get_after(jobset) ] == ["a/gerbers"]
+
+def test_interleave_takes_stages_in_turn():
+    log = []
+    pipelines = {}
+    for prefix, names in [("a", ["erc", "gerbers", "render"]), ("b", ["erc", "gerbers"])]:
+        stages = pipeline.Pipeline()
+        previous = []
+        for name in names:
+            stages.add(make_stage(f"{prefix}-{name}", log, depends=previous))
+            previous = [f"{prefix}-{name}"]
+        pipelines[prefix] = stages
+
+    combined = pipeline.interleave(pipelines)
+    assert combined.names() == ["a/a-erc", "b/b-erc", "a/a-gerbers", "b/b-gerbers", "a/a-render"]
+    stage = combined.stages["b/b-gerbers"]
+    assert stage.depends == ["b/b-erc"]
+    assert stage.group == "b"
+    assert stage.title == "b: Running b-gerbers"
+
+    combined.run(1)
+    assert log == ["a-erc", "b-erc", "a-gerbers", "b-gerbers", "a-render"]
+    # The results are still read through each project's own pipeline
+    assert pipelines["a"].result("a-render") == "a-render"
+
+def test_get_dependencies():
+    stages = pipeline.Pipeline()
+    stages.add(make_stage("erc", []))
+    stages.add(make_stage("bom", []))
+    stages.add(make_stage("pos", [], depends=["erc"]))
+    stages.add(make_stage("bundle", [], depends=["bom", "pos"]))
+    assert stages.get_dependencies(["pos"]) == {"pos", "erc"}
+    assert stages.get_dependencies(["bundle"]) == {"bundle", "bom", "pos", "erc"}
@@ -0,0 +1,80 @@
+import json
+import pytest
+import cache, report
+
+DRC = {
+    "source": "board.kicad_pcb",
+    "violations": [
+        { "type": "clearance", "severity": "error", "description": "Clearance violation",
+          "items": [ { "description": "Track on F.Cu", "pos": { "x": 1.0, "y": 2.0 }, "uuid": "a" } ] },
+        { "type": "clearance", "severity": "error", "description": "Clearance violation",
+          "items": [ { "description": "Track on F.Cu", "pos": { "x": 1.0, "y": 2.0 }, "uuid": "b" } ] },
+    ],
+    "unconnected_items": [
+        { "type": "unconnected_items", "severity": "error", "description": "Missing connection",
+          "items": [ { "description": "Pad 1 of R1", "pos": { "x": 3, "y": 4 } } ] },
+    ],
+    "schematic_parity": [],
+}
+
+ERC = {
+    "sheets": [
+        { "path": "/", "violations": [ { "type": "pin_not_connected", "severity": "error", "items": [] } ] },
+        { "path": "/a/", "violations": [ { "type": "pin_not_connected", "severity": "error", "items": [] } ] },
+    ],
+}
+
+@pytest.fixture(params=["ijson", "json"])
+def parser(request, monkeypatch):
+    # Runs each test with the streaming and the whole document reader
+    if request.param == "ijson":
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr(report, "ijson", None)
+    return request.param
+
+def write_json(tmp_path, name: str, data: dict) -> str:
+    path = tmp_path / name
+    path.write_text(json.dumps(data))
+    return str(path)
+
+def test_load_drc(tmp_path, parser):
+    index = report.load_drc(write_json(tmp_path, "drc.json", DRC))
+    assert sorted((v.section, v.type) for v in index.values()) == [
+        ("unconnected_items", "unconnected_items"),
+        ("violations", "clearance"),
+        ("violations", "clearance"),
+    ]
+    # Repeats of a fingerprint are numbered
+    clearance = [ f for f, v in index.items() if v.type == "clearance" ]
+    assert clearance[1] == clearance[0] + "-2"
+
+def test_load_erc(tmp_path, parser):
+    index = report.load_erc(write_json(tmp_path, "erc.json", ERC))
+    assert sorted(v.sheet for v in index.values()) == ["/", "/a/"]
+    assert len(set(index)) == 2
+
+def test_iter_values_reads_once(tmp_path, monkeypatch):
+    ijson = pytest.importorskip("ijson")
+    path = write_json(tmp_path, "drc.json", DRC)
+    parses = []
+    parse = ijson.parse
+    monkeypatch.setattr(ijson, "parse", lambda *args, **kwargs: parses.append(1) or parse(*args, **kwargs))
+    values = list(report.iter_values(path, report.DRC_SECTIONS))
+    assert len(values) == 3
+    assert len(parses) == 1
+
+def test_iter_values_scalars(tmp_path, parser):
+    path = write_json(tmp_path, "data.json", { "a": [1, "x", None, [2]], "b": { "c": 3 } })
+    assert sorted(map(repr, report.iter_values(path, ["a.item", "b.c"]))) == sorted(map(repr, [
+        ("a.item", 1), ("a.item", "x"), ("a.item", None), ("a.item", [2]), ("b.c", 3),
+    ]))
+
+def test_report_key_allows_missing_inputs(tmp_path):
+    board = write_json(tmp_path, "board.kicad_pcb", {})
+    missing = str(tmp_path / "board.kicad_pro")
+    reports = report.ReportCache(str(tmp_path / "cache"), 1000000, ["1"])
+    key = reports.make_key([board, missing], ["drc", "--output", "a.json"])
+    # The output path is not part of the key
+    assert key == reports.make_key([board, missing], ["drc", "--output", "b.json"])
+    assert cache.hash_inputs([board, missing]) == [ cache.hash_file(board), None ]
@@ -0,0 +1,38 @@
+import os
+import bom, schematic
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_matches_python_bom():
+    # board.xml is the python-bom export of board.kicad_sch, as written by kicad-cli
+    xml_components = bom.load_components(os.path.join(DATA, "board.xml"))
+    sch_components = schematic.load_components(os.path.join(DATA, "board.kicad_sch"))
+    assert bom.compare_components(xml_components, sch_components, ["MPN", "LCSC_Part"]) == []
+
+def test_unannotated_parts_are_kept_apart():
+    components = schematic.load_components(os.path.join(DATA, "board.kicad_sch"))
+    unannotated = [ c for c in components if c.ref == "R?" ]
+    assert sorted(c.value for c in unannotated) == ["1k", "2k2"]
+
+def test_units_are_combined():
+    components = schematic.load_components(os.path.join(DATA, "board.kicad_sch"))
+    [ u1 ] = [ c for c in components if c.ref == "U1" ]
+    assert u1.fields["MPN"] == "LM358DR"
+
+def test_sheet_instances():
+    components = schematic.load_components(os.path.join(DATA, "board.kicad_sch"))
+    assert [ c.ref for c in components if c.value == "100n" ] == ["C10", "C20"]
+
+def test_compare_reports_duplicates():
+    parts = [ bom.Component("R?", "1k", "R_0402", 1, {}), bom.Component("R?", "2k2", "R_0402", 1, {}) ]
+    assert bom.compare_components(parts, parts[:1], []) == [ "R? appears 1 times, expected 2" ]
+
+def test_unit_counts():
+    with open(os.path.join(DATA, "board.kicad_sch"), "r") as f:
+        text = f.read()
+    assert schematic.get_unit_counts(text) == {
+        "Device:R": 1,
+        "Amplifier_Operational:LM358": 3,
+        "power:GND": 1,
+    }
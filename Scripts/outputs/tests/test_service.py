@@ -0,0 +1,47 @@
+import os
+import pytest
+import service
+
+
+@pytest.mark.parametrize("args", [
+    ["--output", "outputs"],
+    ["-o", "elsewhere"],
+    ["--output=outputs"],
+    ["--cache-dir", ".output-cache"],
+    ["--jobs", str(os.cpu_count())],
+    ["-j", "1"],
+    ["--input", "*.kicad_pro"],
+    ["--trace", "trace.json"],
+    ["--watch"],
+    ["--layers", "4", "--max-commands", "2"],
+])
+def test_rejects_service_options(args):
+    # Service options are rejected even when given with their default value
+    with pytest.raises(ValueError, match="Options set by the service"):
+        service.parse_job_args(args)
+
+def test_accepts_job_options():
+    options = service.parse_job_args(["--layers", "4", "--compression", "zip", "--gate", "error"])
+    assert options.layers == 4
+    assert options.gate == "error"
+    assert not hasattr(options, "output")
+
+def test_rejects_invalid_arguments():
+    with pytest.raises(ValueError):
+        service.parse_job_args(["--layers", "four"])
+    with pytest.raises(ValueError):
+        service.parse_job_args(["--no-such-option"])
+    with pytest.raises(ValueError, match="update-baseline"):
+        service.parse_job_args(["--update-baseline"])
+
+def test_project_files_skip_missing_baseline(tmp_path):
+    input_file = str(tmp_path / "board")
+    for ext in [".kicad_pro", ".kicad_pcb", ".kicad_sch"]:
+        (tmp_path / ("board" + ext)).write_text("(kicad_sch)" if ext == ".kicad_sch" else "")
+    options = service.parse_job_args(["--baseline", "baseline.json"])
+    files = service.get_project_files(input_file, options, str(tmp_path))
+    assert str(tmp_path / "baseline.json") not in files
+    # The key can be made without the baseline, and changes once it exists
+    key = service.make_key(files, options)
+    (tmp_path / "baseline.json").write_text("{}")
+    assert service.make_key(service.get_project_files(input_file, options, str(tmp_path)), options) != key
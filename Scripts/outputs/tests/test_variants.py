@@ -0,0 +1,88 @@
+import os, csv, json
+import pytest
+import output, variants
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+VARIANTS = {
+    "variants": {
+        "full": {},
+        "lite": { "dnp": ["U1", "C20"] },
+        "proto": { "fit": ["R2"], "fields": ["MPN"] },
+    }
+}
+
+def read_rows(path: str) -> list[list[str]]:
+    with open(path, "r", newline="") as f:
+        return list(csv.reader(f))
+
+def load(tmp_path, config: dict) -> list[variants.Variant]:
+    path = tmp_path / "variants.json"
+    path.write_text(json.dumps(config))
+    return variants.load_variants(str(path), ["LCSC_Part"])
+
+def test_load_variants(tmp_path):
+    full, lite, proto = load(tmp_path, VARIANTS)
+    assert [ v.name for v in (full, lite, proto) ] == ["full", "lite", "proto"]
+    assert lite.dnp == {"U1", "C20"}
+    assert proto.fit == {"R2"}
+    # Variants use the fields of the format, unless they give their own
+    assert full.fields == ["LCSC_Part"]
+    assert proto.fields == ["MPN"]
+
+def test_load_variants_rejects_bad_definitions(tmp_path):
+    with pytest.raises(ValueError, match="Unknown options"):
+        load(tmp_path, { "variants": { "lite": { "remove": ["U1"] } } })
+    with pytest.raises(ValueError, match="may only contain"):
+        load(tmp_path, { "variants": { "lite v2": {} } })
+    with pytest.raises(ValueError, match="No variants"):
+        load(tmp_path, { "variants": {} })
+
+def test_variant_boms(tmp_path):
+    variant_list = load(tmp_path, VARIANTS)
+    outputs = [ (v, str(tmp_path / "Assembly" / f"board.{v.name}.bom.csv")) for v in variant_list ]
+    dnf_lists = output.export_sch_bom(os.path.join(DATA, "board.kicad_sch"), outputs)
+
+    header = ["Id", "Value", "Designator", "Quantity", "Package"]
+    assert read_rows(outputs[0][1]) == [
+        header + ["LCSC_Part"],
+        ["1", "100n", "C10,C20", "2", "C_0402_1005Metric", "C1525"],
+        ["2", "10k", "R1", "1", "R_0402_1005Metric", ""],
+        ["3", "1k", "R?", "1", "R_0402_1005Metric", ""],
+        ["4", "2k2", "R?", "1", "R_0603_1608Metric", ""],
+        ["5", "LM358", "U1", "1", "SOIC-8_3.9x4.9mm_P1.27mm", ""],
+    ]
+    # lite leaves out U1 and one of the capacitors
+    assert read_rows(outputs[1][1]) == [
+        header + ["LCSC_Part"],
+        ["1", "100n", "C10", "1", "C_0402_1005Metric", "C1525"],
+        ["2", "10k", "R1", "1", "R_0402_1005Metric", ""],
+        ["3", "1k", "R?", "1", "R_0402_1005Metric", ""],
+        ["4", "2k2", "R?", "1", "R_0603_1608Metric", ""],
+    ]
+    # proto fits R2, which is DNP in the schematic, and lists the MPN instead
+    assert read_rows(outputs[2][1]) == [
+        header + ["MPN"],
+        ["1", "100n", "C10,C20", "2", "C_0402_1005Metric", ""],
+        ["2", "10k", "R1", "1", "R_0402_1005Metric", "RC0402FR-0710KL"],
+        ["3", "4k7", "R2", "1", "R_0402_1005Metric", ""],
+        ["4", "1k", "R?", "1", "R_0402_1005Metric", ""],
+        ["5", "2k2", "R?", "1", "R_0603_1608Metric", ""],
+        ["6", "LM358", "U1", "1", "SOIC-8_3.9x4.9mm_P1.27mm", "LM358DR"],
+    ]
+
+    assert dnf_lists == [["R2"], ["C20", "R2", "U1"], []]
+    with open(tmp_path / "Assembly" / "board.lite.dnf.txt", "r") as f:
+        assert f.read().split() == ["C20", "R2", "U1"]
+
+def test_variant_positions(tmp_path):
+    pos_csv = tmp_path / "board.pos.csv"
+    pos_csv.write_text("Designator,Val,Package,Mid X,Mid Y,Rotation,Layer\n"
+                       "C10,100n,C_0402,1,2,0,top\n"
+                       "C20,100n,C_0402,3,4,0,top\n"
+                       "R2,4k7,R_0402,5,6,90,bottom\n"
+                       "U1,LM358,SOIC-8,7,8,0,top\n")
+    outputs = [ str(tmp_path / "board.lite.pos.csv"), str(tmp_path / "board.proto.pos.csv") ]
+    output.export_pcb_pos_variants(str(pos_csv), outputs, [["C20", "R2", "U1"], []])
+    assert [ row[0] for row in read_rows(outputs[0]) ] == ["Designator", "C10"]
+    assert [ row[0] for row in read_rows(outputs[1]) ] == ["Designator", "C10", "C20", "R2", "U1"]